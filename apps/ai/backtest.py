@@ -0,0 +1,291 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Backtest rolling-origin: phát lại lịch sử air_quality_observations, mỗi bucket là 1 mốc dự báo (origin),
+# dự báo `horizons` bucket tiếp theo bằng LSTM từng trạm (predict.py), ST_GNN (predict_gnn.py) và persistence
+# (giữ nguyên giá trị cuối), rồi tính MAE/RMSE theo trạm và theo bước dự báo.
+# Mọi origin chạy chung 1 batch lớn (cửa sổ trượt dạng view), không lặp từng slot.
+#   python backtest.py --days 90                   # báo cáo LSTM + GNN + persistence
+#   python backtest.py --gate --rollback          # cổng sau train: GNN CURRENT phải tốt hơn persistence / version trước
+# Lưu ý: model được đánh giá trên cả dữ liệu đã dùng để train (không train lại theo từng origin).
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from stations import HCMC_GRID
+from data_access import GNN_GRID_FREQ, LSTM_GRID_FREQ, parse_interval, fetch_bucket_means, to_grid, fill_gaps
+
+BACKTEST_HORIZONS = int(os.getenv('BACKTEST_HORIZONS', '4'))
+# Số origin mỗi lần forward (giới hạn bộ nhớ khi có nhiều trạm / lịch sử dài)
+BACKTEST_BATCH = int(os.getenv('BACKTEST_BATCH', '8192'))
+# Cổng sau train: MAE của GNN mới (mọi bước dự báo) không được tệ hơn persistence / version trước quá ngưỡng
+BACKTEST_GATE_DAYS = float(os.getenv('BACKTEST_GATE_DAYS', '14'))
+BACKTEST_GATE_TOLERANCE = float(os.getenv('BACKTEST_GATE_TOLERANCE', '0.05'))
+
+def entity_id(grid_point):
+    return f"urn:ngsi-ld:AirQualityStation:OWM-{grid_point['id']}"
+
+def load_history(engine, grid_points, freq, days=None):
+    """
+    Lịch sử trên lưới đều: (bucket [T], observed [T, N] NaN = bucket không có dữ liệu, filled [T, N]).
+    `filled` lấp khoảng trống giống lúc predict (nội suy, giữ giá trị cuối) -> dùng làm input;
+    `observed` dùng làm target (bucket không có quan trắc thật không được tính điểm).
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+    entity_ids = [entity_id(p) for p in grid_points]
+    series = fetch_bucket_means(engine, entity_ids, freq, since=since)
+    times, observed = to_grid(series, entity_ids, freq)
+    return times, observed, fill_gaps(observed)
+
+def make_windows(filled, observed, seq_length, horizons):
+    """
+    Cửa sổ input [O, N, Seq] (view, không copy) và target [O, N, Horizons] của mọi origin.
+    Origin o dùng filled[o:o+Seq] dự báo observed[o+Seq : o+Seq+Horizons]; các bước vượt quá lịch sử là NaN.
+    """
+    num_steps, num_nodes = observed.shape
+    if num_steps <= seq_length:
+        return np.empty((0, num_nodes, seq_length)), np.empty((0, num_nodes, horizons))
+    windows = np.lib.stride_tricks.sliding_window_view(filled[:num_steps - 1], seq_length, axis=0)
+    padded = np.concatenate([observed[seq_length:], np.full((horizons - 1, num_nodes), np.nan)])
+    targets = np.lib.stride_tricks.sliding_window_view(padded, horizons, axis=0)
+    return windows, targets
+
+def rollout(step, windows, horizons, batch=BACKTEST_BATCH):
+    """
+    Dự báo `horizons` bước cho mọi origin: step(windows [B, N, Seq]) -> [B, N, k] (k bước 1 lần).
+    Model ra ít bước hơn `horizons` thì nối dự báo vào cuối cửa sổ và dự báo tiếp (đệ quy).
+    """
+    outputs = []
+    for start in range(0, len(windows), batch):
+        window = np.asarray(windows[start:start + batch], dtype=np.float32)
+        preds = []
+        while sum(p.shape[-1] for p in preds) < horizons:
+            pred = step(window)
+            preds.append(pred)
+            window = np.concatenate([window, pred], axis=-1)[..., -window.shape[-1]:]
+        outputs.append(np.concatenate(preds, axis=-1)[..., :horizons])
+    return np.concatenate(outputs) if outputs else np.empty(windows.shape[:2] + (horizons,))
+
+def persistence(windows, horizons):
+    # Dự báo = giá trị cuối của cửa sổ cho mọi bước
+    return np.repeat(windows[..., -1:], horizons, axis=-1)
+
+def score(pred, targets, valid):
+    """
+    MAE/RMSE trên các origin có input đầy đủ (`valid` [O, N]) và target thật.
+    Trả về dict: mae/rmse/count theo [Trạm, Bước] + tổng theo bước và toàn bộ.
+    """
+    mask = valid[..., np.newaxis] & ~np.isnan(targets)
+    err = np.where(mask, pred - np.nan_to_num(targets), 0.0)
+    count = mask.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mae = np.abs(err).sum(axis=0) / count
+        rmse = np.sqrt((err ** 2).sum(axis=0) / count)
+        total = count.sum(axis=0)
+        return {
+            'mae': mae, 'rmse': rmse, 'count': count,
+            'mae_by_horizon': np.abs(err).sum(axis=(0, 1)) / total,
+            'rmse_by_horizon': np.sqrt((err ** 2).sum(axis=(0, 1)) / total),
+            'mae_overall': float(np.abs(err).sum() / count.sum()),
+        }
+
+def lstm_step(model, scale, offset):
+    """step() cho rollout từ các AirQualityLSTM xếp chồng (predict.load_stacked_models), đơn vị µg/m³."""
+    from predict import predict_stations
+    scale, offset = scale[:, np.newaxis], offset[:, np.newaxis]
+
+    def step(window):
+        # [B, Trạm, Seq] -> scaler từng trạm -> [Trạm, B, Seq, 1] như predict.py
+        scaled = window * scale + offset
+        X_input = np.ascontiguousarray(scaled.transpose(1, 0, 2)[..., np.newaxis], dtype=np.float32)
+        pred = predict_stations(model, X_input)[..., 0].T
+        return np.maximum(0.0, (pred - offset[:, 0]) / scale[:, 0])[..., np.newaxis]
+    return step
+
+def gnn_step(bundle):
+    """step() cho rollout từ 1 GNNBundle (đồ thị tĩnh: B snapshot gộp thành [B*Nodes, Seq, 1]), đơn vị µg/m³."""
+    data_min = bundle.scaler.min_[np.newaxis, :, np.newaxis]
+    data_scale = bundle.scaler.scale_[np.newaxis, :, np.newaxis]
+
+    def step(window):
+        batch, num_nodes, seq_length = window.shape
+        scaled = window * data_scale + data_min
+        input_data = np.ascontiguousarray(scaled.reshape(batch * num_nodes, seq_length, 1), dtype=np.float32)
+        out = bundle.predict(input_data).reshape(batch, num_nodes, -1)
+        return np.maximum(0.0, (out - data_min) / data_scale)
+    return step
+
+def evaluate(step, history, seq_length, horizons):
+    """Chạy rollout cho mọi origin rồi chấm điểm model và persistence trên cùng tập origin."""
+    _, observed, filled = history
+    windows, targets = make_windows(filled, observed, seq_length, horizons)
+    # Origin trước bản ghi đầu của trạm (input còn NaN) không được tính
+    valid = ~np.isnan(windows).any(axis=-1)
+    inputs = np.nan_to_num(windows)
+    start = time.perf_counter()
+    pred = rollout(step, inputs, horizons)
+    elapsed = time.perf_counter() - start
+    return {
+        'model': score(pred, targets, valid),
+        'persistence': score(persistence(inputs, horizons), targets, valid),
+        'origins': len(windows),
+        'seconds': elapsed,
+    }
+
+def print_report(name, result, station_ids, step_minutes):
+    model, base = result['model'], result['persistence']
+    horizons = model['mae'].shape[1]
+    labels = [f"+{step_minutes * (h + 1)}m" for h in range(horizons)]
+    print(f"\n📈 {name}: {result['origins']} origin, forward {result['seconds']:.2f}s "
+          f"(MAE / RMSE µg/m³, [persistence])")
+    print(f"   {'Trạm':<14}" + ''.join(f"{label:>26}" for label in labels))
+    for i, station in enumerate(station_ids):
+        cells = [f"{model['mae'][i, h]:6.2f}/{model['rmse'][i, h]:6.2f} [{base['mae'][i, h]:6.2f}]" for h in range(horizons)]
+        print(f"   {station:<14}" + ''.join(f"{cell:>26}" for cell in cells))
+    cells = [f"{model['mae_by_horizon'][h]:6.2f}/{model['rmse_by_horizon'][h]:6.2f} [{base['mae_by_horizon'][h]:6.2f}]"
+             for h in range(horizons)]
+    print(f"   {'TỔNG':<14}" + ''.join(f"{cell:>26}" for cell in cells))
+
+def to_json(result, station_ids, step_minutes):
+    def section(s):
+        return {
+            'mae_overall': s['mae_overall'],
+            'mae_by_horizon': s['mae_by_horizon'].tolist(),
+            'rmse_by_horizon': s['rmse_by_horizon'].tolist(),
+            'stations': {
+                station: {'mae': s['mae'][i].tolist(), 'rmse': s['rmse'][i].tolist(), 'count': s['count'][i].tolist()}
+                for i, station in enumerate(station_ids)
+            },
+        }
+    return {'origins': result['origins'], 'seconds': result['seconds'], 'step_minutes': step_minutes,
+            'model': section(result['model']), 'persistence': section(result['persistence'])}
+
+def run_lstm(engine, days, horizons):
+    from predict import load_stacked_models, SEQ_LENGTH
+    points, model, scale, offset = load_stacked_models(HCMC_GRID)
+    if not points:
+        return None
+    history = load_history(engine, points, LSTM_GRID_FREQ, days)
+    result = evaluate(lstm_step(model, scale, offset), history, SEQ_LENGTH, horizons)
+    return [p['id'] for p in points], result
+
+def run_gnn(engine, registry, version, days, horizons, backend):
+    from predict_gnn import SEQ_LENGTH, load_gnn_bundle
+    # Bundle eager/lite/int8 nhận batch bất kỳ; artifact TorchScript/ONNX được export với 1 snapshot
+    bundle = load_gnn_bundle(registry, version=version, backend=backend)
+    history = load_history(engine, HCMC_GRID, GNN_GRID_FREQ, days)
+    return bundle.version, evaluate(gnn_step(bundle), history, SEQ_LENGTH, horizons)
+
+def predecessor(registry, version):
+    """Version CURRENT ngay trước khi `version` được publish (ghi trong metadata lúc train), None nếu không có."""
+    metadata = registry.load_manifest(version, verify=False).get('metadata', {})
+    return metadata.get('previous_version', metadata.get('base_version'))
+
+def gate(engine, horizons, backend, rollback, baseline=None, tolerance=BACKTEST_GATE_TOLERANCE, days=BACKTEST_GATE_DAYS):
+    """
+    Cổng sau train cho GNN CURRENT: MAE mỗi bước dự báo <= persistence và <= version trước (+ tolerance).
+    Version trước = `baseline` (CURRENT trước lần publish, worker truyền vào) hoặc ghi trong metadata của CURRENT.
+    Tệ hơn version trước và `rollback` -> đưa CURRENT về đúng version đó. Trả về True nếu qua cổng.
+    """
+    from model_registry import ModelRegistry
+    registry = ModelRegistry('gnn')
+    current = registry.current_version()
+    if current is None:
+        print("⏩ Registry chưa có version GNN nào, bỏ qua cổng backtest.")
+        return True
+    step_minutes = int(parse_interval(GNN_GRID_FREQ).total_seconds() // 60)
+    station_ids = [p['id'] for p in HCMC_GRID]
+    _, result = run_gnn(engine, registry, current, days, horizons, backend)
+    print_report(f"ST_GNN {current}", result, station_ids, step_minutes)
+    mae = result['model']['mae_by_horizon']
+
+    failures = []
+    limit = result['persistence']['mae_by_horizon'] * (1 + tolerance)
+    if np.any(mae > limit):
+        failures.append("tệ hơn persistence")
+    previous = predecessor(registry, current)
+    if baseline is not None and baseline != previous:
+        # CURRENT không phải version vừa publish từ baseline (đã đổi giữa chừng) -> không so sánh / rollback chéo
+        print(f"⚠️ CURRENT {current} không được publish từ {baseline} (ghi nhận: {previous}), bỏ qua so sánh.")
+        previous = None
+    regressed = False
+    if previous is not None and previous != current:
+        try:
+            _, previous_result = run_gnn(engine, registry, previous, days, horizons, backend)
+        except Exception as e:
+            print(f"⚠️ Không đánh giá được version trước {previous}: {e}")
+        else:
+            print_report(f"ST_GNN {previous} (version trước)", previous_result, station_ids, step_minutes)
+            regressed = bool(np.any(mae > previous_result['model']['mae_by_horizon'] * (1 + tolerance)))
+            if regressed:
+                failures.append(f"tệ hơn version trước {previous}")
+
+    if not failures:
+        print(f"✅ Cổng backtest: {current} qua (ngưỡng +{tolerance:.0%}).")
+        return True
+    print(f"❌ Cổng backtest: {current} {', '.join(failures)} (ngưỡng +{tolerance:.0%}).")
+    # Chỉ quay về version trước khi nó thực sự tốt hơn (tệ hơn persistence thôi thì version trước cũng chưa chắc tốt hơn)
+    if rollback and regressed:
+        registry.set_current(previous)
+        print(f"↩️ Đã đưa CURRENT về {previous}.")
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest rolling-origin LSTM / ST_GNN / persistence trên lịch sử quan trắc")
+    parser.add_argument('--days', type=float, help="Chỉ phát lại N ngày gần nhất (mặc định: toàn bộ lịch sử)")
+    parser.add_argument('--horizons', type=int, default=BACKTEST_HORIZONS, help="Số bước dự báo (bucket của từng model)")
+    parser.add_argument('--backend', default='eager', help="Backend của GNN: eager | lite | int8")
+    parser.add_argument('--skip-lstm', action='store_true')
+    parser.add_argument('--skip-gnn', action='store_true')
+    parser.add_argument('--output', help="Ghi kết quả ra file JSON")
+    parser.add_argument('--gate', action='store_true', help="Chế độ cổng sau train (exit code 1 nếu GNN CURRENT không qua)")
+    parser.add_argument('--rollback', action='store_true', help="Cùng --gate: không qua thì đưa CURRENT về version trước")
+    parser.add_argument('--baseline-version', help="Cùng --gate: version CURRENT trước lần publish vừa rồi")
+    args = parser.parse_args()
+
+    from predict_gnn import get_db_engine
+    engine, _ = get_db_engine()
+    if args.gate:
+        return 0 if gate(engine, args.horizons, args.backend, args.rollback, args.baseline_version) else 1
+
+    report = {'created_at': datetime.now(timezone.utc).isoformat(), 'horizons': args.horizons}
+    if not args.skip_lstm:
+        lstm = run_lstm(engine, args.days, args.horizons)
+        if lstm is None:
+            print("⏩ Chưa có model LSTM nào (Cần chạy train_model.py).")
+        else:
+            station_ids, result = lstm
+            step_minutes = int(parse_interval(LSTM_GRID_FREQ).total_seconds() // 60)
+            print_report("LSTM từng trạm", result, station_ids, step_minutes)
+            report['lstm'] = to_json(result, station_ids, step_minutes)
+    if not args.skip_gnn:
+        from model_registry import ModelRegistry
+        version, result = run_gnn(engine, ModelRegistry('gnn'), None, args.days, args.horizons, args.backend)
+        step_minutes = int(parse_interval(GNN_GRID_FREQ).total_seconds() // 60)
+        print_report(f"ST_GNN {version}", result, [p['id'] for p in HCMC_GRID], step_minutes)
+        report['gnn'] = dict(to_json(result, [p['id'] for p in HCMC_GRID], step_minutes), version=version)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmark từng bước của pipeline AI (predict_gnn + train_gnn) trên dữ liệu tổng hợp, chạy offline:
+#   - DB: SQLite tạm (cùng schema air_quality_observations)
+#   - Orion: fake_orion.FakeOrion chạy trong thread
+# Kết quả (p50/p95/p99, throughput, bộ nhớ đỉnh) ghi ra JSON và so với baseline:
+#   python benchmark.py --update-baseline      # ghi baseline mới
+#   python benchmark.py                        # so sánh, exit code 1 nếu có bước chậm hơn ngưỡng (2 nếu thiếu baseline)
+# Baseline tham chiếu (benchmarks/baseline.json) được commit cùng repo, cập nhật khi thay đổi hiệu năng có chủ đích.
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import warnings
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from sqlalchemy import create_engine
+from sklearn.preprocessing import MinMaxScaler
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, 'benchmarks', 'baseline.json')
+# Chậm hơn baseline quá 25% (và quá 0.5ms tuyệt đối, tránh nhiễu ở bước rất nhanh) -> fail
+DEFAULT_THRESHOLD = 0.25
+ABSOLUTE_SLACK_MS = 0.5
+
+def make_synthetic_db(path, stations, history, step_minutes=15, seed=42):
+    """Tạo SQLite với `history` bản ghi / trạm (chu kỳ ngày + nhiễu), trả về SQLAlchemy engine."""
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE air_quality_observations (time TIMESTAMP, entity_id TEXT, pm2_5 REAL, PRIMARY KEY (time, entity_id))")
+    start = datetime(2025, 1, 1)
+    times = [(start + timedelta(minutes=step_minutes * i)).strftime('%Y-%m-%d %H:%M:%S.%f') for i in range(history)]
+    daily = 10 * np.sin(np.arange(history) * step_minutes / 1440 * 2 * np.pi)
+    for k, station in enumerate(stations):
+        values = 30 + daily + k + rng.normal(0, 3, history)
+        entity_id = f"urn:ngsi-ld:AirQualityStation:OWM-{station['id']}"
+        conn.executemany(
+            "INSERT INTO air_quality_observations VALUES (?, ?, ?)",
+            zip(times, [entity_id] * history, values.tolist())
+        )
+    conn.commit()
+    conn.close()
+    return create_engine(f"sqlite:///{path}")
+
+def measure(name, fn, repeat, warmup=2, items=1):
+    """Chạy fn() `repeat` lần, trả về thống kê latency (ms), throughput (items/s) và bộ nhớ Python đỉnh."""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    result = {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+        'throughput_per_s': float(items * 1000 / latencies.mean()),
+        'peak_python_mem_kb': round(peak / 1024, 1),
+        'repeat': repeat,
+    }
+    print(f"   {name:<14} p50={result['p50_ms']:8.2f}ms  p95={result['p95_ms']:8.2f}ms  "
+          f"{result['throughput_per_s']:10.1f}/s  mem={result['peak_python_mem_kb']:.0f}KB")
+    return result
+
+def bench_predict(engine, orion_url, repeat, backend='auto'):
+    from predict_gnn import GNNPredictor, sync_to_orion
+    from model_registry import ModelRegistry
+
+    # Registry rỗng -> predictor dùng artifact legacy cạnh script (không đụng registry thật)
+    registry = ModelRegistry('gnn', root=tempfile.mkdtemp(prefix='bench-registry-'))
+    predictor = GNNPredictor(registry=registry, engine=engine, orion_url=orion_url, backend=backend)
+    bundle = predictor.bundle
+
+    raw_data, last_time = predictor.fetch()
+    input_tensor = predictor.preprocess(bundle, raw_data)
+    out = predictor.forward(bundle, input_tensor)
+    pred_actual = predictor.inverse_scale(bundle, out)
+    entities = predictor.build_entities(pred_actual, last_time)
+    nodes = raw_data.shape[0]
+
+    results = {
+        'fetch': measure('fetch', predictor.fetch, repeat, items=nodes),
+        'scale': measure('scale', lambda: predictor.preprocess(bundle, raw_data), repeat, items=nodes),
+        'forward': measure('forward', lambda: predictor.forward(bundle, input_tensor), repeat, items=nodes),
+        'inverse': measure('inverse', lambda: predictor.inverse_scale(bundle, out), repeat, items=nodes),
+    }
+    # Tắt log của sync để không làm nhiễu số đo
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results['sync'] = measure('sync', lambda: sync_to_orion(predictor.orion, entities), repeat, items=len(entities))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    sync = results['sync']
+    print(f"   {'sync':<14} p50={sync['p50_ms']:8.2f}ms  p95={sync['p95_ms']:8.2f}ms  "
+          f"{sync['throughput_per_s']:10.1f}/s  ({len(entities)} entity/lần)")
+    return results
+
+def bench_train(engine, repeat):
+    import train_gnn
+    from gnn_model import ST_GNN
+    from obs_cache import ObservationCache
+
+    def load():
+        # Cache lạnh mỗi lần đo: tải + gom bucket toàn bộ lịch sử
+        cache_dir = tempfile.mkdtemp(prefix='bench-cache-')
+        try:
+            entity_ids = [f"urn:ngsi-ld:AirQualityStation:OWM-{point['id']}" for point in train_gnn.HCMC_GRID]
+            ObservationCache(engine, train_gnn.GNN_GRID_FREQ, cache_dir).load_grid(entity_ids)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    results = {'train_load': measure('train_load', load, max(3, repeat // 10), warmup=1)}
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        _, raw_data = train_gnn.load_data_from_db(engine)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    data_scaled = MinMaxScaler().fit_transform(raw_data)
+    X, y = train_gnn.create_sequences(data_scaled, train_gnn.SEQ_LENGTH)
+    X_tensor = torch.tensor(X[..., np.newaxis], dtype=torch.float32)
+    y_tensor = torch.tensor(y, dtype=torch.float32)
+    edge_index, edge_weight = torch.load(os.path.join(BASE_DIR, 'graph_structure.pt'))
+
+    model = ST_GNN(num_nodes=train_gnn.NUM_NODES, input_dim=1, hidden_dim=16, output_dim=1).set_graph(edge_index, edge_weight)
+    optimizer = optim.Adam(model.parameters(), lr=train_gnn.LEARNING_RATE)
+    criterion = nn.MSELoss()
+    results['train_epoch'] = measure(
+        'train_epoch',
+        lambda: train_gnn.train_epoch(model, optimizer, criterion, X_tensor, y_tensor, train_gnn.BATCH_SIZE),
+        max(3, repeat // 10), warmup=1, items=len(X_tensor)
+    )
+    return results
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for stage, current in results['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            continue
+        limit = max(base['p50_ms'] * (1 + threshold), base['p50_ms'] + ABSOLUTE_SLACK_MS)
+        change = (current['p50_ms'] / base['p50_ms'] - 1) * 100 if base['p50_ms'] else 0.0
+        status = '❌' if current['p50_ms'] > limit else '✅'
+        print(f"   {status} {stage:<14} {base['p50_ms']:8.2f}ms -> {current['p50_ms']:8.2f}ms ({change:+.1f}%)")
+        if current['p50_ms'] > limit:
+            regressions.append(stage)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark từng bước pipeline AI với dữ liệu tổng hợp")
+    parser.add_argument('--repeat', type=int, default=50, help="Số lần đo mỗi bước dự báo")
+    parser.add_argument('--history', type=int, default=2000, help="Số bản ghi 15 phút / trạm trong DB tổng hợp")
+    parser.add_argument('--orion-latency-ms', type=float, default=0)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--output', help="Ghi kết quả lần chạy này ra file JSON")
+    parser.add_argument('--skip-train', action='store_true')
+    parser.add_argument('--backend', default='auto', help="Backend của predictor: auto | eager | torchscript | onnx")
+    args = parser.parse_args()
+    if not args.update_baseline and not os.path.exists(args.baseline):
+        # Không có baseline thì cổng không so được gì -> lỗi, không tự ghi baseline mới rồi báo qua
+        print(f"❌ Không có baseline {args.baseline}. Chạy với --update-baseline để tạo.")
+        return 2
+
+    # Cố định số thread để số đo ổn định giữa các lần chạy
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    # Scaler fit bằng DataFrame nhưng predict dùng numpy -> sklearn cảnh báo mỗi lần gọi
+    warnings.filterwarnings('ignore', message='X does not have valid feature names')
+
+    from stations import HCMC_GRID
+    from fake_orion import FakeOrion
+
+    work_dir = tempfile.mkdtemp(prefix='ai-bench-')
+    fake_orion = FakeOrion(latency_ms=args.orion_latency_ms).start()
+    try:
+        engine = make_synthetic_db(os.path.join(work_dir, 'bench.db'), HCMC_GRID, args.history)
+        print(f"🧪 Benchmark: {len(HCMC_GRID)} trạm x {args.history} bản ghi, repeat={args.repeat}")
+        stages = bench_predict(engine, fake_orion.url, args.repeat, args.backend)
+        if not args.skip_train:
+            stages.update(bench_train(engine, args.repeat))
+    finally:
+        fake_orion.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'created_at': datetime.now().isoformat(),
+        'machine': {'python': platform.python_version(), 'torch': torch.__version__,
+                    'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'params': {'stations': len(HCMC_GRID), 'history': args.history, 'repeat': args.repeat, 'backend': args.backend},
+        'stages': stages,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Đã ghi baseline: {args.baseline}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print(f"📏 So với baseline {baseline.get('created_at')} (ngưỡng +{args.threshold:.0%}):")
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"❌ Chậm hơn baseline: {', '.join(regressions)}")
+        return 1
+    print("✅ Không có bước nào chậm hơn ngưỡng.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
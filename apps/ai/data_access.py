@@ -0,0 +1,270 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Đọc chuỗi PM2.5 đã gom theo bucket thời gian (lưới chung cho train và predict).
+# Postgres làm phần nặng ngay cạnh dữ liệu: date_bin gom bucket + AVG, generate_series dựng lưới đều,
+# window function nội suy tuyến tính khoảng trống -> chỉ trả về (Bucket x Trạm) dòng thay cho toàn bộ bản ghi thô.
+# Quy ước giống pandas resample().mean().interpolate(): trước bản ghi đầu tiên để trống (NaN),
+# giữa 2 bucket có dữ liệu nội suy tuyến tính, sau bucket cuối giữ giá trị cuối.
+# DB khác Postgres (SQLite của benchmark) chạy cùng logic bằng NumPy.
+
+import os
+import re
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text, bindparam
+
+# Mốc gốc của lưới bucket (date_bin), giữ cố định để bucket của train và predict trùng nhau
+GRID_ORIGIN = datetime(2000, 1, 1, tzinfo=timezone.utc)
+# Tần suất bucket của từng model (train và predict đọc cùng 1 hằng số)
+GNN_GRID_FREQ = os.getenv('GNN_GRID_FREQ', '1h')
+LSTM_GRID_FREQ = os.getenv('LSTM_GRID_FREQ', '15min')
+# Số bucket lấy thêm phía trước khi chỉ cần N bucket cuối (làm mốc nội suy cho khoảng trống đầu cửa sổ)
+GRID_LEAD_BUCKETS = int(os.getenv('GRID_LEAD_BUCKETS', '8'))
+
+_INTERVAL_UNITS = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400}
+
+def parse_interval(freq):
+    """'15min' / '1h' / '1d' / '30s' -> timedelta (cùng cách viết tần suất như pandas)."""
+    match = re.fullmatch(r'\s*(\d*)\s*(s|min|h|d)\s*', freq.lower())
+    if not match:
+        raise ValueError(f"Tần suất không hợp lệ: {freq} (vd '15min', '1h')")
+    return timedelta(seconds=int(match.group(1) or 1) * _INTERVAL_UNITS[match.group(2)])
+
+def _sql_interval(step):
+    return f"{int(step.total_seconds())} seconds"
+
+# Trung bình theo bucket (chưa lấp khoảng trống) kể từ :since, kèm bản ghi thô mới nhất của bucket
+BUCKET_QUERY = text("""
+    SELECT entity_id,
+           date_bin(CAST(:step AS interval), time, :origin) AS bucket,
+           AVG(pm2_5) AS pm2_5,
+           MAX(time) AS last_time
+    FROM air_quality_observations
+    WHERE entity_id IN :entity_ids AND pm2_5 IS NOT NULL
+      AND (CAST(:since AS timestamptz) IS NULL OR time >= :since)
+    GROUP BY 1, 2
+    ORDER BY 2
+""").bindparams(bindparam('entity_ids', expanding=True))
+
+# Lưới đều (generate_series) x trạm, đã nội suy khoảng trống.
+# grp_prev / grp_next: số bucket có dữ liệu tính đến dòng hiện tại theo 2 chiều -> các dòng trống nằm cùng nhóm
+# với bucket có dữ liệu ngay trước / ngay sau, FIRST_VALUE trong nhóm cho ra 2 điểm neo để nội suy.
+GRID_QUERY = text("""
+    WITH bounds AS (
+        SELECT date_bin(CAST(:step AS interval), MIN(time), :origin) AS first_bucket,
+               date_bin(CAST(:step AS interval), MAX(time), :origin) AS last_bucket,
+               MAX(time) AS last_time
+        FROM air_quality_observations
+        WHERE entity_id IN :entity_ids AND pm2_5 IS NOT NULL
+    ),
+    grid AS (
+        SELECT generate_series(
+                   CASE WHEN CAST(:max_buckets AS integer) IS NULL THEN first_bucket
+                        ELSE GREATEST(first_bucket, last_bucket - CAST(:step AS interval) * (CAST(:max_buckets AS integer) - 1))
+                   END,
+                   last_bucket, CAST(:step AS interval)) AS bucket
+        FROM bounds
+    ),
+    buckets AS (
+        SELECT entity_id, date_bin(CAST(:step AS interval), time, :origin) AS bucket, AVG(pm2_5) AS pm2_5
+        FROM air_quality_observations
+        WHERE entity_id IN :entity_ids AND pm2_5 IS NOT NULL AND time >= (SELECT MIN(bucket) FROM grid)
+        GROUP BY 1, 2
+    ),
+    dense AS (
+        SELECT s.entity_id, g.bucket, b.pm2_5,
+               COUNT(b.pm2_5) OVER (PARTITION BY s.entity_id ORDER BY g.bucket) AS grp_prev,
+               COUNT(b.pm2_5) OVER (PARTITION BY s.entity_id ORDER BY g.bucket DESC) AS grp_next
+        FROM (SELECT DISTINCT entity_id FROM buckets) s
+        CROSS JOIN grid g
+        LEFT JOIN buckets b ON b.entity_id = s.entity_id AND b.bucket = g.bucket
+    ),
+    anchored AS (
+        SELECT entity_id, bucket, pm2_5,
+               FIRST_VALUE(pm2_5) OVER (PARTITION BY entity_id, grp_prev ORDER BY bucket) AS prev_value,
+               FIRST_VALUE(bucket) OVER (PARTITION BY entity_id, grp_prev ORDER BY bucket) AS prev_bucket,
+               FIRST_VALUE(pm2_5) OVER (PARTITION BY entity_id, grp_next ORDER BY bucket DESC) AS next_value,
+               FIRST_VALUE(bucket) OVER (PARTITION BY entity_id, grp_next ORDER BY bucket DESC) AS next_bucket
+        FROM dense
+    )
+    SELECT entity_id, bucket,
+           CASE
+               WHEN pm2_5 IS NOT NULL THEN pm2_5
+               WHEN prev_value IS NULL THEN NULL
+               WHEN next_value IS NULL THEN prev_value
+               ELSE prev_value + (next_value - prev_value)
+                    * EXTRACT(EPOCH FROM bucket - prev_bucket) / EXTRACT(EPOCH FROM next_bucket - prev_bucket)
+           END AS pm2_5,
+           (SELECT last_time FROM bounds) AS last_time
+    FROM anchored
+    ORDER BY bucket, entity_id
+""").bindparams(bindparam('entity_ids', expanding=True))
+
+# Bản ghi thô cho DB không có date_bin (SQLite) -> gom bucket bằng NumPy
+RAW_QUERY = text("""
+    SELECT entity_id, time, pm2_5
+    FROM air_quality_observations
+    WHERE entity_id IN :entity_ids AND pm2_5 IS NOT NULL AND time >= :since
+""").bindparams(bindparam('entity_ids', expanding=True))
+
+def _is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
+
+def to_datetime64(values):
+    """datetime (có/không tz) hoặc chuỗi ISO -> ndarray datetime64[ns] theo UTC (naive)."""
+    values = list(values)
+    if not values:
+        return np.array([], dtype='datetime64[ns]')
+    if isinstance(values[0], str) or getattr(values[0], 'tzinfo', None) is None:
+        # Chuỗi ISO / datetime không tz: NumPy chuyển cả mảng 1 lần
+        return np.array(values, dtype='datetime64[ns]')
+    return np.array([v.astimezone(timezone.utc).replace(tzinfo=None) for v in values], dtype='datetime64[ns]')
+
+def _bucket_start(times_ns, step):
+    # Giống date_bin(step, time, GRID_ORIGIN)
+    origin = np.datetime64(GRID_ORIGIN.replace(tzinfo=None), 'ns').astype(np.int64)
+    step_ns = int(step.total_seconds()) * 10**9
+    return origin + (times_ns - origin) // step_ns * step_ns
+
+def fill_gaps(values, hold_last=True):
+    """
+    Nội suy tuyến tính theo trục thời gian (axis 0) từng cột, cùng quy ước với GRID_QUERY. Trả về mảng mới.
+    hold_last=False: phần sau bucket có dữ liệu cuối cùng của trạm để NaN (dữ liệu train không chứa giá trị kéo dài).
+    """
+    values = np.array(values, dtype=np.float64)
+    positions = np.arange(values.shape[0])
+    for column in values.T:
+        known = ~np.isnan(column)
+        if not known.any() or known.all():
+            continue
+        first = np.argmax(known)
+        last = len(known) if hold_last else len(known) - np.argmax(known[::-1])
+        # np.interp giữ giá trị cuối cho phần sau điểm cuối; phần trước điểm đầu để NaN
+        column[first:last] = np.interp(positions[first:last], positions[known], column[known])
+    return values
+
+def fetch_bucket_means(engine, entity_ids, freq, since=None):
+    """
+    Trung bình theo bucket của từng trạm, chưa lấp khoảng trống.
+    Trả về dict entity_id -> (bucket datetime64[ns] tăng dần, giá trị, bản ghi thô mới nhất của từng bucket).
+    """
+    step = parse_interval(freq)
+    entity_ids = list(entity_ids)
+    with engine.connect() as conn:
+        if _is_postgres(engine):
+            rows = conn.execute(BUCKET_QUERY, {
+                'entity_ids': entity_ids, 'step': _sql_interval(step), 'origin': GRID_ORIGIN, 'since': since,
+            }).fetchall()
+            return _group_rows(rows)
+        if since is None:
+            since = datetime.min
+        elif since.tzinfo is not None:
+            # SQLite lưu time dạng chuỗi UTC không kèm tz
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        rows = conn.execute(RAW_QUERY, {'entity_ids': entity_ids, 'since': since}).fetchall()
+    return _bucket_raw_rows(rows, step)
+
+def _split_by_station(entity_ids, buckets, columns):
+    # Gom theo (trạm, bucket) đã sắp xếp -> dict entity_id -> (bucket, *columns) cho từng trạm
+    names, codes = np.unique(np.array(entity_ids, dtype=object), return_inverse=True)
+    order = np.lexsort((buckets, codes))
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    result = {}
+    for name, idx in zip(names, np.split(order, bounds)):
+        result[name] = (buckets[idx],) + tuple(column[idx] for column in columns)
+    return result
+
+def _group_rows(rows):
+    if not rows:
+        return {}
+    entity_ids, buckets, values, last_times = zip(*rows)
+    return _split_by_station(
+        entity_ids, to_datetime64(buckets), (np.array(values, dtype=np.float64), to_datetime64(last_times)))
+
+def _bucket_raw_rows(rows, step):
+    if not rows:
+        return {}
+    entity_ids, times, values = zip(*rows)
+    names, codes = np.unique(np.array(entity_ids, dtype=object), return_inverse=True)
+    times = to_datetime64(times).astype(np.int64)
+    buckets = _bucket_start(times, step)
+    # Mỗi nhóm (trạm, bucket) -> AVG và MAX(time) như BUCKET_QUERY
+    keys, inverse = np.unique(np.stack([codes, buckets], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    means = np.bincount(inverse, weights=np.array(values, dtype=np.float64)) / np.bincount(inverse)
+    last_times = np.full(len(keys), np.iinfo(np.int64).min)
+    np.maximum.at(last_times, inverse, times)
+    return _split_by_station(
+        names[keys[:, 0]], keys[:, 1].astype('datetime64[ns]'), (means, last_times.astype('datetime64[ns]')))
+
+def to_grid(series, entity_ids, freq, start=None, end=None):
+    """
+    Dựng lưới đều (Bucket x Trạm) từ kết quả fetch_bucket_means (chưa lấp khoảng trống, NaN = không có dữ liệu).
+    Trả về (bucket datetime64[ns] [T], values [T, N]).
+    """
+    step_ns = int(parse_interval(freq).total_seconds()) * 10**9
+    present = [series[e][0] for e in entity_ids if e in series and len(series[e][0])]
+    if not present:
+        return np.array([], dtype='datetime64[ns]'), np.full((0, len(entity_ids)), np.nan)
+    first = np.datetime64(start, 'ns') if start is not None else min(b[0] for b in present)
+    last = np.datetime64(end, 'ns') if end is not None else max(b[-1] for b in present)
+    times = np.arange(first.astype(np.int64), last.astype(np.int64) + 1, step_ns).astype('datetime64[ns]')
+    values = np.full((len(times), len(entity_ids)), np.nan)
+    for j, entity_id in enumerate(entity_ids):
+        if entity_id not in series:
+            continue
+        buckets, means = series[entity_id][:2]
+        rows = (buckets.astype(np.int64) - times[0].astype(np.int64)) // step_ns
+        inside = (rows >= 0) & (rows < len(times))
+        values[rows[inside], j] = means[inside]
+    return times, values
+
+def load_grid(engine, entity_ids, freq, last_buckets=None):
+    """
+    Lưới đều đã nội suy của mọi trạm trong 1 truy vấn: (bucket datetime64[ns] [T], values [T, N], bản ghi thô mới nhất).
+    last_buckets: chỉ lấy N bucket cuối (nội suy vẫn dùng GRID_LEAD_BUCKETS bucket trước đó làm mốc).
+    Trạm không có dữ liệu -> cột NaN.
+    """
+    step = parse_interval(freq)
+    entity_ids = list(entity_ids)
+    max_buckets = last_buckets + GRID_LEAD_BUCKETS if last_buckets else None
+
+    if _is_postgres(engine):
+        with engine.connect() as conn:
+            rows = conn.execute(GRID_QUERY, {
+                'entity_ids': entity_ids, 'step': _sql_interval(step), 'origin': GRID_ORIGIN, 'max_buckets': max_buckets,
+            }).fetchall()
+        if not rows:
+            return np.array([], dtype='datetime64[ns]'), np.full((0, len(entity_ids)), np.nan), None
+        node_index = {entity_id: j for j, entity_id in enumerate(entity_ids)}
+        buckets = to_datetime64(r[1] for r in rows)
+        times = np.unique(buckets)
+        values = np.full((len(times), len(entity_ids)), np.nan)
+        cols = np.fromiter((node_index[r[0]] for r in rows), dtype=np.int64, count=len(rows))
+        values[np.searchsorted(times, buckets), cols] = np.array([r[2] for r in rows], dtype=np.float64)
+        last_time = to_datetime64([rows[0][3]])[0]
+    else:
+        series = fetch_bucket_means(engine, entity_ids, freq)
+        times, values = to_grid(series, entity_ids, freq)
+        if max_buckets:
+            times, values = times[-max_buckets:], values[-max_buckets:]
+        values = fill_gaps(values)
+        last_time = max((s[2][-1] for s in series.values()), default=None)
+
+    if last_buckets:
+        times, values = times[-last_buckets:], values[-last_buckets:]
+    return times, values, last_time
@@ -0,0 +1,195 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Export ST_GNN đã train + đồ thị cố định thành artifact biên dịch sẵn cho predictor:
+#   gnn_model.ts.pt   TorchScript (chạy bằng torch.jit.load, không cần torch_geometric)
+#   gnn_model.onnx    ONNX (chạy bằng onnxruntime CPU, cần gói onnx lúc export)
+#   gnn_model.npz     trọng số + Â cho engine NumPy (chế độ lite, không cần torch - xem numpy_engine.py)
+# Đồ thị không đổi giữa các lần dự báo nên export dùng chế độ đồ thị tĩnh của ST_GNN (Â dense gắn sẵn,
+# xem gnn_model.gcn_norm_adjacency) thay cho GCNConv.
+#   python export_model.py                    # export version CURRENT trong registry (hoặc artifact legacy)
+#   python export_model.py --check            # chỉ kiểm tra parity artifact đã có với model eager
+
+import os
+import copy
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from numpy_engine import LITE_GNN_FILE, LITE_SCALER_FILE, save_gnn_npz, save_scaler_npz, load_gnn_npz
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TORCHSCRIPT_FILE = 'gnn_model.ts.pt'
+ONNX_FILE = 'gnn_model.onnx'
+EXPORT_FORMATS = [f for f in os.getenv('GNN_EXPORT_FORMATS', 'torchscript,onnx,lite').split(',') if f]
+# Sai số tối đa (trên dữ liệu đã scale 0..1) giữa artifact và model eager
+PARITY_ATOL = float(os.getenv('GNN_PARITY_ATOL', '1e-5'))
+
+class StaticGraphGNN(nn.Module):
+    """ST_GNN với đồ thị cố định gắn sẵn bên trong: forward(x [B*N, Seq, F]) -> [B*N, Horizons]."""
+
+    def __init__(self, model, edge_index, edge_weight):
+        super(StaticGraphGNN, self).__init__()
+        # Bản sao ở chế độ đồ thị tĩnh, Â dense (ONNX không hỗ trợ sparse CSR)
+        self.model = copy.deepcopy(model).set_graph(edge_index, edge_weight, dense=True).eval()
+        # Lưu số bước dự báo trong artifact (freeze xóa submodule fc nên không đọc được từ trọng số)
+        self.register_buffer('horizons', torch.tensor(model.fc.out_features))
+
+    def forward(self, x):
+        return self.model(x)
+
+def export_torchscript(static_model, example, path):
+    traced = torch.jit.trace(static_model, (example,))
+    traced = torch.jit.freeze(traced.eval(), preserved_attrs=['horizons'])
+    tmp_path = path + '.tmp'
+    torch.jit.save(traced, tmp_path)
+    os.replace(tmp_path, path)
+
+def export_onnx(static_model, example, path):
+    tmp_path = path + '.tmp'
+    torch.onnx.export(
+        static_model, (example,), tmp_path,
+        input_names=['x'], output_names=['y'],
+        dynamic_axes={'x': {0: 'nodes'}, 'y': {0: 'nodes'}},
+        dynamo=False
+    )
+    os.replace(tmp_path, path)
+
+def export_lite(static_model, example, path):
+    from gnn_model import GCN_DENSE_MAX_NODES
+    # Đồ thị lớn lưu Â dạng CSR để engine NumPy không phải nhân ma trận dense N x N
+    save_gnn_npz(path, static_model.model, dense_max_nodes=GCN_DENSE_MAX_NODES)
+
+class TorchScriptRunner:
+    """Chạy artifact TorchScript: Tensor [N, Seq, 1] -> Tensor [N, Horizons]."""
+
+    def __init__(self, path):
+        self.module = torch.jit.load(path)
+        self.module.eval()
+        self.horizons = int(self.module.horizons)
+
+    def __call__(self, x):
+        # x: ndarray float32 (dùng chung bộ nhớ, không copy) -> ndarray
+        with torch.no_grad():
+            return self.module(torch.from_numpy(x)).numpy()
+
+class OnnxRunner:
+    """Chạy artifact ONNX bằng onnxruntime (CPU), cùng giao diện với TorchScriptRunner."""
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.horizons = self.session.get_outputs()[0].shape[-1]
+
+    def __call__(self, x):
+        return self.session.run(None, {self.input_name: np.asarray(x, dtype=np.float32)})[0]
+
+def load_runner(artifact_dir, backend):
+    if backend == 'torchscript':
+        return TorchScriptRunner(os.path.join(artifact_dir, TORCHSCRIPT_FILE))
+    if backend == 'onnx':
+        return OnnxRunner(os.path.join(artifact_dir, ONNX_FILE), num_threads=torch.get_num_threads())
+    if backend == 'lite':
+        return load_gnn_npz(os.path.join(artifact_dir, LITE_GNN_FILE))
+    raise ValueError(f"GNN backend không hợp lệ: {backend} (eager | torchscript | onnx | lite)")
+
+def check_parity(model, edge_index, edge_weight, runner, seq_length=4, batches=8, seed=0):
+    """Trả về sai số tuyệt đối lớn nhất giữa runner và model eager trên input ngẫu nhiên 0..1."""
+    generator = torch.Generator().manual_seed(seed)
+    max_diff = 0.0
+    model.eval()
+    with torch.no_grad():
+        for _ in range(batches):
+            x = torch.rand(model.num_nodes, seq_length, model.lstm.input_size, generator=generator)
+            # Tham chiếu: GCNConv của torch_geometric (truyền edge_index -> không dùng Â đã cache)
+            expected = model(x, edge_index, edge_weight)
+            max_diff = max(max_diff, float(np.abs(runner(x.numpy()) - expected.numpy()).max()))
+    return max_diff
+
+def export_artifacts(model, edge_index, edge_weight, out_dir, formats=EXPORT_FORMATS, seq_length=4, atol=PARITY_ATOL):
+    """
+    Export các định dạng trong `formats` vào out_dir. Artifact nào lệch model eager quá atol
+    (hoặc thiếu thư viện export) thì bị xóa -> predictor tự quay về eager. Trả về list file đã giữ.
+    """
+    model.eval()
+    static_model = StaticGraphGNN(model, edge_index, edge_weight).eval()
+    example = torch.rand(model.num_nodes, seq_length, model.lstm.input_size)
+    exporters = {
+        'torchscript': (TORCHSCRIPT_FILE, export_torchscript),
+        'onnx': (ONNX_FILE, export_onnx),
+        'lite': (LITE_GNN_FILE, export_lite),
+    }
+    kept = []
+    for backend in formats:
+        file_name, exporter = exporters[backend]
+        path = os.path.join(out_dir, file_name)
+        try:
+            exporter(static_model, example, path)
+            diff = check_parity(model, edge_index, edge_weight, load_runner(out_dir, backend), seq_length)
+        except Exception as e:
+            print(f"⚠️ Bỏ qua export {backend}: {e}")
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        if diff > atol:
+            print(f"❌ Parity {backend} không đạt: max |diff| = {diff:.2e} > {atol:.0e}, bỏ artifact")
+            os.remove(path)
+            continue
+        print(f"✅ Export {backend}: {file_name} (max |diff| với eager = {diff:.2e})")
+        kept.append(file_name)
+    return kept
+
+def main():
+    parser = argparse.ArgumentParser(description="Export ST_GNN sang TorchScript / ONNX")
+    parser.add_argument('--version', help="Version trong registry (mặc định CURRENT)")
+    parser.add_argument('--formats', default=','.join(EXPORT_FORMATS))
+    parser.add_argument('--output', help="Thư mục ghi artifact (mặc định thư mục của version)")
+    parser.add_argument('--check', action='store_true', help="Chỉ kiểm tra parity các artifact đã có")
+    args = parser.parse_args()
+
+    from predict_gnn import load_gnn_bundle, SEQ_LENGTH
+    from model_registry import ModelRegistry
+    registry = ModelRegistry('gnn')
+    bundle = load_gnn_bundle(registry, args.version, backend='eager')
+    artifact_dir = BASE_DIR if bundle.version == 'legacy' else registry.version_dir(bundle.version)
+    formats = [f for f in args.formats.split(',') if f]
+
+    if args.check:
+        failed = False
+        for backend in formats:
+            diff = check_parity(bundle.model, bundle.edge_index, bundle.edge_weight,
+                                load_runner(artifact_dir, backend), SEQ_LENGTH)
+            ok = diff <= PARITY_ATOL
+            failed |= not ok
+            print(f"{'✅' if ok else '❌'} Parity {backend}: max |diff| = {diff:.2e}")
+        raise SystemExit(1 if failed else 0)
+
+    # Version trong registry là bất biến (checksum trong manifest) -> mặc định ghi ra thư mục riêng
+    out_dir = args.output or (BASE_DIR if bundle.version == 'legacy' else None)
+    if out_dir is None:
+        print("⚠️ Version trong registry không được sửa, hãy chỉ định --output (artifact mới được export lúc train_gnn.py).")
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    export_artifacts(bundle.model, bundle.edge_index, bundle.edge_weight, out_dir, formats, SEQ_LENGTH)
+    if 'lite' in formats:
+        save_scaler_npz(os.path.join(out_dir, LITE_SCALER_FILE), bundle.scaler)
+
+if __name__ == "__main__":
+    main()
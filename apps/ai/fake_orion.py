@@ -0,0 +1,168 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Orion-LD giả lập (in-memory) để test/benchmark đường sync mà không cần FIWARE thật.
+# Chạy độc lập: python fake_orion.py --port 1026  (rồi đặt ORION_LD_URL=http://localhost:1026)
+
+import json
+import time
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ENTITIES_PATH = '/ngsi-ld/v1/entities'
+UPSERT_PATH = '/ngsi-ld/v1/entityOperations/upsert'
+
+class FakeOrion:
+    """Server NGSI-LD tối giản: entities CRUD cơ bản + batch upsert, chạy trong thread nền."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0):
+        self.entities = {}
+        self.request_count = 0
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _store(self, entity, merge):
+        # Trả về True nếu entity được tạo mới
+        with self.lock:
+            existing = self.entities.get(entity['id'])
+            if existing is None or not merge:
+                self.entities[entity['id']] = dict(entity)
+                return existing is None
+            existing.update(entity)
+            return False
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body=None):
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                if payload:
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _read_json(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'null')
+
+            def _begin(self):
+                with fake.lock:
+                    fake.request_count += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                return urlparse(self.path)
+
+            def do_GET(self):
+                url = self._begin()
+                if url.path == ENTITIES_PATH:
+                    query = parse_qs(url.query)
+                    entity_type = query.get('type', [None])[0]
+                    limit = int(query.get('limit', ['20'])[0])
+                    with fake.lock:
+                        found = [e for e in fake.entities.values() if entity_type is None or e.get('type') == entity_type]
+                    return self._reply(200, found[:limit])
+                if url.path.startswith(ENTITIES_PATH + '/'):
+                    entity = fake.entities.get(url.path[len(ENTITIES_PATH) + 1:])
+                    return self._reply(200, entity) if entity else self._reply(404, {'title': 'Entity Not Found'})
+                self._reply(404, {'title': 'Not Found'})
+
+            def do_POST(self):
+                url = self._begin()
+                try:
+                    body = self._read_json()
+                except ValueError:
+                    return self._reply(400, {'title': 'Invalid JSON'})
+
+                if url.path == UPSERT_PATH:
+                    merge = 'update' in parse_qs(url.query).get('options', [''])[0]
+                    created, success, errors = [], [], []
+                    for entity in body if isinstance(body, list) else []:
+                        if not isinstance(entity, dict) or 'id' not in entity or 'type' not in entity:
+                            entity_id = entity.get('id') if isinstance(entity, dict) else None
+                            errors.append({'entityId': entity_id, 'error': {'title': 'Bad Request Data', 'detail': 'id/type missing'}})
+                            continue
+                        if fake._store(entity, merge):
+                            created.append(entity['id'])
+                        success.append(entity['id'])
+                    if errors:
+                        return self._reply(207, {'success': success, 'errors': errors})
+                    return self._reply(201, created) if created else self._reply(204)
+
+                if url.path == ENTITIES_PATH:
+                    if body.get('id') in fake.entities:
+                        return self._reply(409, {'title': 'Already Exists'})
+                    fake._store(body, merge=False)
+                    return self._reply(201)
+
+                if url.path.startswith(ENTITIES_PATH + '/') and url.path.endswith('/attrs'):
+                    entity_id = url.path[len(ENTITIES_PATH) + 1:-len('/attrs')]
+                    if entity_id not in fake.entities:
+                        return self._reply(404, {'title': 'Entity Not Found'})
+                    fake._store(dict(body, id=entity_id), merge=True)
+                    return self._reply(204)
+
+                self._reply(404, {'title': 'Not Found'})
+
+            def do_PATCH(self):
+                url = self._begin()
+                if url.path.startswith(ENTITIES_PATH + '/') and url.path.endswith('/attrs'):
+                    entity_id = url.path[len(ENTITIES_PATH) + 1:-len('/attrs')]
+                    if entity_id not in fake.entities:
+                        return self._reply(404, {'title': 'Entity Not Found'})
+                    fake._store(dict(self._read_json(), id=entity_id), merge=True)
+                    return self._reply(204)
+                self._reply(404, {'title': 'Not Found'})
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Orion-LD giả lập cho test/benchmark")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1026)
+    parser.add_argument('--latency-ms', type=float, default=0, help="Độ trễ giả lập cho mỗi request")
+    args = parser.parse_args()
+
+    fake = FakeOrion(args.host, args.port, args.latency_ms)
+    print(f"🧪 Fake Orion-LD đang chạy tại {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
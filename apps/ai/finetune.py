@@ -0,0 +1,207 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Fine-tune hằng đêm dùng chung cho train_gnn.py / train_model.py:
+#   - nightly: khởi tạo từ trọng số production (cùng scaler), chỉ train trên dữ liệu mới từ lần train trước
+#     + cửa sổ replay -> chi phí theo lượng dữ liệu mới, không theo độ dài lịch sử
+#   - full: train lại từ đầu trên toàn bộ lịch sử (lần đầu, model quá cũ / khác cấu hình, hoặc TRAIN_MODE=full)
+# Cả 2 chế độ dừng sớm theo loss trên phần validation (các mẫu mới nhất) và ghi checkpoint mỗi epoch
+# để lần chạy bị ngắt giữa chừng tiếp tục được từ epoch cuối.
+
+import os
+import copy
+import json
+import torch
+import numpy as np
+from datetime import datetime, timezone, timedelta
+
+# auto: nightly nếu có model production tương thích và chưa quá FULL_RETRAIN_DAYS ngày kể từ lần train full
+TRAIN_MODE = os.getenv('TRAIN_MODE', 'auto').lower()
+FULL_RETRAIN_DAYS = float(os.getenv('FULL_RETRAIN_DAYS', '7'))
+# Cửa sổ replay: dữ liệu cũ (trước lần train trước) train lại cùng dữ liệu mới, tránh quên
+FINETUNE_REPLAY_HOURS = float(os.getenv('FINETUNE_REPLAY_HOURS', '168'))
+FINETUNE_MAX_EPOCHS = int(os.getenv('FINETUNE_MAX_EPOCHS', '30'))
+# Learning rate lúc fine-tune = learning rate train full x hệ số này
+FINETUNE_LR_FACTOR = float(os.getenv('FINETUNE_LR_FACTOR', '0.2'))
+# Tỉ lệ mẫu cuối (mới nhất) giữ lại làm validation, cần tối thiểu VAL_MIN_SAMPLES mẫu mới dùng early stopping
+VAL_FRACTION = float(os.getenv('VAL_FRACTION', '0.1'))
+VAL_MIN_SAMPLES = int(os.getenv('VAL_MIN_SAMPLES', '4'))
+EARLY_STOP_PATIENCE = int(os.getenv('EARLY_STOP_PATIENCE', '10'))
+EARLY_STOP_MIN_DELTA = float(os.getenv('EARLY_STOP_MIN_DELTA', '1e-5'))
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKPOINT_DIR = os.getenv('TRAIN_CHECKPOINT_DIR') or os.path.join(BASE_DIR, 'checkpoints')
+
+def format_time(value):
+    """datetime64 (UTC naive) -> chuỗi ISO có tz, lưu trong metadata."""
+    return value.astype('datetime64[us]').item().replace(tzinfo=timezone.utc).isoformat()
+
+def parse_time(value):
+    """Chuỗi ISO (format_time) -> datetime64[ns] UTC naive."""
+    return np.datetime64(datetime.fromisoformat(value).astimezone(timezone.utc).replace(tzinfo=None), 'ns')
+
+def choose_mode(trained_at, compatible=True, now=None):
+    """'nightly' hoặc 'full' theo TRAIN_MODE và thời điểm train full gần nhất (ISO, None = chưa có model)."""
+    if TRAIN_MODE == 'full' or not trained_at or not compatible:
+        return 'full'
+    if TRAIN_MODE == 'nightly':
+        return 'nightly'
+    now = now or datetime.now(timezone.utc)
+    age = now - datetime.fromisoformat(trained_at)
+    return 'nightly' if age < timedelta(days=FULL_RETRAIN_DAYS) else 'full'
+
+def replay_start(times, data_end, seq_length, replay_hours=FINETUNE_REPLAY_HOURS):
+    """
+    Chỉ số dòng đầu tiên cần đọc để fine-tune: mẫu có target sau (data_end - replay) kèm seq_length mốc ngữ cảnh.
+    Trả về None nếu không có bucket nào mới hơn data_end.
+    """
+    if not len(times) or times[-1] <= data_end:
+        return None
+    replay = np.timedelta64(int(replay_hours * 3600), 's')
+    # Bucket cuối có thể chưa đủ dữ liệu lần trước -> luôn tính lại từ data_end
+    first_target = int(np.searchsorted(times, data_end - replay, side='left'))
+    return max(0, first_target - seq_length)
+
+def split_train_val(num_samples, fraction=VAL_FRACTION, min_samples=VAL_MIN_SAMPLES):
+    """Số mẫu train (theo thời gian: phần đầu train, phần cuối validation). Ít mẫu quá -> không tách."""
+    num_val = int(num_samples * fraction)
+    if num_val < min_samples or num_samples - num_val < min_samples:
+        return num_samples
+    return num_samples - num_val
+
+def finetune_lr(learning_rate, mode):
+    return learning_rate * FINETUNE_LR_FACTOR if mode == 'nightly' else learning_rate
+
+class EarlyStopping:
+    """Giữ trọng số có loss validation tốt nhất, báo dừng sau `patience` epoch không cải thiện."""
+
+    def __init__(self, patience=EARLY_STOP_PATIENCE, min_delta=EARLY_STOP_MIN_DELTA):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = float('inf')
+        self.best_epoch = None
+        self.best_state = None
+        self.bad_epochs = 0
+
+    def step(self, epoch, val_loss, model):
+        """Trả về True nếu nên dừng."""
+        if val_loss < self.best_loss - self.min_delta:
+            self.best_loss = val_loss
+            self.best_epoch = epoch
+            self.best_state = copy.deepcopy(model.state_dict())
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+        return self.bad_epochs >= self.patience
+
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+        return model
+
+    def state_dict(self):
+        return {'best_loss': self.best_loss, 'best_epoch': self.best_epoch,
+                'best_state': self.best_state, 'bad_epochs': self.bad_epochs}
+
+    def load_state_dict(self, state):
+        self.best_loss = state['best_loss']
+        self.best_epoch = state['best_epoch']
+        self.best_state = state['best_state']
+        self.bad_epochs = state['bad_epochs']
+
+class TrainCheckpoint:
+    """
+    Checkpoint của 1 lần train (model + optimizer + early stopping + RNG), ghi atomic sau mỗi epoch.
+    `run` mô tả lần train (mode, model gốc, mốc dữ liệu, số mẫu...): chỉ resume checkpoint có cùng `run`,
+    checkpoint của lần train khác (dữ liệu / cấu hình đã đổi) bị bỏ qua.
+    """
+
+    def __init__(self, name, run, checkpoint_dir=CHECKPOINT_DIR):
+        self.path = os.path.join(checkpoint_dir, f"{name}.ckpt.pt")
+        self.run = json.loads(json.dumps(run, sort_keys=True, default=str))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            state = torch.load(self.path, weights_only=False)
+        except Exception as e:
+            print(f"⚠️ Checkpoint hỏng ({self.path}), train lại từ đầu: {e}")
+            return None
+        if state.get('run') != self.run:
+            return None
+        return state
+
+    def save(self, epoch, model, optimizer, stopper, train_loss, done=False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        torch.save({
+            'run': self.run,
+            'epoch': epoch,
+            'train_loss': train_loss,
+            'done': done,
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'stopper': stopper.state_dict(),
+            'rng': torch.get_rng_state(),
+        }, tmp_path)
+        # Ghi file tạm rồi đổi tên -> không bao giờ đọc phải checkpoint ghi dở
+        os.replace(tmp_path, self.path)
+
+    def resume(self, model, optimizer, stopper):
+        """Nạp checkpoint (nếu khớp) vào model/optimizer/stopper. Trả về (epoch bắt đầu, loss train cuối, đã xong?)."""
+        state = self.load()
+        if state is None:
+            return 0, None, False
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        stopper.load_state_dict(state['stopper'])
+        torch.set_rng_state(state['rng'])
+        print(f"♻️ Tiếp tục từ checkpoint {os.path.basename(self.path)} (đã xong epoch {state['epoch'] + 1})")
+        return state['epoch'] + 1, state['train_loss'], state['done']
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def fit(model, optimizer, run_epoch, eval_loss, max_epochs, checkpoint, label, log_every=10):
+    """
+    Vòng train chung: run_epoch() -> loss train, eval_loss() -> loss validation (None = không có validation).
+    Dừng sớm theo validation, checkpoint mỗi epoch, cuối cùng nạp lại trọng số tốt nhất.
+    Trả về dict thống kê (số epoch đã chạy, epoch tốt nhất, loss train cuối, loss validation tốt nhất).
+    """
+    stopper = EarlyStopping()
+    start, train_loss, done = checkpoint.resume(model, optimizer, stopper)
+    epoch = start - 1
+    while not done and epoch + 1 < max_epochs:
+        epoch += 1
+        train_loss = run_epoch()
+        val_loss = eval_loss()
+        done = val_loss is not None and stopper.step(epoch, val_loss, model)
+        checkpoint.save(epoch, model, optimizer, stopper, train_loss, done)
+
+        if (epoch + 1) % log_every == 0 or done:
+            val_text = f", Val Loss: {val_loss:.6f}" if val_loss is not None else ""
+            print(f"   [{label}] Epoch {epoch+1}/{max_epochs}, Loss: {train_loss:.6f}{val_text}")
+        if done:
+            print(f"   [{label}] ⏹️ Dừng sớm ở epoch {epoch+1} (tốt nhất: epoch {stopper.best_epoch+1}, "
+                  f"Val Loss {stopper.best_loss:.6f})")
+    stopper.restore(model)
+    return {
+        'epochs_run': epoch + 1,
+        'best_epoch': stopper.best_epoch + 1 if stopper.best_epoch is not None else None,
+        'final_loss': train_loss,
+        'val_loss': stopper.best_loss if stopper.best_state is not None else None,
+    }
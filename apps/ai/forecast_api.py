@@ -0,0 +1,285 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# API đọc dự báo mới nhất trực tiếp từ RAM của worker (Orion vẫn là nơi lưu chính thức):
+#   GET /forecasts            -> toàn bộ trạm, mọi bước dự báo (1 JSON)
+#   GET /forecasts/{station}  -> 1 trạm (id lưới, vd. ThuDuc, hoặc OWM-ThuDuc)
+#   POST /interpolate         -> PM2.5 nội suy tại nhiều tọa độ trong 1 lần gọi (xem interpolation.py), body:
+#                                {"points": [[lon, lat], ...], "horizon": 1, "method": "idw" | "graph"}
+# Sau mỗi slot predictor dựng 1 snapshot bất biến (JSON + ETag tính sẵn) rồi đổi tham chiếu -> reader chỉ thấy
+# snapshot cũ hoặc mới, không cần lock. Hỗ trợ If-None-Match (304) để client poll không phải tải lại body.
+# Server asyncio (stdlib) chạy ở thread nền: giữ được nhiều kết nối keep-alive mà không tốn 1 thread / kết nối.
+
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, unquote
+import numpy as np
+import metrics
+from interpolation import Interpolator, METHODS
+
+FORECAST_API_PORT = int(os.getenv('FORECAST_API_PORT', '8090'))
+FORECAST_API_ENABLED = os.getenv('FORECAST_API_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# Đóng kết nối keep-alive không gửi request nào trong khoảng này
+FORECAST_API_IDLE_SECONDS = float(os.getenv('FORECAST_API_IDLE_SECONDS', '30'))
+MAX_HEADER_LINES = 100
+# Giới hạn 1 request nội suy (số điểm và kích thước body JSON)
+INTERPOLATE_MAX_POINTS = int(os.getenv('INTERPOLATE_MAX_POINTS', '50000'))
+MAX_BODY_BYTES = int(os.getenv('FORECAST_API_MAX_BODY_BYTES', str(4 * 1024 * 1024)))
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+           503: 'Service Unavailable'}
+
+class RequestError(Exception):
+    """Request không đọc/parse được: trả status này rồi đóng kết nối."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:20] + '"'
+
+def _dumps(document):
+    return json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class ForecastSnapshot:
+    """Bộ dự báo của 1 slot, đã serialize sẵn: bulk + từng trạm (body, ETag). Không sửa sau khi tạo."""
+
+    def __init__(self, document):
+        self.document = document
+        self.bulk = _dumps(document)
+        self.bulk_etag = _etag(self.bulk)
+        self.stations = {}
+        for station in document['stations']:
+            body = _dumps(dict(station, generatedAt=document['generatedAt'], model=document['model'],
+                               observedAt=document['observedAt'], stepMinutes=document['stepMinutes']))
+            self.stations[station['id']] = (body, _etag(body))
+        # Chỉ mục không gian cho /interpolate dựng 1 lần cùng snapshot
+        self.interpolator = Interpolator.from_document(document) if document['stations'] else None
+
+def build_snapshot(grid_points, pred_actual, last_time, forecast_time, step_minutes, version):
+    """
+    pred_actual: (Horizons, Nodes) µg/m³ theo thứ tự grid_points, cùng giá trị vừa gửi lên Orion.
+    forecast_time: mốc bắt đầu bước 1, bước h bắt đầu sau (h-1) * step_minutes.
+    """
+    stations = []
+    for i, grid_point in enumerate(grid_points):
+        forecasts = []
+        for h, step_values in enumerate(pred_actual):
+            valid_from = forecast_time + timedelta(minutes=step_minutes * h)
+            value = round(float(step_values[i]), 2)
+            forecasts.append({
+                'horizon': h + 1,
+                'validFrom': valid_from.isoformat(),
+                'validTo': (valid_from + timedelta(minutes=step_minutes)).isoformat(),
+                'pm25': value,
+                'aqi': int(value * 2.5), # Cùng công thức AQI tương đối với entity Orion
+            })
+        stations.append({
+            'id': grid_point['id'],
+            'entityId': f"urn:ngsi-ld:AirQualityForecast:OWM-{grid_point['id']}",
+            'location': {'type': 'Point', 'coordinates': [grid_point['lon'], grid_point['lat']]},
+            'forecasts': forecasts,
+        })
+    return ForecastSnapshot({
+        'generatedAt': datetime.now(timezone.utc).isoformat(),
+        'model': version,
+        'observedAt': last_time.isoformat() if last_time is not None else None,
+        'stepMinutes': step_minutes,
+        'stations': stations,
+    })
+
+# Snapshot hiện hành: gán tham chiếu là atomic -> predictor đổi snapshot, các request đang đọc giữ bản cũ
+_snapshot = None
+
+def publish(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+def _station_key(name):
+    # Chấp nhận id lưới (ThuDuc), OWM-ThuDuc hoặc id entity NGSI-LD đầy đủ
+    name = name.rsplit(':', 1)[-1]
+    return name[4:] if name.startswith('OWM-') else name
+
+def _not_modified(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # So sánh yếu: bỏ tiền tố W/
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+def _parse_interpolate(body):
+    """Body JSON của POST /interpolate -> (lats, lons, horizon, method). Sai định dạng -> ValueError."""
+    try:
+        request = json.loads(body)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f'body không phải JSON: {e}')
+    if not isinstance(request, dict) or not isinstance(request.get('points'), list):
+        raise ValueError('thiếu "points": [[lon, lat], ...]')
+    if len(request['points']) > INTERPOLATE_MAX_POINTS:
+        raise ValueError(f'tối đa {INTERPOLATE_MAX_POINTS} điểm / request')
+    try:
+        points = np.asarray(request['points'], dtype=np.float64).reshape(-1, 2)
+    except (TypeError, ValueError):
+        raise ValueError('mỗi điểm phải là [lon, lat]')
+    if len(points) != len(request['points']) or not np.isfinite(points).all():
+        raise ValueError('mỗi điểm phải là [lon, lat]')
+    horizon = request.get('horizon', 1)
+    method = request.get('method', 'idw')
+    if not isinstance(horizon, int) or isinstance(horizon, bool) or method not in METHODS:
+        raise ValueError(f'horizon phải là số nguyên, method thuộc {METHODS}')
+    return points[:, 1], points[:, 0], horizon, method
+
+def _interpolate(snapshot, body):
+    try:
+        lats, lons, horizon, method = _parse_interpolate(body)
+        values = snapshot.interpolator.interpolate(lats, lons, horizon, method)
+    except ValueError as e:
+        return 400, {}, _dumps({'error': str(e)})
+    forecast = snapshot.document['stations'][0]['forecasts'][horizon - 1]
+    return 200, {'Cache-Control': 'no-store'}, _dumps({
+        'generatedAt': snapshot.document['generatedAt'],
+        'model': snapshot.document['model'],
+        'horizon': horizon,
+        'validFrom': forecast['validFrom'],
+        'validTo': forecast['validTo'],
+        'method': method,
+        # NaN (không có trạm trong IDW_MAX_DISTANCE_KM) -> null
+        'pm25': [None if np.isnan(v) else round(v, 2) for v in values.tolist()],
+    })
+
+def route(method, target, headers, body=b''):
+    """Trả về (status, headers, body) cho 1 request. Tách riêng khỏi phần I/O để dễ kiểm tra."""
+    path = unquote(urlsplit(target).path).rstrip('/')
+    parts = path.split('/')[1:]
+    if parts == ['interpolate']:
+        if method != 'POST':
+            return 405, {'Allow': 'POST'}, b''
+    elif not parts or parts[0] != 'forecasts' or len(parts) > 2:
+        return 404, {}, _dumps({'error': 'not found'})
+    elif method not in ('GET', 'HEAD'):
+        return 405, {'Allow': 'GET, HEAD'}, b''
+
+    snapshot = _snapshot
+    if snapshot is None or (parts[0] == 'interpolate' and snapshot.interpolator is None):
+        # Worker vừa khởi động, chưa có slot nào -> client đọc Orion
+        return 503, {'Retry-After': '30'}, _dumps({'error': 'no forecast yet'})
+    if parts[0] == 'interpolate':
+        return _interpolate(snapshot, body)
+    if len(parts) == 1:
+        body, etag = snapshot.bulk, snapshot.bulk_etag
+    else:
+        entry = snapshot.stations.get(_station_key(parts[1]))
+        if entry is None:
+            return 404, {}, _dumps({'error': f'unknown station {parts[1]}'})
+        body, etag = entry
+
+    response_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if _not_modified(headers.get('if-none-match'), etag):
+        return 304, response_headers, b''
+    return 200, response_headers, body
+
+def _render(status, headers, body, head_only, keep_alive):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+    if status != 304:
+        lines.append('Content-Type: application/json; charset=utf-8')
+        lines.append(f'Content-Length: {len(body)}')
+    lines.extend(f'{name}: {value}' for name, value in headers.items())
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+    head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    return head if head_only or status == 304 else head + body
+
+async def _read_request(reader):
+    """(method, target, version, headers, body) của 1 request, None nếu client đóng kết nối."""
+    request_line = await asyncio.wait_for(reader.readline(), FORECAST_API_IDLE_SECONDS)
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise RequestError(400, 'request line không hợp lệ')
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await asyncio.wait_for(reader.readline(), FORECAST_API_IDLE_SECONDS)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise RequestError(400, 'quá nhiều header')
+
+    # Chỉ nhận body có Content-Length (không hỗ trợ chunked)
+    if 'transfer-encoding' in headers:
+        raise RequestError(411, 'cần Content-Length')
+    try:
+        length = int(headers.get('content-length', '0'))
+    except ValueError:
+        raise RequestError(400, 'Content-Length không hợp lệ')
+    if length < 0:
+        raise RequestError(400, 'Content-Length không hợp lệ')
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, f'body tối đa {MAX_BODY_BYTES} bytes')
+    body = await asyncio.wait_for(reader.readexactly(length), FORECAST_API_IDLE_SECONDS) if length else b''
+    return parts[0], parts[1], parts[2], headers, body
+
+async def _handle(reader, writer):
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except RequestError as e:
+                writer.write(_render(e.status, {}, _dumps({'error': str(e)}), False, False))
+                metrics.API_REQUESTS.inc(status=e.status)
+                break
+            if request is None:
+                break
+            method, target, version, headers, request_body = request
+            if method == 'POST':
+                # /interpolate (parse JSON + IDW tới INTERPOLATE_MAX_POINTS điểm) tốn hàng trăm ms -> chạy ở thread pool
+                # để event loop vẫn phục vụ các GET /forecasts trong lúc đó
+                status, response_headers, body = await asyncio.get_running_loop().run_in_executor(
+                    None, route, method, target, headers, request_body)
+            else:
+                status, response_headers, body = route(method, target, headers, request_body)
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            writer.write(_render(status, response_headers, body, method == 'HEAD', keep_alive))
+            await writer.drain()
+            metrics.API_REQUESTS.inc(status=status)
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def start_forecast_api(port=FORECAST_API_PORT, host='0.0.0.0'):
+    """Mở API đọc dự báo ở thread nền (event loop riêng). Trả về server (hoặc None nếu tắt / không mở được port)."""
+    if not FORECAST_API_ENABLED:
+        return None
+    loop = asyncio.new_event_loop()
+    try:
+        # Bind ở thread gọi để báo lỗi cổng ngay
+        server = loop.run_until_complete(asyncio.start_server(_handle, host, port))
+    except OSError as e:
+        print(f"⚠️ Không mở được forecast API cổng {port}: {e}")
+        loop.close()
+        return None
+    threading.Thread(target=loop.run_forever, name='forecast-api', daemon=True).start()
+    return server
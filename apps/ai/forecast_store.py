@@ -0,0 +1,210 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Lịch sử dự báo trong Postgres: Orion chỉ giữ bản mới nhất (ghi đè mỗi slot), bảng air_quality_forecasts
+# giữ lại mọi lần chạy (run_id, version model, mốc mục tiêu, horizon, giá trị) để backtest / dashboard độ chính xác
+# / đọc lịch sử bằng SQL thay vì quét Orion.
+#   - Bảng chia partition theo tháng của target_time: truy vấn theo khoảng thời gian chỉ đọc vài partition,
+#     xóa dữ liệu cũ = DROP partition. Partition được tạo khi cần, ngay trong transaction ghi.
+#   - Mỗi lần chạy ghi bằng 1 lệnh COPY (psycopg2 copy_expert) trong 1 transaction: hoặc đủ cả lần chạy, hoặc không.
+#   - Chỉ 1 index (entity_id, target_time); B-tree dedup (PG13+) gộp các khóa entity_id lặp lại nên index gọn.
+# Bảng được worker tự tạo (idempotent) như trigger NOTIFY của obs_events.py. DB khác Postgres (SQLite của benchmark)
+# dùng bảng thường + INSERT.
+#   python forecast_store.py --days 7   # MAE / RMSE theo horizon của các dự báo đã lưu so với quan trắc thực tế
+
+import io
+import os
+import csv
+import uuid
+import argparse
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+import metrics
+
+FORECAST_HISTORY_ENABLED = os.getenv('FORECAST_HISTORY_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+FORECAST_TABLE = 'air_quality_forecasts'
+COLUMNS = ('run_id', 'model_version', 'entity_id', 'issued_at', 'observed_at', 'target_time', 'horizon', 'pm25')
+
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS {FORECAST_TABLE} (
+    run_id uuid NOT NULL,
+    model_version text NOT NULL,
+    entity_id text NOT NULL,
+    issued_at timestamptz NOT NULL,
+    observed_at timestamptz,
+    target_time timestamptz NOT NULL,
+    horizon smallint NOT NULL,
+    pm25 real NOT NULL
+) PARTITION BY RANGE (target_time);
+
+CREATE INDEX IF NOT EXISTS {FORECAST_TABLE}_entity_target_idx ON {FORECAST_TABLE} (entity_id, target_time);
+"""
+
+SQLITE_SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS {FORECAST_TABLE} (
+    run_id TEXT, model_version TEXT, entity_id TEXT, issued_at TIMESTAMP, observed_at TIMESTAMP,
+    target_time TIMESTAMP, horizon INTEGER, pm25 REAL
+)
+"""
+
+COPY_SQL = f"COPY {FORECAST_TABLE} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+
+# Sai số của các dự báo đã đến hạn: mỗi dự báo so với trung bình quan trắc trong khoảng hiệu lực của nó
+# [target_time, target_time + step). Lọc theo target_time -> chỉ đọc các partition liên quan.
+ACCURACY_QUERY = text(f"""
+    SELECT f.horizon, COUNT(*) AS samples,
+           AVG(ABS(f.pm25 - o.pm25)) AS mae,
+           SQRT(AVG((f.pm25 - o.pm25) ^ 2)) AS rmse
+    FROM {FORECAST_TABLE} f
+    CROSS JOIN LATERAL (
+        SELECT AVG(pm2_5) AS pm25
+        FROM air_quality_observations
+        WHERE entity_id = f.entity_id AND pm2_5 IS NOT NULL
+          AND time >= f.target_time AND time < f.target_time + CAST(:step AS interval)
+    ) o
+    WHERE f.target_time >= :since AND f.target_time + CAST(:step AS interval) <= now()
+      AND (CAST(:model_version AS text) IS NULL OR f.model_version = :model_version)
+      AND o.pm25 IS NOT NULL
+    GROUP BY f.horizon
+    ORDER BY f.horizon
+""")
+
+def _is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
+
+def _utc(value):
+    # datetime không tz (datetime.now() của predictor) hiểu theo giờ máy, giống lúc gửi lên Orion
+    return value.astimezone(timezone.utc) if value is not None else None
+
+def _month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _next_month(value):
+    return (value.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+def partition_ddl(month):
+    """CREATE TABLE của partition chứa tháng `month` (datetime UTC, ngày 1 lúc 00:00)."""
+    name = f"{FORECAST_TABLE}_p{month:%Y%m}"
+    return (f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {FORECAST_TABLE} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')")
+
+def build_rows(run_id, model_version, grid_points, pred_actual, last_time, forecast_time, step_minutes, issued_at):
+    """1 dòng / (horizon, trạm), cùng giá trị và mốc thời gian với entity gửi lên Orion."""
+    forecast_time = _utc(forecast_time)
+    observed_at = _utc(last_time)
+    rows = []
+    for h, step_values in enumerate(pred_actual):
+        target_time = forecast_time + timedelta(minutes=step_minutes * h)
+        for grid_point, value in zip(grid_points, step_values):
+            rows.append((run_id, model_version, f"urn:ngsi-ld:AirQualityStation:OWM-{grid_point['id']}",
+                         issued_at, observed_at, target_time, h + 1, round(float(value), 2)))
+    return rows
+
+class ForecastStore:
+    """Ghi lịch sử dự báo của predictor sống lâu trong worker (bảng + partition đã tạo được nhớ lại)."""
+
+    def __init__(self, engine, enabled=FORECAST_HISTORY_ENABLED):
+        self.engine = engine
+        self.enabled = enabled
+        self._schema_ready = False
+        self._months = set()
+
+    def write_run(self, model_version, grid_points, pred_actual, last_time, forecast_time, step_minutes):
+        """
+        Ghi 1 lần dự báo (pred_actual: (Horizons, Nodes) µg/m³ theo thứ tự grid_points).
+        Trả về run_id, hoặc None nếu tắt / lỗi (lỗi không làm hỏng slot dự báo, Orion vẫn được đồng bộ).
+        """
+        if not self.enabled:
+            return None
+        run_id = str(uuid.uuid4())
+        rows = build_rows(run_id, model_version, grid_points, pred_actual, last_time, forecast_time,
+                          step_minutes, datetime.now(timezone.utc))
+        try:
+            if _is_postgres(self.engine):
+                self._copy(rows)
+            else:
+                self._insert(rows)
+        except Exception as e:
+            metrics.HISTORY_FAILURES.inc()
+            print(f"⚠️ Không lưu được lịch sử dự báo vào {FORECAST_TABLE}: {e}")
+            return None
+        metrics.HISTORY_ROWS.inc(len(rows))
+        return run_id
+
+    def _copy(self, rows):
+        months = {_month_start(row[5]) for row in rows}
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            (run_id, version, entity_id, issued_at.isoformat(), observed_at.isoformat() if observed_at else '',
+             target_time.isoformat(), horizon, value)
+            for run_id, version, entity_id, issued_at, observed_at, target_time, horizon, value in rows)
+        buffer.seek(0)
+
+        # Kết nối psycopg2 gốc từ pool: DDL (lần đầu / sang tháng mới) + COPY cùng 1 transaction
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                if not self._schema_ready:
+                    cur.execute(SCHEMA_SQL)
+                for month in sorted(months - self._months):
+                    cur.execute(partition_ddl(month))
+                cur.copy_expert(COPY_SQL, buffer)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        # Chỉ nhớ sau khi commit: transaction lỗi thì lần sau tạo lại
+        self._schema_ready = True
+        self._months |= months
+
+    def _insert(self, rows):
+        # SQLite lưu thời gian dạng chuỗi UTC không kèm tz (giống air_quality_observations của benchmark)
+        def naive(value):
+            return value.replace(tzinfo=None) if value is not None else None
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(SQLITE_SCHEMA_SQL)
+            conn.exec_driver_sql(
+                f"INSERT INTO {FORECAST_TABLE} ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [(r[0], r[1], r[2], naive(r[3]), naive(r[4]), naive(r[5]), r[6], r[7]) for r in rows])
+
+def fetch_accuracy(engine, days, step_minutes, model_version=None):
+    """[(horizon, số mẫu, MAE, RMSE)] của các dự báo có target_time trong `days` ngày gần nhất (chỉ Postgres)."""
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    with engine.connect() as conn:
+        return conn.execute(ACCURACY_QUERY, {
+            'since': since, 'step': f"{int(step_minutes) * 60} seconds", 'model_version': model_version,
+        }).fetchall()
+
+def main():
+    from predict_gnn import get_db_engine, STEP_MINUTES
+    parser = argparse.ArgumentParser(description="Độ chính xác của dự báo đã lưu trong air_quality_forecasts")
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--version', default=None, help="Chỉ tính 1 version model")
+    args = parser.parse_args()
+
+    engine, _ = get_db_engine()
+    rows = fetch_accuracy(engine, args.days, STEP_MINUTES, args.version)
+    if not rows:
+        print(f"⚠️ Chưa có dự báo nào đến hạn trong {args.days:g} ngày qua.")
+        return
+    print(f"📈 Dự báo đã lưu, {args.days:g} ngày gần nhất" + (f" (version {args.version})" if args.version else ""))
+    for horizon, samples, mae, rmse in rows:
+        print(f"   H{horizon}: {samples} mẫu, MAE {mae:.2f}, RMSE {rmse:.2f} µg/m³")
+
+if __name__ == "__main__":
+    main()
@@ -15,11 +15,49 @@
 #
 
 
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.nn import GCNConv
 
+# Đồ thị tĩnh: tới số node này lưu Â dạng dense (matmul nhanh hơn sparse khi N nhỏ), lớn hơn thì CSR
+GCN_DENSE_MAX_NODES = int(os.getenv('GCN_DENSE_MAX_NODES', '256'))
+
+def gcn_norm_adjacency(edge_index, edge_weight, num_nodes, dense=None):
+    """
+    Ma trận kề chuẩn hóa Â = D^-1/2 (A + I) D^-1/2 [N, N], giống hệt chuẩn hóa mặc định của GCNConv:
+    self-loop trọng số 1 cho node chưa có, bậc tính theo node đích, out[i] = sum_j Â[i, j] * x[j].
+    Trả về tensor dense (N <= GCN_DENSE_MAX_NODES hoặc dense=True) hoặc sparse CSR.
+    """
+    row, col = edge_index[0].cpu(), edge_index[1].cpu()
+    if edge_weight is None:
+        edge_weight = torch.ones(row.size(0))
+    edge_weight = edge_weight.detach().cpu().to(torch.float32)
+
+    # Giữ self-loop sẵn có (nếu có), thêm self-loop trọng số 1 cho các node còn lại
+    is_loop = row == col
+    loop_weight = torch.ones(num_nodes)
+    loop_weight[row[is_loop]] = edge_weight[is_loop]
+    nodes = torch.arange(num_nodes)
+    row = torch.cat([row[~is_loop], nodes])
+    col = torch.cat([col[~is_loop], nodes])
+    weight = torch.cat([edge_weight[~is_loop], loop_weight])
+
+    deg = torch.zeros(num_nodes).index_add_(0, col, weight)
+    deg_inv_sqrt = deg.pow(-0.5)
+    deg_inv_sqrt[torch.isinf(deg_inv_sqrt)] = 0
+    norm = deg_inv_sqrt[row] * weight * deg_inv_sqrt[col]
+
+    if dense is None:
+        dense = num_nodes <= GCN_DENSE_MAX_NODES
+    if dense:
+        adj = torch.zeros(num_nodes, num_nodes)
+        adj.index_put_((col, row), norm, accumulate=True)
+        return adj
+    # coalesce() cộng các cạnh trùng và sắp theo hàng -> chuyển CSR
+    return torch.sparse_coo_tensor(torch.stack([col, row]), norm, (num_nodes, num_nodes), check_invariants=False).coalesce().to_sparse_csr()
+
 class ST_GNN(nn.Module):
     def __init__(self, num_nodes, input_dim, hidden_dim, output_dim):
         super(ST_GNN, self).__init__()
@@ -37,23 +75,60 @@ class ST_GNN(nn.Module):
         # 3. Output Layer
         self.fc = nn.Linear(hidden_dim, output_dim)
 
-    def forward(self, x, edge_index, edge_weight=None):
+        # Đồ thị tĩnh (set_graph): Â tính 1 lần, không nằm trong state_dict
+        self.register_buffer('adj', None, persistent=False)
+
+    def set_graph(self, edge_index, edge_weight=None, dense=None):
+        """Bật chế độ đồ thị tĩnh: chuẩn hóa đồ thị 1 lần, forward(x) không cần truyền edge_index."""
+        # gcn.bias luôn là Parameter thường (fc/lstm có thể đã bị lượng tử hóa int8)
+        device = self.gcn.bias.device
+        self.adj = gcn_norm_adjacency(edge_index, edge_weight, self.num_nodes, dense).to(device)
+        return self
+
+    def clear_graph(self):
+        self.adj = None
+        return self
+
+    def propagate_static(self, h):
+        # h: [B*N, Hidden] -> Â (h W^T) + b cho từng snapshot, trọng số dùng chung với self.gcn
+        h = F.linear(h, self.gcn.lin.weight)
+        if self.adj.layout == torch.strided:
+            h = torch.matmul(self.adj, h.view(-1, self.num_nodes, self.hidden_dim))
+            return h.reshape(-1, self.hidden_dim) + self.gcn.bias
+        # CSR: gộp mọi snapshot thành các cột của 1 ma trận [N, B*Hidden] -> 1 lần sparse matmul
+        h = h.view(-1, self.num_nodes, self.hidden_dim).transpose(0, 1).reshape(self.num_nodes, -1)
+        h = torch.sparse.mm(self.adj, h)
+        h = h.view(self.num_nodes, -1, self.hidden_dim).transpose(0, 1).reshape(-1, self.hidden_dim)
+        return h + self.gcn.bias
+
+    def forward(self, x, edge_index=None, edge_weight=None):
         # x shape: [Batch_Size * Num_Nodes, Seq_Len, Features]
-        # Nhưng PyG thường xử lý graph snapshot.
-        # Để đơn giản cho dự án này, ta xử lý từng snapshot.
+        # - edge_index=None: dùng đồ thị tĩnh đã set_graph (mọi snapshot chung 1 Â)
+        # - Truyền edge_index: GCNConv như cũ; nhiều snapshot thì nhân bản theo khối chéo (xem batch_graph)
         
         # --- BƯỚC 1: LSTM (Thời gian) ---
-        # Input x: [Num_Nodes, Seq_Len, Features] (1 Graph snapshot)
+        # Input x: [Batch_Size * Num_Nodes, Seq_Len, Features]
         lstm_out, _ = self.lstm(x) 
         
-        # Lấy hidden state cuối cùng: [Num_Nodes, Hidden_Dim]
+        # Lấy hidden state cuối cùng: [Batch_Size * Num_Nodes, Hidden_Dim]
         h_last = lstm_out[:, -1, :]
         
         # --- BƯỚC 2: GCN (Không gian) ---
         # Truyền thông tin qua các cạnh (edge_index)
-        gcn_out = self.gcn(h_last, edge_index, edge_weight)
+        if edge_index is None:
+            gcn_out = self.propagate_static(h_last)
+        else:
+            gcn_out = self.gcn(h_last, edge_index, edge_weight)
         gcn_out = F.relu(gcn_out)
         
         # --- BƯỚC 3: Dự báo ---
-        out = self.fc(gcn_out) # [Num_Nodes, 1]
-        return out
\ No newline at end of file
+        out = self.fc(gcn_out) # [Batch_Size * Num_Nodes, Horizons] (output_dim = số bước dự báo)
+        return out
+
+def batch_graph(edge_index, edge_weight, num_nodes, batch_size):
+    """Ghép batch_size snapshot thành 1 đồ thị lớn (ma trận kề khối chéo) để chạy 1 forward duy nhất."""
+    # Snapshot thứ b dùng các node [b*num_nodes, (b+1)*num_nodes)
+    offsets = torch.arange(batch_size, device=edge_index.device).repeat_interleave(edge_index.size(1)) * num_nodes
+    batch_edge_index = edge_index.repeat(1, batch_size) + offsets
+    batch_edge_weight = edge_weight.repeat(batch_size) if edge_weight is not None else None
+    return batch_edge_index, batch_edge_weight
\ No newline at end of file
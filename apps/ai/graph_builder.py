@@ -0,0 +1,117 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Sinh graph_structure.pt (edge_index, edge_weight) từ tọa độ trạm.
+# Dùng BallTree (metric haversine) thay vì tính khoảng cách mọi cặp trạm -> chạy được với hàng nghìn trạm.
+#   python graph_builder.py                      # radius 15km như đồ thị gốc
+#   python graph_builder.py --mode knn --k 8     # k láng giềng gần nhất (khuyên dùng khi rất nhiều trạm)
+#   python graph_builder.py --from-db            # lấy trạm + tọa độ từ DB, ghi lại stations.json
+
+import os
+import time
+import argparse
+import numpy as np
+from sklearn.neighbors import BallTree
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GRAPH_PATH = os.path.join(BASE_DIR, 'graph_structure.pt')
+EARTH_RADIUS_KM = 6371.0088
+GRAPH_MODE = os.getenv('GRAPH_MODE', 'radius')
+GRAPH_RADIUS_KM = float(os.getenv('GRAPH_RADIUS_KM', '15'))
+GRAPH_K = int(os.getenv('GRAPH_K', '8'))
+# Chặn trọng số vô hạn khi 2 trạm trùng tọa độ
+MIN_DISTANCE_KM = 0.01
+
+def build_graph(stations, mode=GRAPH_MODE, radius_km=GRAPH_RADIUS_KM, k=GRAPH_K):
+    """
+    Trả về (edge_index [2, E] int64, edge_weight [E] float32) dạng numpy.
+    Cạnh vô hướng (luôn có cả 2 chiều), trọng số = 1 / khoảng cách (km), không có self-loop.
+    """
+    coords = np.radians([[s['lat'], s['lon']] for s in stations])
+    num_nodes = len(coords)
+    tree = BallTree(coords, metric='haversine')
+
+    if mode == 'radius':
+        neighbors, distances = tree.query_radius(coords, r=radius_km / EARTH_RADIUS_KM, return_distance=True)
+        counts = np.array([len(n) for n in neighbors])
+        src = np.repeat(np.arange(num_nodes), counts)
+        dst = np.concatenate(neighbors) if num_nodes else np.array([], dtype=np.int64)
+        dist = np.concatenate(distances) if num_nodes else np.array([])
+    elif mode == 'knn':
+        k = min(k + 1, num_nodes) # +1 vì điểm gần nhất là chính nó
+        distances, neighbors = tree.query(coords, k=k)
+        src = np.repeat(np.arange(num_nodes), k)
+        dst = neighbors.ravel()
+        dist = distances.ravel()
+        # kNN không đối xứng -> thêm chiều ngược lại để đồ thị vô hướng
+        src, dst, dist = np.concatenate([src, dst]), np.concatenate([dst, src]), np.concatenate([dist, dist])
+    else:
+        raise ValueError(f"GRAPH_MODE không hợp lệ: {mode} (radius | knn)")
+
+    # Bỏ self-loop (GCN tự thêm), bỏ cạnh trùng, sắp theo (src, dst)
+    mask = src != dst
+    src, dst, dist = src[mask], dst[mask], dist[mask]
+    keys, first = np.unique(src.astype(np.int64) * num_nodes + dst, return_index=True)
+    src, dst, dist = keys // num_nodes, keys % num_nodes, dist[first]
+
+    edge_index = np.stack([src, dst]).astype(np.int64)
+    edge_weight = (1.0 / np.maximum(dist * EARTH_RADIUS_KM, MIN_DISTANCE_KM)).astype(np.float32)
+    return edge_index, edge_weight
+
+def save_graph(edge_index, edge_weight, path=GRAPH_PATH):
+    # Định dạng ST_GNN.forward cần: tuple (LongTensor [2, E], FloatTensor [E])
+    import torch
+    tmp_path = path + '.tmp'
+    torch.save((torch.from_numpy(edge_index), torch.from_numpy(edge_weight)), tmp_path)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sinh đồ thị trạm cho ST-GNN")
+    parser.add_argument('--mode', choices=['radius', 'knn'], default=GRAPH_MODE)
+    parser.add_argument('--radius-km', type=float, default=GRAPH_RADIUS_KM)
+    parser.add_argument('--k', type=int, default=GRAPH_K)
+    parser.add_argument('--from-db', action='store_true', help="Đọc tọa độ trạm từ DB và cập nhật stations.json")
+    parser.add_argument('--output', default=GRAPH_PATH)
+    args = parser.parse_args()
+
+    import stations as station_config
+    if args.from_db:
+        from train_gnn import get_db_engine
+        fresh = station_config.load_stations_from_db(get_db_engine())
+        if not fresh:
+            print("❌ Không tìm thấy trạm nào có tọa độ trong DB.")
+            return
+        # Giữ thứ tự node của stations.json hiện tại, trạm mới nối vào cuối
+        existing = station_config.load_stations() if os.path.exists(station_config.STATIONS_FILE) else []
+        stations, added = station_config.merge_stations(existing, fresh)
+        station_config.save_stations(stations)
+        print(f"💾 Đã cập nhật {station_config.STATIONS_FILE} ({len(stations)} trạm"
+              + (f", thêm mới: {', '.join(added)}" if added else "") + ")")
+    else:
+        stations = station_config.load_stations()
+
+    start = time.perf_counter()
+    edge_index, edge_weight = build_graph(stations, args.mode, args.radius_km, args.k)
+    elapsed = (time.perf_counter() - start) * 1000
+    save_graph(edge_index, edge_weight, args.output)
+
+    isolated = len(stations) - len(np.unique(edge_index[0]))
+    print(f"✅ Đồ thị {args.mode}: {len(stations)} node, {edge_index.shape[1]} cạnh, "
+          f"{isolated} node cô lập, build {elapsed:.1f}ms -> {args.output}")
+    print("⚠️ Số node/đồ thị đã đổi thì cần train lại model (train_gnn.py) trước khi dự báo.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Nội suy PM2.5 tại tọa độ bất kỳ từ dự báo ST_GNN mới nhất (giá trị tại các node/trạm), theo lô:
+#   - idw:   nghịch đảo khoảng cách (k trạm gần nhất, lũy thừa IDW_POWER)
+#   - graph: làm trơn giá trị node trên đồ thị trạm (cạnh trong GRAPH_RADIUS_KM, trọng số 1/km như
+#            graph_builder.py) rồi mới IDW -> bớt "đốm" quanh 1 trạm lệch hẳn so với láng giềng
+# Chỉ mục không gian dựng 1 lần cho mỗi snapshot dự báo; 1 lần gọi xử lý hàng nghìn điểm bằng phép toán
+# vector NumPy (route planner gửi cả tuyến đường trong 1 request thay vì quét từng điểm).
+
+import os
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+IDW_NEIGHBORS = int(os.getenv('IDW_NEIGHBORS', '4'))
+IDW_POWER = float(os.getenv('IDW_POWER', '2'))
+# Trạm xa hơn ngưỡng này không được tính (0 = không giới hạn); điểm không có trạm nào trong ngưỡng -> None
+IDW_MAX_DISTANCE_KM = float(os.getenv('IDW_MAX_DISTANCE_KM', '0'))
+# Điểm trùng trạm (khoảng cách gần 0) lấy đúng giá trị trạm, không chia cho 0
+MIN_DISTANCE_KM = 0.01
+GRAPH_RADIUS_KM = float(os.getenv('GRAPH_RADIUS_KM', '15'))
+# Mỗi bước: x <- (1 - alpha) * x + alpha * trung bình có trọng số của láng giềng
+GRAPH_SMOOTH_ALPHA = float(os.getenv('GRAPH_SMOOTH_ALPHA', '0.5'))
+GRAPH_SMOOTH_STEPS = int(os.getenv('GRAPH_SMOOTH_STEPS', '2'))
+# Ít trạm thì so khoảng cách với mọi trạm (1 phép nhân ma trận) nhanh hơn dựng BallTree
+BALLTREE_MIN_STATIONS = int(os.getenv('BALLTREE_MIN_STATIONS', '256'))
+# Chia lô điểm truy vấn để ma trận (điểm x trạm) không chiếm quá nhiều RAM
+QUERY_CHUNK = 8192
+METHODS = ('idw', 'graph')
+
+def _unit_vectors(lat_rad, lon_rad):
+    cos_lat = np.cos(lat_rad)
+    return np.stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)], axis=-1)
+
+class StationIndex:
+    """
+    Chỉ mục k trạm gần nhất theo khoảng cách mặt cầu (km).
+    Nhiều trạm (và có sklearn) -> BallTree haversine như graph_builder.py; ít trạm -> so với mọi trạm bằng tích
+    vô hướng của vector đơn vị (không cần sklearn, chạy được trên image lite).
+    """
+
+    def __init__(self, lats, lons):
+        self.coords = np.radians(np.column_stack([lats, lons]).astype(np.float64))
+        self.size = len(self.coords)
+        self.tree = None
+        if self.size >= BALLTREE_MIN_STATIONS:
+            try:
+                from sklearn.neighbors import BallTree
+                self.tree = BallTree(self.coords, metric='haversine')
+            except ImportError:
+                pass
+        if self.tree is None:
+            self.vectors = _unit_vectors(self.coords[:, 0], self.coords[:, 1])
+
+    def query(self, lats, lons, k):
+        """(khoảng cách km [Q, k], chỉ số trạm [Q, k]), sắp tăng dần theo khoảng cách."""
+        k = min(k, self.size)
+        points = np.radians(np.column_stack([lats, lons]).astype(np.float64))
+        if self.tree is not None:
+            distances, indices = self.tree.query(points, k=k)
+            return distances * EARTH_RADIUS_KM, indices
+
+        distances = np.empty((len(points), k))
+        indices = np.empty((len(points), k), dtype=np.int64)
+        for start in range(0, len(points), QUERY_CHUNK):
+            chunk = _unit_vectors(points[start:start + QUERY_CHUNK, 0], points[start:start + QUERY_CHUNK, 1])
+            # Dây cung giữa 2 vector đơn vị -> góc ở tâm (ổn định số hơn arccos khi 2 điểm rất gần)
+            chord_sq = np.maximum(2.0 - 2.0 * (chunk @ self.vectors.T), 0.0)
+            if k < self.size:
+                nearest = np.argpartition(chord_sq, k - 1, axis=1)[:, :k]
+                chord_sq = np.take_along_axis(chord_sq, nearest, axis=1)
+            else:
+                nearest = np.broadcast_to(np.arange(self.size), chord_sq.shape)
+            order = np.argsort(chord_sq, axis=1)
+            end = start + len(chunk)
+            indices[start:end] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:end] = 2.0 * np.arcsin(np.minimum(np.sqrt(np.take_along_axis(chord_sq, order, axis=1)) / 2.0, 1.0))
+        return distances * EARTH_RADIUS_KM, indices
+
+def station_graph(index, radius_km=GRAPH_RADIUS_KM):
+    """Ma trận kề dày [N, N] giữa các trạm trong bán kính, trọng số 1/km, không có self-loop."""
+    vectors = _unit_vectors(index.coords[:, 0], index.coords[:, 1])
+    chord = np.sqrt(np.maximum(2.0 - 2.0 * (vectors @ vectors.T), 0.0))
+    distances = 2.0 * np.arcsin(np.minimum(chord / 2.0, 1.0)) * EARTH_RADIUS_KM
+    weights = 1.0 / np.maximum(distances, MIN_DISTANCE_KM)
+    weights[(distances > radius_km) | np.eye(index.size, dtype=bool)] = 0.0
+    return weights
+
+def smooth_on_graph(values, weights, alpha=GRAPH_SMOOTH_ALPHA, steps=GRAPH_SMOOTH_STEPS):
+    """values [H, N] -> làm trơn theo láng giềng trên đồ thị; node cô lập giữ nguyên giá trị."""
+    degree = weights.sum(axis=1)
+    connected = degree > 0
+    transition = np.divide(weights, degree[:, None], out=np.zeros_like(weights), where=connected[:, None])
+    mix = np.where(connected, alpha, 0.0)
+    for _ in range(steps):
+        values = (1.0 - mix) * values + mix * (values @ transition.T)
+    return values
+
+class Interpolator:
+    """Giá trị trạm [H, N] + chỉ mục không gian của 1 snapshot dự báo. Không sửa sau khi tạo."""
+
+    def __init__(self, lats, lons, values):
+        self.index = StationIndex(lats, lons)
+        self.values = {'idw': np.asarray(values, dtype=np.float64)}
+        # Đồ thị trạm chỉ dựng khi vừa phải (ma trận dày N x N)
+        if self.index.size <= 4096:
+            self.values['graph'] = smooth_on_graph(self.values['idw'], station_graph(self.index))
+        self.horizons = self.values['idw'].shape[0]
+
+    @classmethod
+    def from_document(cls, document):
+        """Dựng từ document của forecast_api (location GeoJSON [lon, lat], pm25 theo từng horizon)."""
+        stations = document['stations']
+        lons = [s['location']['coordinates'][0] for s in stations]
+        lats = [s['location']['coordinates'][1] for s in stations]
+        values = [[s['forecasts'][h]['pm25'] for s in stations] for h in range(len(stations[0]['forecasts']))]
+        return cls(lats, lons, values)
+
+    def interpolate(self, lats, lons, horizon=1, method='idw', k=IDW_NEIGHBORS, power=IDW_POWER,
+                    max_distance_km=IDW_MAX_DISTANCE_KM):
+        """
+        PM2.5 (µg/m³) tại các điểm (lats, lons) cho bước dự báo `horizon` (1-based).
+        Trả về ndarray [Q]; NaN ở điểm không có trạm nào trong max_distance_km.
+        """
+        if method not in self.values:
+            raise ValueError(f"method không hỗ trợ: {method} ({' | '.join(self.values)})")
+        if not 1 <= horizon <= self.horizons:
+            raise ValueError(f"horizon phải trong 1..{self.horizons}")
+        station_values = self.values[method][horizon - 1]
+        distances, indices = self.index.query(lats, lons, k)
+        weights = 1.0 / np.maximum(distances, MIN_DISTANCE_KM) ** power
+        if max_distance_km > 0:
+            weights[distances > max_distance_km] = 0.0
+        total = weights.sum(axis=1)
+        weighted = (weights * station_values[indices]).sum(axis=1)
+        return np.divide(weighted, total, out=np.full(len(total), np.nan), where=total > 0)
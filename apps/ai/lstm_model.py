@@ -0,0 +1,147 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import torch
+import torch.nn as nn
+
+class AirQualityLSTM(nn.Module):
+    """Model LSTM của 1 trạm (định dạng file lstm_model_<id>.pth), dùng chung cho train_model.py và predict.py."""
+
+    def __init__(self, input_size, hidden_size, num_layers, output_size=1):
+        super(AirQualityLSTM, self).__init__()
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
+        self.fc = nn.Linear(hidden_size, output_size)
+
+    def forward(self, x):
+        # Khởi tạo hidden state (h0) và cell state (c0)
+        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
+        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
+
+        out, _ = self.lstm(x, (h0, c0))
+        out = self.fc(out[:, -1, :])
+        return out
+
+class QuantizedStationLSTMs(nn.Module):
+    """Các AirQualityLSTM int8 của từng trạm, cùng giao diện với StackedAirQualityLSTM: [S, B, T, 1] -> [S, B, 1]."""
+
+    def __init__(self, models):
+        super(QuantizedStationLSTMs, self).__init__()
+        self.models = nn.ModuleList(models)
+
+    def forward(self, x):
+        # Kernel int8 chỉ có cho nn.LSTM/nn.Linear nên không gộp trạm được như bản fp32 (bmm)
+        return torch.stack([model(x[s]) for s, model in enumerate(self.models)])
+
+class StackedAirQualityLSTM(nn.Module):
+    """
+    Gộp S mô hình AirQualityLSTM (cùng kiến trúc, mỗi trạm 1 bộ trọng số) thành 1 module.
+    Trọng số được xếp chồng theo trục trạm, mọi trạm chạy chung 1 lần forward bằng batched matmul.
+    Tên/định dạng trọng số từng trạm giữ nguyên như nn.LSTM + nn.Linear (xem from_state_dicts/to_state_dicts).
+    """
+
+    def __init__(self, num_stations, input_size, hidden_size, num_layers, output_size=1):
+        super(StackedAirQualityLSTM, self).__init__()
+        self.num_stations = num_stations
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.output_size = output_size
+
+        gates = 4 * hidden_size
+        self.weight_ih = nn.ParameterList()
+        self.weight_hh = nn.ParameterList()
+        self.bias_ih = nn.ParameterList()
+        self.bias_hh = nn.ParameterList()
+        for layer in range(num_layers):
+            layer_input = input_size if layer == 0 else hidden_size
+            self.weight_ih.append(nn.Parameter(torch.empty(num_stations, gates, layer_input)))
+            self.weight_hh.append(nn.Parameter(torch.empty(num_stations, gates, hidden_size)))
+            self.bias_ih.append(nn.Parameter(torch.empty(num_stations, gates)))
+            self.bias_hh.append(nn.Parameter(torch.empty(num_stations, gates)))
+        self.fc_weight = nn.Parameter(torch.empty(num_stations, output_size, hidden_size))
+        self.fc_bias = nn.Parameter(torch.empty(num_stations, output_size))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Khởi tạo giống nn.LSTM / nn.Linear: U(-1/sqrt(H), 1/sqrt(H))
+        bound = self.hidden_size ** -0.5
+        for param in self.parameters():
+            nn.init.uniform_(param, -bound, bound)
+
+    @classmethod
+    def from_state_dicts(cls, state_dicts, input_size, hidden_size, num_layers, output_size=1):
+        model = cls(len(state_dicts), input_size, hidden_size, num_layers, output_size)
+        with torch.no_grad():
+            for layer in range(num_layers):
+                model.weight_ih[layer].copy_(torch.stack([sd[f'lstm.weight_ih_l{layer}'] for sd in state_dicts]))
+                model.weight_hh[layer].copy_(torch.stack([sd[f'lstm.weight_hh_l{layer}'] for sd in state_dicts]))
+                model.bias_ih[layer].copy_(torch.stack([sd[f'lstm.bias_ih_l{layer}'] for sd in state_dicts]))
+                model.bias_hh[layer].copy_(torch.stack([sd[f'lstm.bias_hh_l{layer}'] for sd in state_dicts]))
+            model.fc_weight.copy_(torch.stack([sd['fc.weight'] for sd in state_dicts]))
+            model.fc_bias.copy_(torch.stack([sd['fc.bias'] for sd in state_dicts]))
+        return model
+
+    def to_state_dicts(self):
+        # Tách lại thành state_dict của từng AirQualityLSTM (tương thích predict.py / file .pth cũ)
+        state_dicts = []
+        for s in range(self.num_stations):
+            sd = {}
+            for layer in range(self.num_layers):
+                sd[f'lstm.weight_ih_l{layer}'] = self.weight_ih[layer][s].detach().clone()
+                sd[f'lstm.weight_hh_l{layer}'] = self.weight_hh[layer][s].detach().clone()
+                sd[f'lstm.bias_ih_l{layer}'] = self.bias_ih[layer][s].detach().clone()
+                sd[f'lstm.bias_hh_l{layer}'] = self.bias_hh[layer][s].detach().clone()
+            sd['fc.weight'] = self.fc_weight[s].detach().clone()
+            sd['fc.bias'] = self.fc_bias[s].detach().clone()
+            state_dicts.append(sd)
+        return state_dicts
+
+    def forward(self, x):
+        # x shape: [Stations, Batch, Seq_Len, Input] -> out: [Stations, Batch, Output]
+        num_stations, batch, seq_len, _ = x.shape
+        hidden = self.hidden_size
+        layer_input = x
+        for layer in range(self.num_layers):
+            # Chiếu input của mọi bước thời gian 1 lần (cộng luôn bias): [S, B*T, in] x [S, in, 4H]
+            x_proj = torch.baddbmm(
+                (self.bias_ih[layer] + self.bias_hh[layer]).unsqueeze(1),
+                layer_input.reshape(num_stations, batch * seq_len, -1),
+                self.weight_ih[layer].transpose(1, 2)
+            ).view(num_stations, batch, seq_len, -1)
+            w_hh = self.weight_hh[layer].transpose(1, 2)
+            last_layer = layer == self.num_layers - 1
+
+            h = c = None
+            outputs = []
+            for t in range(seq_len):
+                # h0 = c0 = 0: bước đầu không cần nhân với w_hh / cộng forget * c
+                gates = x_proj[:, :, t] if h is None else torch.baddbmm(x_proj[:, :, t], h, w_hh)
+                # Thứ tự cổng của nn.LSTM: input, forget, cell, output (sigmoid 1 lần cho cả 4 cổng, cổng cell dùng tanh)
+                sig = torch.sigmoid(gates)
+                i, f, o = sig[..., :hidden], sig[..., hidden:2 * hidden], sig[..., 3 * hidden:]
+                g = torch.tanh(gates[..., 2 * hidden:3 * hidden])
+                c = i * g if c is None else torch.addcmul(i * g, f, c)
+                h = o * torch.tanh(c)
+                if not last_layer:
+                    outputs.append(h)
+            if not last_layer:
+                layer_input = torch.stack(outputs, dim=2)
+
+        # Lấy output ở bước thời gian cuối cùng rồi qua Linear của từng trạm
+        return torch.baddbmm(self.fc_bias.unsqueeze(1), h, self.fc_weight.transpose(1, 2))
@@ -20,22 +20,46 @@ import subprocess
 import datetime
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from model_registry import ModelRegistry
+import metrics
+import forecast_api
 
 # Lấy đường dẫn tuyệt đối của thư mục hiện tại (/app)
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Chu kỳ dự báo (giây) và độ trễ cho phép so với mốc :00/:15/:30/:45 trước khi tính là lỡ slot
+PREDICT_INTERVAL_SECONDS = 15 * 60
+SLOT_GRACE_SECONDS = int(os.getenv('SLOT_GRACE_SECONDS', '60'))
+# Dự báo bắt đầu sau mốc slot + deadline thì dữ liệu đã cũ -> bỏ, chờ slot sau
+PREDICT_DEADLINE_SECONDS = int(os.getenv('PREDICT_DEADLINE_SECONDS', '600'))
+# Slot tới khi lần dự báo trước chưa xong: 'catchup' = xếp hàng 1 lần chạy bù, 'skip' = bỏ luôn
+SLOT_POLICY = os.getenv('SLOT_POLICY', 'catchup')
+# Chia CPU: train (process con, nice thấp) và predict (trong worker) không giành core của nhau
+CPU_COUNT = os.cpu_count() or 2
+TRAIN_THREADS = int(os.getenv('TRAIN_THREADS', str(max(1, CPU_COUNT // 2))))
+PREDICT_THREADS = int(os.getenv('PREDICT_THREADS', str(max(1, CPU_COUNT - TRAIN_THREADS))))
+TRAIN_NICE = int(os.getenv('TRAIN_NICE', '10'))
+# Image lite (requirements-lite.txt, GNN_BACKEND=lite) không có torch -> chỉ dự báo, train chạy ở worker khác cùng registry
+TRAIN_ENABLED = os.getenv('TRAIN_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# 'event' = dự báo ngay khi mọi trạm đã có bước dữ liệu mới (Postgres LISTEN/NOTIFY), lịch cố định chỉ còn là
+# dự phòng và bỏ qua nếu dữ liệu không đổi | 'schedule' = chỉ chạy theo lịch cố định như cũ
+PREDICT_TRIGGER = os.getenv('PREDICT_TRIGGER', 'event')
+# Sau mỗi lần train: backtest GNN mới trên lịch sử gần đây, tệ hơn version trước thì đưa CURRENT về version cũ
+BACKTEST_GATE = os.getenv('BACKTEST_GATE', 'true').lower() not in ('0', 'false', 'no')
 
 # Cấu hình log: Ép flush ngay lập tức để thấy log trong Docker
 def log(message):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] [Worker-PID:{os.getpid()}] {message}", flush=True)
 
-def run_script(script_name):
+def run_script(script_name, env=None, nice=0, args=()):
     script_path = os.path.join(CURRENT_DIR, script_name)
     
     # Kiểm tra file có tồn tại không
     if not os.path.exists(script_path):
         log(f"❌ KHẨN CẤP: Không tìm thấy file {script_name} tại {script_path}")
-        return
+        return False
 
     log(f"▶️ Đang thực thi: {script_name} ...")
     start_time = time.time()
@@ -43,28 +67,236 @@ def run_script(script_name):
     try:
         # Sử dụng sys.executable để đảm bảo dùng đúng Python của môi trường hiện tại
         result = subprocess.run(
-            [sys.executable, "-u", script_path], 
+            [sys.executable, "-u", script_path, *args], 
             check=True,
-            cwd=CURRENT_DIR 
+            cwd=CURRENT_DIR,
+            env=env,
+            # Hạ độ ưu tiên CPU của process con (Linux) để không chèn slot dự báo
+            preexec_fn=(lambda: os.nice(nice)) if nice and hasattr(os, 'nice') else None
         )
         duration = round(time.time() - start_time, 2)
         log(f"✅ Hoàn tất {script_name} trong {duration}s.")
+        return True
         
     except subprocess.CalledProcessError as e:
         log(f"❌ Lỗi khi chạy {script_name} (Exit Code: {e.returncode})")
     except Exception as e:
         log(f"❌ Lỗi không xác định khi gọi {script_name}: {e}")
+    finally:
+        metrics.JOB_DURATION.observe(time.time() - start_time, job=os.path.splitext(script_name)[0])
+    return False
+
+# Bộ dự báo sống lâu trong process: chỉ import torch/PyG và load model 1 lần
+_predictor = None
+# Predict / train executor, listener NOTIFY đều có thể gọi get_predictor() lần đầu cùng lúc -> chỉ 1 thread khởi tạo
+_predictor_lock = threading.Lock()
+
+def get_predictor():
+    global _predictor
+    if _predictor is not None:
+        return _predictor
+    with _predictor_lock:
+        if _predictor is not None:
+            return _predictor
+        start_time = time.time()
+        from predict_gnn import GNNPredictor, GNN_BACKEND
+        if GNN_BACKEND != 'lite':
+            # Chế độ lite chạy bằng NumPy, không nạp torch
+            import torch
+            torch.set_num_threads(PREDICT_THREADS)
+        predictor = GNNPredictor()
+        # Nạp sẵn bộ đệm quan trắc (slot sau chỉ đọc phần mới); lỗi thì slot đầu tự nạp lại
+        try:
+            predictor.buffer.warm(predictor.engine)
+        except Exception as e:
+            log(f"⚠️ Chưa nạp được bộ đệm quan trắc: {e}")
+        # Theo dõi registry để hot reload model mới ở thread nền
+        predictor.start_watcher()
+        # Chỉ công bố sau khi đã khởi tạo xong (thread khác không thấy predictor dở dang)
+        _predictor = predictor
+        log(f"🧠 Đã khởi tạo GNNPredictor trong {round(time.time() - start_time, 2)}s.")
+    return _predictor
+
+def run_predict():
+    global _predicted_stamp
+    log("▶️ Đang thực thi: dự báo GNN (in-process) ...")
+    start_time = time.time()
+    ok = False
+    try:
+        predictor = get_predictor()
+        # Mốc dữ liệu được dự báo lần này (đọc trước khi fetch -> không bỏ sót bản ghi tới giữa chừng)
+        stamp = read_data_stamp(predictor) if _listener is not None else None
+        ok = predictor.run_slot() is not None
+        if ok and stamp is not None:
+            _predicted_stamp = stamp
+        duration = round(time.time() - start_time, 2)
+        log(f"✅ Hoàn tất dự báo GNN trong {duration}s.")
+    except Exception as e:
+        log(f"❌ Lỗi khi dự báo GNN: {e}")
+
+    duration = time.time() - start_time
+    metrics.JOB_DURATION.observe(duration, job='predict')
+    metrics.SLOTS.inc(job='predict', result='ok' if ok else 'error')
+    # Chạy lâu hơn 1 chu kỳ -> slot sau chắc chắn bị lỡ
+    if duration > PREDICT_INTERVAL_SECONDS:
+        metrics.SLOTS.inc(job='predict', result='overrun')
+        log(f"⚠️ Dự báo chạy {round(duration, 1)}s, vượt chu kỳ {PREDICT_INTERVAL_SECONDS}s.")
+
+# Mốc slot (epoch giây) của lần dự báo theo lịch gần nhất, để phát hiện slot bị bỏ qua
+_last_slot = None
+
+def account_slot(now=None):
+    """Ghi nhận slot bị lỡ: job chạy trễ hơn SLOT_GRACE_SECONDS hoặc có mốc bị nhảy qua."""
+    global _last_slot
+    now = now or time.time()
+    slot = now - now % PREDICT_INTERVAL_SECONDS
+    missed = 0
+    if _last_slot is not None and slot - _last_slot > PREDICT_INTERVAL_SECONDS:
+        missed += int((slot - _last_slot) // PREDICT_INTERVAL_SECONDS) - 1
+    if now - slot > SLOT_GRACE_SECONDS:
+        missed += 1
+        log(f"⚠️ Job dự báo chạy trễ {round(now - slot)}s so với mốc slot.")
+    if missed:
+        metrics.SLOTS.inc(missed, job='predict', result='missed')
+    _last_slot = slot
+    return slot
+
+# --- EXECUTOR RIÊNG CHO PREDICT VÀ TRAIN ---
+# Vòng lặp schedule chỉ nộp job rồi quay lại ngay, không bao giờ bị train (dài) chặn
+_predict_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='predict')
+_train_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='train')
+_state_lock = threading.Lock()
+_predict_running = False
+_predict_pending = None # (deadline,) của lần chạy bù đang chờ, tối đa 1
+_train_future = None
+
+def submit_predict(deadline=None):
+    """Nộp 1 lần dự báo. deadline (epoch giây) = hạn chót bắt đầu chạy, None = không giới hạn."""
+    global _predict_running, _predict_pending
+    with _state_lock:
+        if _predict_running:
+            if SLOT_POLICY == 'catchup':
+                # Gộp: chỉ giữ 1 lần chạy bù (mới nhất), dự báo luôn dùng dữ liệu mới nhất
+                _predict_pending = (deadline,)
+                log("⏳ Dự báo trước chưa xong -> xếp hàng 1 lần chạy bù.")
+            else:
+                metrics.SLOTS.inc(job='predict', result='skipped')
+                log("⏭️ Dự báo trước chưa xong -> bỏ qua slot này (SLOT_POLICY=skip).")
+            return
+        _predict_running = True
+    _predict_executor.submit(_predict_loop, deadline)
+
+def _predict_loop(deadline):
+    global _predict_running, _predict_pending
+    while True:
+        try:
+            if deadline is not None and time.time() > deadline:
+                metrics.SLOTS.inc(job='predict', result='skipped')
+                log(f"⏭️ Quá hạn chót slot ({PREDICT_DEADLINE_SECONDS}s sau mốc), bỏ qua lần dự báo này.")
+            else:
+                run_predict()
+        except Exception as e:
+            log(f"❌ Lỗi không xác định trong executor dự báo: {e}")
+        with _state_lock:
+            if _predict_pending is None:
+                _predict_running = False
+                return
+            (deadline,), _predict_pending = _predict_pending, None
+
+def run_training():
+    # Giới hạn số thread BLAS/OpenMP của process train theo TRAIN_THREADS
+    env = dict(os.environ)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[var] = str(TRAIN_THREADS)
+    registry = ModelRegistry('gnn')
+    before = registry.current_version()
+    ok = run_script("train_gnn.py", env=env, nice=TRAIN_NICE)
+    # train_gnn thoát 0 cả khi không publish (không có dữ liệu mới / quá ít dữ liệu) -> so CURRENT trước và sau
+    published = ok and registry.current_version() != before
+    metrics.SLOTS.inc(job='train', result=('ok' if published else 'unchanged') if ok else 'error')
+    if published and BACKTEST_GATE:
+        # Exit code != 0: model mới không qua cổng (đã rollback về `before` nếu tệ hơn) hoặc backtest lỗi
+        args = ('--gate', '--rollback') + (('--baseline-version', before) if before else ())
+        passed = run_script("backtest.py", env=env, nice=TRAIN_NICE, args=args)
+        metrics.SLOTS.inc(job='backtest', result='ok' if passed else 'rejected')
+    # Train xong thì nạp ngay version mới từ registry (không chờ watcher) rồi dự báo
+    if _predictor is not None:
+        try:
+            _predictor.check_for_update()
+        except Exception as e:
+            log(f"❌ Lỗi khi nạp model mới (giữ version cũ): {e}")
+    log("🔄 Train xong -> Chạy dự báo ngay lập tức...")
+    submit_predict()
+    # Lần đầu khởi động chưa có model: chỉ bật được chế độ event sau khi train xong
+    if PREDICT_TRIGGER == 'event' and _listener is None and ok:
+        start_event_trigger()
 
 def job_predict():
     log("🚀 [SCHEDULE] Kích hoạt Job Dự báo GNN (Theo mốc giờ cố định)...")
-    run_script("predict_gnn.py")
+    slot = account_slot()
+    # Chế độ event: lịch chỉ là dự phòng (NOTIFY bị lỡ, bước dữ liệu thiếu trạm) -> bỏ nếu không có gì mới
+    if _listener is not None and _predicted_stamp is not None:
+        try:
+            _, latest = read_data_stamp(get_predictor())
+        except Exception as e:
+            log(f"⚠️ Không đọc được mốc dữ liệu, vẫn dự báo: {e}")
+        else:
+            if latest is not None and latest <= _predicted_stamp[1]:
+                metrics.SLOTS.inc(job='predict', result='unchanged')
+                log(f"⏭️ Không có quan trắc mới kể từ lần dự báo trước ({latest}), bỏ qua slot.")
+                return
+    submit_predict(deadline=slot + PREDICT_DEADLINE_SECONDS)
+
+# --- DỰ BÁO THEO SỰ KIỆN (PREDICT_TRIGGER=event) ---
+_listener = None
+_predicted_stamp = None # (complete, latest) của dữ liệu ở lần dự báo thành công gần nhất
+_event_step = None # Bước đầy đủ gần nhất đã nộp dự báo từ sự kiện (tránh nộp lại khi lần trước chưa xong)
+
+def read_data_stamp(predictor):
+    from predict_gnn import HCMC_GRID
+    from obs_events import get_network_step
+    entity_ids = [f"urn:ngsi-ld:AirQualityStation:OWM-{p['id']}" for p in HCMC_GRID]
+    return get_network_step(predictor.engine, entity_ids)
+
+def on_observations(batch):
+    # Gọi ở thread listener sau mỗi đợt NOTIFY đã debounce
+    global _event_step
+    complete, _ = read_data_stamp(get_predictor())
+    if complete is None:
+        return
+    done = [step for step in (_event_step, _predicted_stamp and _predicted_stamp[0]) if step is not None]
+    if done and complete <= max(done):
+        if batch['notifications']:
+            log(f"⌛ [EVENT] {batch['rows']} bản ghi mới nhưng chưa đủ mọi trạm cho bước sau {max(done)}, chờ thêm.")
+        return
+    _event_step = complete
+    log(f"📥 [EVENT] Đủ bước dữ liệu mới cho mọi trạm ({complete}) -> dự báo.")
+    submit_predict(deadline=time.time() + PREDICT_DEADLINE_SECONDS)
+
+def start_event_trigger():
+    """Cài trigger NOTIFY và bắt đầu LISTEN. Trả về False nếu không được (giữ lịch cố định như cũ)."""
+    global _listener
+    from obs_events import ObservationListener, install_notify_trigger
+    try:
+        engine = get_predictor().engine
+    except Exception as e:
+        log(f"❌ Không khởi tạo được predictor cho chế độ event: {e}")
+        return False
+    if not install_notify_trigger(engine):
+        return False
+    _listener = ObservationListener(engine, on_observations).start()
+    return True
 
 def job_train():
+    global _train_future
     log("🏋️‍♀️ [SCHEDULE] Kích hoạt Job Train GNN (Chu kỳ hàng ngày)...")
-    run_script("train_gnn.py")
-    # Train xong thì dự báo lại ngay để cập nhật model mới
-    log("🔄 Train xong -> Chạy dự báo ngay lập tức...")
-    run_script("predict_gnn.py")
+    with _state_lock:
+        # Chỉ 1 lần train tại 1 thời điểm
+        if _train_future is not None and not _train_future.done():
+            metrics.SLOTS.inc(job='train', result='skipped')
+            log("⏭️ Lần train trước vẫn đang chạy, bỏ qua.")
+            return
+        _train_future = _train_executor.submit(run_training)
 
 # --- CẤU HÌNH LỊCH TRÌNH ---
 
@@ -76,13 +308,19 @@ schedule.every().hour.at(":30").do(job_predict)
 schedule.every().hour.at(":45").do(job_predict)
 
 # 2. Chạy Train mỗi ngày 1 lần vào lúc 02:00 sáng
-schedule.every().day.at("02:00").do(job_train)
+if TRAIN_ENABLED:
+    schedule.every().day.at("02:00").do(job_train)
 
 # --- KHỞI CHẠY ---
 
 if __name__ == "__main__":
     log("--- 🤖 AI WORKER KHỞI ĐỘNG (FIXED TIME SLOTS) ---")
+    log(f"🧵 CPU: predict {PREDICT_THREADS} thread, train {TRAIN_THREADS} thread (nice +{TRAIN_NICE}), SLOT_POLICY={SLOT_POLICY}, PREDICT_TRIGGER={PREDICT_TRIGGER}")
     log(f"📂 Thư mục làm việc: {CURRENT_DIR}")
+    if metrics.start_metrics_server():
+        log(f"📈 Metrics Prometheus: http://0.0.0.0:{metrics.METRICS_PORT}/metrics")
+    if forecast_api.start_forecast_api():
+        log(f"📡 API đọc dự báo: http://0.0.0.0:{forecast_api.FORECAST_API_PORT}/forecasts")
     
     # Kiểm tra các file quan trọng
     files = os.listdir(CURRENT_DIR)
@@ -92,13 +330,18 @@ if __name__ == "__main__":
         log(f"⚠️ Cảnh báo: File trong thư mục: {files}")
 
     # Chạy Train nhẹ 1 lần khi khởi động để đảm bảo có model (nếu chưa có)
-    if not os.path.exists(os.path.join(CURRENT_DIR, "gnn_model.pth")):
+    has_model = ModelRegistry('gnn').current_version() is not None \
+        or os.path.exists(os.path.join(CURRENT_DIR, "gnn_model.pth"))
+    if not has_model and TRAIN_ENABLED:
         log("⚠️ Chưa thấy model GNN, chạy Train lần đầu...")
         job_train()
+    elif PREDICT_TRIGGER == 'event' and start_event_trigger():
+        # Listener gọi on_observations ngay khi kết nối -> dự báo luôn nếu đã có dữ liệu
+        log("🔥 Chế độ event: dự báo khi có bước quan trắc mới, lịch cố định làm dự phòng.")
     else:
         # Nếu có model rồi thì chạy Predict luôn cho nóng
         log("🔥 Kích hoạt Predict ngay lập tức khi khởi động...")
-        job_predict()
+        submit_predict()
     
     log("⏳ Đang chờ đến mốc thời gian tiếp theo (:00, :15, :30, :45)...")
     
@@ -109,6 +352,10 @@ if __name__ == "__main__":
             time.sleep(1)
         except KeyboardInterrupt:
             log("🛑 Worker đang dừng...")
+            if _listener is not None:
+                _listener.stop()
+            _predict_executor.shutdown(wait=False)
+            _train_executor.shutdown(wait=False)
             break
         except Exception as e:
             log(f"❌ Lỗi trong vòng lặp chính: {e}")
@@ -0,0 +1,205 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Metrics của AI worker theo định dạng text của Prometheus (không cần thêm thư viện).
+# Worker mở endpoint http://<host>:METRICS_PORT/metrics ở thread nền.
+# Ghi metric chỉ là cộng số dưới 1 lock -> chi phí ~micro giây, để bật thường trực trên production.
+
+import os
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# Bucket (giây) phủ từ bước numpy ~1ms tới training vài phút
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: cần label {self.labelnames}, nhận {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        # Render trong lock để bucket/sum/count của histogram luôn nhất quán với nhau
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_only(self, value, **labels):
+        # Xóa mọi label cũ rồi đặt 1 giá trị (dùng cho metric dạng info, vd version model)
+        key = self._key(labels)
+        with self._lock:
+            self._values = {key: value}
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [đếm theo từng bucket (không cộng dồn), tổng, số lần]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames + ('le',), key + (_format_value(float(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# --- Metrics của pipeline dự báo ---
+STAGE_DURATION = REGISTRY.register(Histogram(
+    'aqi_predict_stage_duration_seconds', 'Thời gian từng bước của 1 slot dự báo', ('stage',)))
+ROWS_FETCHED = REGISTRY.register(Counter(
+    'aqi_predict_rows_fetched_total', 'Số bản ghi quan trắc đọc từ Postgres'))
+NODES_PREDICTED = REGISTRY.register(Counter(
+    'aqi_predict_nodes_total', 'Số trạm đã dự báo'))
+ORION_FAILURES = REGISTRY.register(Counter(
+    'aqi_orion_sync_failures_total', 'Số entity đồng bộ lên Orion bị lỗi'))
+ORION_ENTITIES = REGISTRY.register(Counter(
+    'aqi_orion_sync_entities_total', 'Số entity đã gửi lên Orion'))
+MODEL_INFO = REGISTRY.register(Gauge(
+    'aqi_model_info', 'Version model đang phục vụ (giá trị luôn 1)', ('model', 'version')))
+LAST_SUCCESS = REGISTRY.register(Gauge(
+    'aqi_predict_last_success_timestamp_seconds', 'Unix time của slot dự báo thành công gần nhất'))
+HISTORY_ROWS = REGISTRY.register(Counter(
+    'aqi_forecast_history_rows_total', 'Số dòng dự báo đã ghi vào bảng lịch sử air_quality_forecasts'))
+HISTORY_FAILURES = REGISTRY.register(Counter(
+    'aqi_forecast_history_failures_total', 'Số lần ghi lịch sử dự báo bị lỗi'))
+
+# --- Metrics của worker / lịch chạy ---
+SLOTS = REGISTRY.register(Counter(
+    'aqi_worker_slots_total', 'Số slot theo kết quả (ok | error | missed | overrun | skipped | unchanged | rejected)', ('job', 'result')))
+JOB_DURATION = REGISTRY.register(Histogram(
+    'aqi_worker_job_duration_seconds', 'Thời gian chạy của từng job', ('job',)))
+OBS_NOTIFICATIONS = REGISTRY.register(Counter(
+    'aqi_obs_notifications_total', 'Số NOTIFY quan trắc mới nhận được từ Postgres'))
+OBS_LISTENER_UP = REGISTRY.register(Gauge(
+    'aqi_obs_listener_up', '1 nếu worker đang LISTEN quan trắc mới (chế độ event)'))
+API_REQUESTS = REGISTRY.register(Counter(
+    'aqi_forecast_api_requests_total', 'Số request tới API đọc dự báo theo HTTP status', ('status',)))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Prometheus scrape liên tục -> không ghi access log
+        pass
+
+def start_metrics_server(port=METRICS_PORT, host='0.0.0.0'):
+    """Mở endpoint /metrics ở thread nền. Trả về server (hoặc None nếu tắt / không mở được port)."""
+    if not METRICS_ENABLED:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"⚠️ Không mở được metrics endpoint cổng {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,154 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Model registry trên file system:
+#   models/<name>/<version>/          artifact + manifest.json (checksum + metadata train)
+#   models/<name>/CURRENT             tên version đang chạy production (đổi bằng os.replace -> atomic)
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REGISTRY_DIR = os.getenv('MODEL_REGISTRY_DIR') or os.path.join(BASE_DIR, 'models')
+KEEP_VERSIONS = int(os.getenv('MODEL_KEEP_VERSIONS', '5'))
+MANIFEST_NAME = 'manifest.json'
+CURRENT_NAME = 'CURRENT'
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _fsync_dir(path):
+    # Đảm bảo rename đã xuống đĩa (bỏ qua trên hệ điều hành không hỗ trợ)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class ModelRegistry:
+    """Lưu các version model bất biến, publish bằng cách đổi con trỏ CURRENT một cách atomic."""
+
+    def __init__(self, name, root=REGISTRY_DIR):
+        self.name = name
+        self.dir = os.path.join(root, name)
+
+    def current_version(self):
+        try:
+            with open(os.path.join(self.dir, CURRENT_NAME)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def version_dir(self, version):
+        return os.path.join(self.dir, version)
+
+    def load_manifest(self, version, verify=True):
+        version_dir = self.version_dir(version)
+        with open(os.path.join(version_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        if verify:
+            for file_name, checksum in manifest['files'].items():
+                if sha256_file(os.path.join(version_dir, file_name)) != checksum:
+                    raise ValueError(f"Checksum không khớp: {self.name}/{version}/{file_name}")
+        return manifest
+
+    @contextmanager
+    def publishing(self, metadata=None):
+        """
+        Ghi artifact vào thư mục staging (yield đường dẫn), khi thoát khối with:
+        tính checksum, ghi manifest, rename thành version mới rồi đổi CURRENT.
+        Nếu có lỗi trong khối with thì staging bị xóa và CURRENT giữ nguyên.
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=self.dir)
+        try:
+            yield staging_dir
+            version = self._commit(staging_dir, metadata or {})
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        self.set_current(version)
+        self.prune()
+        print(f"📦 Đã publish {self.name} version {version}")
+
+    def _commit(self, staging_dir, metadata):
+        files = {}
+        for file_name in sorted(os.listdir(staging_dir)):
+            path = os.path.join(staging_dir, file_name)
+            with open(path, 'rb') as f:
+                os.fsync(f.fileno())
+            files[file_name] = sha256_file(path)
+
+        created_at = datetime.now(timezone.utc)
+        fingerprint = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:8]
+        version = f"{created_at.strftime('%Y%m%dT%H%M%SZ')}-{fingerprint}"
+        manifest = {
+            'name': self.name,
+            'version': version,
+            'created_at': created_at.isoformat(),
+            'files': files,
+            'metadata': metadata,
+        }
+        with open(os.path.join(staging_dir, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(staging_dir, self.version_dir(version))
+        _fsync_dir(self.dir)
+        return version
+
+    def set_current(self, version):
+        # Ghi con trỏ ra file tạm rồi os.replace: reader chỉ thấy version cũ hoặc mới, không bao giờ nửa vời
+        tmp_path = os.path.join(self.dir, f".{CURRENT_NAME}.tmp")
+        with open(tmp_path, 'w') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.dir, CURRENT_NAME))
+        _fsync_dir(self.dir)
+
+    def versions(self):
+        if not os.path.isdir(self.dir):
+            return []
+        return sorted(
+            v for v in os.listdir(self.dir)
+            if not v.startswith('.') and os.path.isfile(os.path.join(self.dir, v, MANIFEST_NAME))
+        )
+
+    def prune(self, keep=KEEP_VERSIONS):
+        # Xóa các version cũ, luôn giữ version CURRENT và version trước nó (đích rollback của cổng backtest)
+        current = self.current_version()
+        protected = {current}
+        if current is not None:
+            protected.add(self.load_manifest(current, verify=False).get('metadata', {}).get('previous_version'))
+        for version in self.versions()[:-keep]:
+            if version not in protected:
+                shutil.rmtree(self.version_dir(version), ignore_errors=True)
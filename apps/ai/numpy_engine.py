@@ -0,0 +1,186 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Inference thuần NumPy cho ST_GNN và AirQualityLSTM (chế độ "lite"):
+# không import torch / torch_geometric / sklearn lúc chạy, trọng số đọc từ file .npz
+# (ghi lúc train từ state_dict, cùng tên khóa như state_dict của PyTorch).
+
+import os
+import numpy as np
+
+LITE_GNN_FILE = 'gnn_model.npz'
+LITE_SCALER_FILE = 'gnn_scaler.npz'
+
+def _sigmoid(x):
+    # Dạng tanh: không tràn số với giá trị âm lớn như 1 / (1 + exp(-x))
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+def _to_numpy(value):
+    # Nhận Tensor (lúc export) hoặc ndarray mà không cần import torch
+    if hasattr(value, 'detach'):
+        value = value.detach().cpu().numpy()
+    return np.asarray(value)
+
+def lstm_last_hidden(x, layers):
+    """
+    LSTM nhiều lớp (thứ tự cổng i, f, g, o như nn.LSTM), trả về hidden state ở bước cuối của lớp cuối.
+    x: [S, B, T, F] - S bộ trọng số độc lập (S=1 khi mọi node dùng chung 1 LSTM).
+    layers: list dict 'w_ih' [S, 4H, in], 'w_hh' [S, 4H, H], 'b' [S, 4H] (= bias_ih + bias_hh).
+    """
+    num_sets, batch, seq_len, _ = x.shape
+    layer_input = x
+    for layer in layers:
+        hidden = layer['w_hh'].shape[-1]
+        # Chiếu input mọi bước thời gian 1 lần: [S, B*T, in] @ [S, in, 4H]
+        x_proj = np.matmul(layer_input.reshape(num_sets, batch * seq_len, -1), layer['w_ih_t'])
+        x_proj = x_proj.reshape(num_sets, batch, seq_len, 4 * hidden) + layer['b'][:, np.newaxis, np.newaxis, :]
+
+        h = np.zeros((num_sets, batch, hidden), dtype=x.dtype)
+        c = np.zeros((num_sets, batch, hidden), dtype=x.dtype)
+        outputs = []
+        for t in range(seq_len):
+            gates = x_proj[:, :, t] + np.matmul(h, layer['w_hh_t'])
+            i, f, g, o = np.split(gates, 4, axis=-1)
+            c = _sigmoid(f) * c + _sigmoid(i) * np.tanh(g)
+            h = _sigmoid(o) * np.tanh(c)
+            outputs.append(h)
+        layer_input = np.stack(outputs, axis=2)
+    return h
+
+def _lstm_layers(state_dicts, prefix='lstm.'):
+    # Xếp chồng trọng số nn.LSTM của S model theo trục đầu, chuyển vị sẵn để forward chỉ còn matmul
+    layers = []
+    layer = 0
+    while f'{prefix}weight_ih_l{layer}' in state_dicts[0]:
+        stack = lambda key: np.stack([_to_numpy(sd[f'{prefix}{key}_l{layer}']) for sd in state_dicts]).astype(np.float32)
+        w_ih, w_hh = stack('weight_ih'), stack('weight_hh')
+        layers.append({
+            'w_ih_t': np.ascontiguousarray(w_ih.transpose(0, 2, 1)),
+            'w_hh': w_hh,
+            'w_hh_t': np.ascontiguousarray(w_hh.transpose(0, 2, 1)),
+            'b': stack('bias_ih') + stack('bias_hh'),
+        })
+        layer += 1
+    return layers
+
+class MinMaxScalerLite:
+    """Thay sklearn MinMaxScaler lúc dự báo: x_scaled = x * scale_ + min_ (theo từng cột)."""
+
+    def __init__(self, min_, scale_):
+        self.min_ = np.asarray(min_, dtype=np.float64)
+        self.scale_ = np.asarray(scale_, dtype=np.float64)
+
+    def transform(self, X):
+        return np.asarray(X) * self.scale_ + self.min_
+
+    def inverse_transform(self, X):
+        return (np.asarray(X) - self.min_) / self.scale_
+
+class NumpyST_GNN:
+    """ST_GNN chế độ đồ thị tĩnh bằng NumPy: __call__(x [B*N, T, F]) -> [B*N, Horizons]."""
+
+    def __init__(self, weights):
+        self.num_nodes = int(weights['num_nodes'])
+        self.layers = _lstm_layers([weights])
+        self.gcn_weight_t = np.ascontiguousarray(weights['gcn.lin.weight'].T.astype(np.float32))
+        self.gcn_bias = weights['gcn.bias'].astype(np.float32)
+        self.fc_weight_t = np.ascontiguousarray(weights['fc.weight'].T.astype(np.float32))
+        self.fc_bias = weights['fc.bias'].astype(np.float32)
+        self.horizons = self.fc_bias.shape[0]
+        if 'adj' in weights:
+            self.adj = weights['adj'].astype(np.float32)
+        else:
+            # CSR (đồ thị lớn): mọi hàng đều có self-loop nên không có hàng rỗng
+            self.adj = None
+            self.adj_indptr = weights['adj_indptr']
+            self.adj_indices = weights['adj_indices']
+            self.adj_data = weights['adj_data'].astype(np.float32)
+
+    def propagate(self, h):
+        # h: [B, N, H] -> Â h cho từng snapshot
+        if self.adj is not None:
+            return np.matmul(self.adj, h)
+        messages = self.adj_data[np.newaxis, :, np.newaxis] * h[:, self.adj_indices]
+        return np.add.reduceat(messages, self.adj_indptr[:-1], axis=1)
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        h_last = lstm_last_hidden(x[np.newaxis], self.layers)[0]
+        h = (h_last @ self.gcn_weight_t).reshape(-1, self.num_nodes, self.gcn_weight_t.shape[1])
+        gcn_out = self.propagate(h).reshape(-1, self.gcn_weight_t.shape[1]) + self.gcn_bias
+        return np.maximum(gcn_out, 0.0) @ self.fc_weight_t + self.fc_bias
+
+class NumpyStackedLSTM:
+    """S model AirQualityLSTM (mỗi trạm 1 bộ trọng số) chạy chung: __call__(x [S, B, T, F]) -> [S, B, Output]."""
+
+    def __init__(self, state_dicts):
+        self.num_stations = len(state_dicts)
+        self.layers = _lstm_layers(state_dicts)
+        self.fc_weight_t = np.stack([_to_numpy(sd['fc.weight']).T for sd in state_dicts]).astype(np.float32)
+        self.fc_bias = np.stack([_to_numpy(sd['fc.bias']) for sd in state_dicts]).astype(np.float32)
+
+    def __call__(self, x):
+        h = lstm_last_hidden(np.asarray(x, dtype=np.float32), self.layers)
+        return np.matmul(h, self.fc_weight_t) + self.fc_bias[:, np.newaxis, :]
+
+# --- Ghi / đọc artifact .npz ---
+def _savez_atomic(path, **arrays):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def save_gnn_npz(path, model, dense_max_nodes=None):
+    """Ghi trọng số ST_GNN (đã set_graph) + Â ra .npz. Đồ thị lớn hơn dense_max_nodes lưu dạng CSR."""
+    arrays = {key: _to_numpy(value) for key, value in model.state_dict().items()}
+    arrays['num_nodes'] = np.array(model.num_nodes)
+    adj = model.adj
+    if getattr(adj, 'layout', None) is not None and str(adj.layout) == 'torch.sparse_csr':
+        arrays['adj_indptr'] = _to_numpy(adj.crow_indices())
+        arrays['adj_indices'] = _to_numpy(adj.col_indices())
+        arrays['adj_data'] = _to_numpy(adj.values())
+    else:
+        adj = _to_numpy(adj)
+        if dense_max_nodes is not None and adj.shape[0] > dense_max_nodes:
+            rows, cols = np.nonzero(adj)
+            arrays['adj_indptr'] = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=adj.shape[0]))])
+            arrays['adj_indices'] = cols
+            arrays['adj_data'] = adj[rows, cols]
+        else:
+            arrays['adj'] = adj
+    _savez_atomic(path, **arrays)
+
+def save_station_npz(path, state_dict, scaler):
+    """Ghi trọng số AirQualityLSTM + tham số MinMaxScaler của 1 trạm ra .npz."""
+    arrays = {key: _to_numpy(value) for key, value in state_dict.items()}
+    _savez_atomic(path, scaler_min=scaler.min_, scaler_scale=scaler.scale_, **arrays)
+
+def save_scaler_npz(path, scaler):
+    _savez_atomic(path, scaler_min=scaler.min_, scaler_scale=scaler.scale_)
+
+def load_scaler_npz(path):
+    with np.load(path) as data:
+        return MinMaxScalerLite(data['scaler_min'], data['scaler_scale'])
+
+def load_gnn_npz(path):
+    with np.load(path) as data:
+        return NumpyST_GNN({key: data[key] for key in data.files})
+
+def load_station_npz(path):
+    """Trả về (state_dict dạng ndarray, MinMaxScalerLite) của 1 trạm."""
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    scaler = MinMaxScalerLite(arrays.pop('scaler_min'), arrays.pop('scaler_scale'))
+    return arrays, scaler
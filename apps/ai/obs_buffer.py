@@ -0,0 +1,108 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Bộ đệm trong RAM: `window` bucket gần nhất (lưới data_access, cùng lưới lúc train) của từng trạm,
+# mảng (Trạm, Window) thứ tự Cũ -> Mới. Nạp đầy 1 lần từ DB (lưới đã nội suy trong SQL) rồi chỉ hỏi
+# trung bình các bucket từ bucket cuối trở đi; predictor dùng thẳng mảng này làm input (không tạo DataFrame).
+
+import os
+import time
+import threading
+import numpy as np
+from datetime import timezone
+from data_access import GRID_LEAD_BUCKETS, parse_interval, load_grid, fetch_bucket_means, fill_gaps
+
+# Nạp lại toàn bộ định kỳ: lưới nội suy lại từ đầu trong DB (sửa cả bản ghi tới trễ của bucket đã qua)
+OBS_BUFFER_REWARM_SECONDS = int(os.getenv('OBS_BUFFER_REWARM_SECONDS', str(6 * 3600)))
+
+def _to_datetime(value):
+    # datetime64 (UTC) -> datetime có tz
+    return value.astype('datetime64[us]').item().replace(tzinfo=timezone.utc)
+
+class StationRingBuffer:
+    """
+    means: trung bình theo bucket (Trạm, Capacity), NaN = bucket chưa có dữ liệu; values = means đã lấp khoảng trống.
+    Capacity = window + GRID_LEAD_BUCKETS: các bucket phía trước cửa sổ làm mốc nội suy.
+    Có bucket mới thì dịch cả mảng sang trái (mọi trạm chung 1 lưới thời gian; window nhỏ -> rẻ hơn giữ
+    con trỏ đầu + gom lại theo thứ tự), nhờ vậy cửa sổ luôn đúng thứ tự và đọc được trực tiếp không cần copy.
+    """
+
+    def __init__(self, entity_ids, window, freq):
+        self.entity_ids = list(entity_ids)
+        self.window = window
+        self.freq = freq
+        self.step = np.timedelta64(int(parse_interval(freq).total_seconds()), 's').astype('timedelta64[ns]')
+        self.capacity = window + GRID_LEAD_BUCKETS
+        self.means = np.full((len(self.entity_ids), self.capacity), np.nan)
+        self.values = self.means.copy()
+        self.last_bucket = None # datetime64[ns] UTC của cột cuối
+        self.latest_raw = None # datetime64[ns] UTC của bản ghi thô mới nhất
+        self.warmed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def latest_time(self):
+        return _to_datetime(self.latest_raw) if self.latest_raw is not None else None
+
+    def warm(self, engine):
+        """Nạp lại toàn bộ cửa sổ từ DB (lưới đã nội suy). Trả về số ô (bucket x trạm) đã đọc."""
+        times, grid, last_time = load_grid(engine, self.entity_ids, self.freq, last_buckets=self.capacity)
+        means = np.full_like(self.means, np.nan)
+        if len(times):
+            means[:, self.capacity - len(times):] = grid.T
+        with self._lock:
+            self.means = means
+            self.values = means.copy()
+            self.last_bucket = times[-1] if len(times) else None
+            self.latest_raw = last_time
+            self.warmed_at = time.monotonic()
+        return grid.size
+
+    def refresh(self, engine):
+        """Hỏi DB các bucket từ bucket cuối trở đi (nạp toàn bộ nếu chưa nạp / đến hạn nạp lại). Trả về số bucket đã đọc."""
+        if self.warmed_at is None or self.last_bucket is None \
+                or time.monotonic() - self.warmed_at > OBS_BUFFER_REWARM_SECONDS:
+            return self.warm(engine)
+        series = fetch_bucket_means(engine, self.entity_ids, self.freq, since=_to_datetime(self.last_bucket))
+        if not series:
+            return 0
+        with self._lock:
+            new_last = max(buckets[-1] for buckets, _, _ in series.values())
+            shift = int((new_last - self.last_bucket) // self.step)
+            if shift > 0:
+                # Dịch sang trái, các bucket mới để NaN cho tới khi có dữ liệu
+                self.means[:, :-shift] = self.means[:, shift:] if shift < self.capacity else np.nan
+                self.means[:, -shift:] = np.nan
+                self.last_bucket = new_last
+            rows = 0
+            for i, entity_id in enumerate(self.entity_ids):
+                if entity_id not in series:
+                    continue
+                buckets, means, last_times = series[entity_id]
+                cols = self.capacity - 1 - ((self.last_bucket - buckets) // self.step).astype(np.int64)
+                inside = cols >= 0
+                self.means[i, cols[inside]] = means[inside]
+                rows += len(buckets)
+                if self.latest_raw is None or last_times[-1] > self.latest_raw:
+                    self.latest_raw = last_times[-1]
+            self.values = fill_gaps(self.means.T).T
+        return rows
+
+    def view(self):
+        """(values, counts): view chỉ đọc của `window` bucket cuối (không copy) và số bucket có giá trị của từng trạm."""
+        values = self.values[:, -self.window:]
+        values.flags.writeable = False
+        return values, np.sum(~np.isnan(values), axis=1)
@@ -0,0 +1,107 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import numpy as np
+from datetime import timezone
+from data_access import fetch_bucket_means, to_grid, fill_gaps
+
+# Cache cục bộ dạng .npz (1 file / trạm / tần suất bucket)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.getenv('OBS_CACHE_DIR') or os.path.join(BASE_DIR, 'cache')
+# v2: lưu trung bình theo bucket do DB tính (data_access), không còn bản ghi thô phần đuôi
+CACHE_VERSION = 2
+
+class ObservationCache:
+    """
+    Cache trung bình PM2.5 theo bucket của từng trạm (chưa lấp khoảng trống).
+    Mỗi lần load chỉ hỏi DB các bucket từ bucket cuối đã cache trở đi (bucket cuối có thể chưa đủ dữ liệu
+    nên được tính lại), cho mọi trạm trong 1 truy vấn; nội suy khoảng trống làm lại trên lưới đã ghép.
+    """
+
+    def __init__(self, engine, freq, cache_dir=CACHE_DIR):
+        self.engine = engine
+        self.freq = freq
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, entity_id):
+        safe_id = entity_id.replace(':', '_')
+        return os.path.join(self.cache_dir, f"{safe_id}.{self.freq}.npz")
+
+    def _read_state(self, entity_id):
+        path = self._path(entity_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as f:
+                if int(f['version']) != CACHE_VERSION:
+                    return None
+                return f['buckets'].astype('datetime64[ns]'), f['values']
+        except Exception as e:
+            print(f"⚠️ Cache hỏng ({path}), tải lại toàn bộ: {e}")
+            return None
+
+    def _write_state(self, entity_id, buckets, values):
+        path = self._path(entity_id)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=CACHE_VERSION, buckets=buckets.astype(np.int64), values=values)
+        # Ghi file tạm rồi đổi tên -> không bao giờ đọc phải file ghi dở
+        os.replace(tmp_path, path)
+
+    def load_grid(self, entity_ids):
+        """
+        Lưới đều (Bucket x Trạm) đã nội suy: (bucket datetime64[ns] UTC [T], values [T, N]).
+        Trạm chưa có dữ liệu -> cột NaN; trước bản ghi đầu / sau bản ghi cuối của trạm -> NaN.
+        """
+        entity_ids = list(entity_ids)
+        states = {entity_id: self._read_state(entity_id) for entity_id in entity_ids}
+        cached = [state for state in states.values() if state is not None and len(state[0])]
+
+        since = None
+        if len(cached) == len(entity_ids):
+            # Mốc sớm nhất trong các bucket cuối của từng trạm: 1 truy vấn cho mọi trạm
+            since = min(state[0][-1] for state in cached).astype('datetime64[us]').item().replace(tzinfo=timezone.utc)
+        fetched = fetch_bucket_means(self.engine, entity_ids, self.freq, since=since)
+
+        series = {}
+        for entity_id in entity_ids:
+            state, new = states[entity_id], fetched.get(entity_id)
+            if since is None or state is None:
+                buckets, values = (new[0], new[1]) if new is not None else (None, None)
+            elif new is None:
+                buckets, values = state
+            else:
+                keep = state[0] < new[0][0]
+                buckets = np.concatenate([state[0][keep], new[0]])
+                values = np.concatenate([state[1][keep], new[1]])
+                print(f"   ➕ {entity_id}: {len(new[0])} bucket mới/tính lại (cache {self.freq})")
+            if buckets is None:
+                continue
+            if new is not None:
+                self._write_state(entity_id, buckets, values)
+            series[entity_id] = (buckets, values)
+
+        times, values = to_grid(series, entity_ids, self.freq)
+        # Như resample().interpolate() từng trạm rồi ghép: sau bản ghi cuối của trạm để NaN
+        return times, fill_gaps(values, hold_last=False)
+
+    def load(self, entity_id):
+        """(bucket datetime64[ns] [T], values [T]) đã nội suy của 1 trạm, None nếu trạm chưa có dữ liệu."""
+        times, values = self.load_grid([entity_id])
+        if not len(times):
+            return None
+        return times, values[:, 0]
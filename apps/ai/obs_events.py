@@ -0,0 +1,198 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Dự báo theo sự kiện: trigger trên air_quality_observations gửi NOTIFY sau mỗi câu lệnh INSERT,
+# worker LISTEN ở thread nền, gom các thông báo liên tiếp (debounce) rồi gọi callback 1 lần.
+# Bảng do TypeORM (aqi-service, synchronize) tạo nên trigger được worker tự cài lúc khởi động (idempotent).
+
+import os
+import json
+import time
+import select
+import threading
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text, bindparam
+import metrics
+
+OBS_CHANNEL = os.getenv('OBS_NOTIFY_CHANNEL', 'aqi_observations')
+# Chờ đến khi không có INSERT mới trong OBS_DEBOUNCE_SECONDS (agent ghi từng trạm 1 câu lệnh),
+# nhưng không chờ quá OBS_DEBOUNCE_MAX_SECONDS kể từ thông báo đầu tiên
+OBS_DEBOUNCE_SECONDS = float(os.getenv('OBS_DEBOUNCE_SECONDS', '10'))
+OBS_DEBOUNCE_MAX_SECONDS = float(os.getenv('OBS_DEBOUNCE_MAX_SECONDS', '120'))
+OBS_RECONNECT_SECONDS = float(os.getenv('OBS_RECONNECT_SECONDS', '30'))
+# Trạm không có dữ liệu trong khoảng này coi như ngừng hoạt động, không chặn bước thời gian của đồ thị
+OBS_STATION_LOOKBACK_HOURS = int(os.getenv('OBS_STATION_LOOKBACK_HOURS', '24'))
+
+# Trigger mức câu lệnh (1 NOTIFY cho cả batch INSERT) đọc bảng chuyển tiếp new_rows.
+# NOTIFY chỉ được gửi khi transaction commit, các payload trùng trong 1 transaction được gộp.
+NOTIFY_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION notify_air_quality_observations() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{OBS_CHANNEL}', (
+        SELECT json_build_object('rows', count(*), 'latest', max(time))::text
+        FROM new_rows WHERE pm2_5 IS NOT NULL
+    ));
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER air_quality_observations_notify
+    AFTER INSERT ON air_quality_observations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_air_quality_observations();
+"""
+
+# Bản ghi mới nhất của từng trạm (PK (time, entity_id) -> chỉ quét phần dữ liệu gần đây)
+NETWORK_LATEST_QUERY = text("""
+    SELECT entity_id, MAX(time)
+    FROM air_quality_observations
+    WHERE entity_id IN :entity_ids AND pm2_5 IS NOT NULL AND time >= :since
+    GROUP BY entity_id
+""").bindparams(bindparam('entity_ids', expanding=True))
+
+def install_notify_trigger(engine):
+    """Cài (hoặc cập nhật) trigger NOTIFY. Trả về False nếu không cài được (thiếu quyền, không phải Postgres...)."""
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(NOTIFY_TRIGGER_SQL)
+        return True
+    except Exception as e:
+        print(f"⚠️ Không cài được trigger NOTIFY trên air_quality_observations: {e}")
+        return False
+
+def _as_datetime(value):
+    # Postgres trả về datetime; SQLite (benchmark) trả về chuỗi ISO
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def get_network_step(engine, entity_ids, lookback_hours=OBS_STATION_LOOKBACK_HOURS):
+    """
+    Trả về (complete, latest) của đồ thị:
+    complete = mốc mới nhất mà mọi trạm còn hoạt động đều đã có dữ liệu (min theo trạm),
+    latest = bản ghi mới nhất của bất kỳ trạm nào. (None, None) nếu chưa có dữ liệu.
+    """
+    since = datetime.now(timezone.utc) - timedelta(hours=lookback_hours)
+    with engine.connect() as conn:
+        rows = conn.execute(NETWORK_LATEST_QUERY, {'entity_ids': list(entity_ids), 'since': since}).fetchall()
+    if not rows:
+        return None, None
+    times = [_as_datetime(row_time) for _, row_time in rows]
+    return min(times), max(times)
+
+class ObservationListener:
+    """
+    LISTEN kênh OBS_CHANNEL trên 1 kết nối psycopg2 riêng (không lấy từ pool của engine).
+    Mỗi đợt thông báo (đã debounce) gọi on_batch(summary) ở thread của listener, summary gồm
+    số thông báo / số bản ghi / mốc mới nhất của đợt. Mất kết nối -> tự kết nối lại và gọi on_batch
+    1 lần (thông báo trong lúc mất kết nối không được Postgres giữ lại).
+    """
+
+    def __init__(self, engine, on_batch, channel=OBS_CHANNEL,
+                 debounce=OBS_DEBOUNCE_SECONDS, max_wait=OBS_DEBOUNCE_MAX_SECONDS):
+        self.engine = engine
+        self.on_batch = on_batch
+        self.channel = channel
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.connected = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._first_at = None
+        self._last_at = None
+        self._batch = {'notifications': 0, 'rows': 0, 'latest': None}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='obs-listener', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _connect(self):
+        import psycopg2
+        conn = psycopg2.connect(**self.engine.url.translate_connect_args(username='user'))
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def add_notification(self, payload, now=None):
+        now = now if now is not None else time.monotonic()
+        if self._first_at is None:
+            self._first_at = now
+        self._last_at = now
+        self._batch['notifications'] += 1
+        metrics.OBS_NOTIFICATIONS.inc()
+        try:
+            data = json.loads(payload) if payload else {}
+        except ValueError:
+            data = {}
+        self._batch['rows'] += int(data.get('rows') or 0)
+        latest = data.get('latest')
+        if latest and (self._batch['latest'] is None or latest > self._batch['latest']):
+            self._batch['latest'] = latest
+
+    def flush_due(self, now=None):
+        """Số giây còn phải chờ trước khi flush đợt hiện tại (0 = flush ngay, None = không có gì chờ)."""
+        if self._first_at is None:
+            return None
+        now = now if now is not None else time.monotonic()
+        deadline = min(self._last_at + self.debounce, self._first_at + self.max_wait)
+        return max(0.0, deadline - now)
+
+    def flush(self):
+        batch = self._batch
+        self._reset_batch()
+        try:
+            self.on_batch(batch)
+        except Exception as e:
+            print(f"❌ Lỗi xử lý thông báo quan trắc mới: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                self.connected = True
+                metrics.OBS_LISTENER_UP.set(1)
+                print(f"👂 Đang LISTEN kênh '{self.channel}' (debounce {self.debounce:g}s, tối đa {self.max_wait:g}s).")
+                # Bắt kịp dữ liệu có thể đã tới lúc chưa / mất kết nối
+                self.flush()
+                while not self._stop.is_set():
+                    wait = self.flush_due()
+                    timeout = 1.0 if wait is None else min(wait, 1.0)
+                    if select.select([conn], [], [], timeout)[0]:
+                        conn.poll()
+                        for notify in conn.notifies:
+                            self.add_notification(notify.payload)
+                        conn.notifies.clear()
+                    if self.flush_due() == 0:
+                        self.flush()
+            except Exception as e:
+                print(f"⚠️ Listener quan trắc mất kết nối: {e}. Thử lại sau {OBS_RECONNECT_SECONDS:g}s.")
+            finally:
+                self.connected = False
+                metrics.OBS_LISTENER_UP.set(0)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            self._stop.wait(OBS_RECONNECT_SECONDS)
@@ -0,0 +1,81 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import json
+import requests
+from requests.adapters import HTTPAdapter
+
+ENTITIES_PATH = '/ngsi-ld/v1/entities'
+UPSERT_PATH = '/ngsi-ld/v1/entityOperations/upsert'
+# Số entity tối đa trong 1 request batch
+BATCH_SIZE = int(os.getenv('ORION_BATCH_SIZE', '100'))
+REQUEST_TIMEOUT = float(os.getenv('ORION_TIMEOUT', '10'))
+
+def orion_base_url(orion_url):
+    # ORION_LD_URL có nơi cấu hình là gốc (http://orion:1026), có nơi là .../ngsi-ld/v1/entities
+    url = (orion_url or '').rstrip('/')
+    if url.endswith(ENTITIES_PATH):
+        url = url[:-len(ENTITIES_PATH)]
+    return url
+
+class OrionClient:
+    """Đẩy entity lên Orion-LD qua batch upsert, dùng chung 1 HTTP session keep-alive."""
+
+    def __init__(self, orion_url, session=None, batch_size=BATCH_SIZE, timeout=REQUEST_TIMEOUT):
+        self.base_url = orion_base_url(orion_url)
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def upsert(self, entities):
+        """
+        Upsert (options=update: chỉ ghi đè các attribute gửi lên) theo từng chunk.
+        Trả về dict {entity_id: 'ok' | mô tả lỗi} cho từng entity.
+        """
+        statuses = {}
+        url = f"{self.base_url}{UPSERT_PATH}"
+        headers = { 'Content-Type': 'application/ld+json' }
+
+        for start in range(0, len(entities), self.batch_size):
+            chunk = entities[start:start + self.batch_size]
+            chunk_ids = [e['id'] for e in chunk]
+            try:
+                resp = self.session.post(
+                    url, params={'options': 'update'}, headers=headers,
+                    data=json.dumps(chunk), timeout=self.timeout
+                )
+            except Exception as e:
+                statuses.update({entity_id: str(e) for entity_id in chunk_ids})
+                continue
+
+            if resp.status_code in [200, 201, 204]:
+                # 201: có entity được tạo mới, 204: tất cả đã cập nhật
+                statuses.update({entity_id: 'ok' for entity_id in chunk_ids})
+            elif resp.status_code == 207:
+                # Multi-Status: {"success": [...ids], "errors": [{"entityId": ..., "error": {...}}]}
+                body = resp.json()
+                statuses.update({entity_id: 'ok' for entity_id in body.get('success', [])})
+                for err in body.get('errors', []):
+                    detail = err.get('error', {})
+                    statuses[err.get('entityId')] = detail.get('title') or detail.get('detail') or json.dumps(detail)
+            else:
+                statuses.update({entity_id: f"HTTP {resp.status_code}: {resp.text[:200]}" for entity_id in chunk_ids})
+
+        return statuses
@@ -16,55 +16,27 @@
 
 
 import os
-import pandas as pd
 import numpy as np
-import torch
-import torch.nn as nn
-import joblib
-import requests
-import json
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from datetime import datetime, timedelta
+from stations import HCMC_GRID # Danh sách trạm dùng chung (stations.json)
+from sqlalchemy import create_engine
+from datetime import datetime, timedelta, timezone
+from orion_sync import OrionClient
+from data_access import LSTM_GRID_FREQ, parse_interval, load_grid
+from numpy_engine import NumpyStackedLSTM, load_station_npz
 
 # 🚀 CẤU HÌNH ĐƯỜNG DẪN TUYỆT ĐỐI
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Danh sách 9 trạm
-HCMC_GRID = [
-  { 'id': 'ThuDuc', 'lat': 10.8231, 'lon': 106.7711 },
-  { 'id': 'District12', 'lat': 10.8672, 'lon': 106.6415 },
-  { 'id': 'HocMon', 'lat': 10.8763, 'lon': 106.5941 },
-  { 'id': 'District1', 'lat': 10.7769, 'lon': 106.7009 },
-  { 'id': 'BinhTan', 'lat': 10.7656, 'lon': 106.6031 },
-  { 'id': 'District2', 'lat': 10.7877, 'lon': 106.7407 },
-  { 'id': 'District7', 'lat': 10.734, 'lon': 106.7206 },
-  { 'id': 'BinhChanh', 'lat': 10.718, 'lon': 106.6067 },
-  { 'id': 'CanGio', 'lat': 10.518, 'lon': 106.8776 },
-]
+SEQ_LENGTH = 4 # 4 bucket 15 phút gần nhất (T-45, T-30, T-15, T)
+# Dùng model int8 của từng trạm (nếu mọi trạm đều có) thay cho model fp32 xếp chồng
+LSTM_QUANTIZED = os.getenv('LSTM_QUANTIZED', 'false').lower() in ('1', 'true', 'yes')
+# Chạy bằng engine NumPy từ file lstm_model_<id>.npz (không import torch / sklearn / joblib)
+LSTM_LITE = os.getenv('LSTM_LITE', 'false').lower() in ('1', 'true', 'yes')
 
-# ---------------------------------------------------------
-# 1. ĐỊNH NGHĨA LẠI MÔ HÌNH LSTM (PHẢI KHỚP 100% VỚI TRAIN)
-# ---------------------------------------------------------
-class AirQualityLSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, output_size=1):
-        super(AirQualityLSTM, self).__init__()
-        self.hidden_size = hidden_size
-        self.num_layers = num_layers
-        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
-        self.fc = nn.Linear(hidden_size, output_size)
-
-    def forward(self, x):
-        # Khởi tạo hidden state (h0) và cell state (c0)
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        
-        out, _ = self.lstm(x, (h0, c0))
-        out = self.fc(out[:, -1, :])
-        return out
 
 # ---------------------------------------------------------
-# 2. HÀM HỖ TRỢ
+# 1. HÀM HỖ TRỢ
 # ---------------------------------------------------------
 def get_db_engine():
     env_path = os.path.join(BASE_DIR, '..', '..', '.env')
@@ -85,30 +57,26 @@ def format_forecast_to_ngsi_ld(forecast_value, forecast_time, grid_point):
         "@context": ["https://smartdatamodels.org/context.jsonld"]
     }
 
-def sync_forecast_to_orion(orion_url, payload):
-    headers = { 'Content-Type': 'application/ld+json' }
-    try:
-        requests.post(orion_url, headers=headers, data=json.dumps(payload)).raise_for_status()
-        print(f"✅ Đã TẠO MỚI (POST): {payload['id']}")
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code in [409, 422]:
-            try:
-                patch_payload = { k: v for k, v in payload.items() if k not in ['id', 'type', '@context'] }
-                requests.patch(f"{orion_url}/{payload['id']}/attrs", headers={ 'Content-Type': 'application/json' }, data=json.dumps(patch_payload)).raise_for_status()
-                print(f"✅ Đã CẬP NHẬT (PATCH): {payload['id']}")
-            except Exception as pe: print(f"❌ Lỗi PATCH {payload['id']}: {pe}")
-        else: print(f"❌ Lỗi POST {payload['id']}: {e}")
-
-# ---------------------------------------------------------
-# 3. MAIN
-# ---------------------------------------------------------
-def main():
-    engine, orion_url = get_db_engine()
-    print(f"\n--- BẮT ĐẦU DỰ BÁO (LSTM - PyTorch) lúc {datetime.now()} ---")
-
-    for grid_point in HCMC_GRID:
+def sync_forecast_to_orion(orion_client, payloads):
+    # Batch upsert toàn bộ dự báo của lần chạy (thay cho POST rồi PATCH từng trạm)
+    statuses = orion_client.upsert(payloads)
+    for entity_id, status in statuses.items():
+        if status == 'ok': print(f"✅ Đã UPSERT: {entity_id}")
+        else: print(f"❌ Lỗi UPSERT {entity_id}: {status}")
+    return statuses
+
+
+def load_stacked_models(grid_points):
+    """Load LSTM + scaler của mọi trạm 1 lần, xếp chồng trọng số và tham số scaler thành mảng."""
+    if LSTM_LITE:
+        return load_lite_models(grid_points)
+
+    import torch
+    import joblib
+    from lstm_model import StackedAirQualityLSTM
+    points, state_dicts, scale, offset = [], [], [], []
+    for grid_point in grid_points:
         grid_id = grid_point['id']
-        
         # Đường dẫn file mô hình (.pth) và scaler (.joblib)
         model_path = os.path.join(BASE_DIR, f'lstm_model_{grid_id}.pth')
         scaler_path = os.path.join(BASE_DIR, f'scaler_{grid_id}.joblib')
@@ -118,59 +86,141 @@ def main():
             continue
 
         try:
-            # 1. Lấy dữ liệu 4 mốc thời gian gần nhất (T-45, T-30, T-15, T)
-            station_entity_id = f"urn:ngsi-ld:AirQualityStation:OWM-{grid_id}"
-            query = text(f"""
-                SELECT time, pm2_5 
-                FROM air_quality_observations 
-                WHERE entity_id = :id 
-                ORDER BY time DESC 
-                LIMIT 4
-            """)
-            with engine.connect() as conn:
-                df = pd.read_sql(query, conn, params={'id': station_entity_id})
-
-            if len(df) < 4:
-                print(f"⚠️ {grid_id}: Không đủ dữ liệu lịch sử (Cần 4, có {len(df)})")
-                continue
-            
-            # Thời gian dự báo = Mốc mới nhất + 15 phút
-            last_time = pd.to_datetime(df['time'].iloc[0])
-            forecast_time = last_time + timedelta(minutes=15)
-
-            # 2. Chuẩn bị Input cho LSTM
-            # Đảo ngược lại để đúng thứ tự thời gian: [Cũ -> Mới]
-            input_raw = df['pm2_5'].values[::-1].reshape(-1, 1)
-            
-            # Load Scaler và chuẩn hóa
+            state_dict = torch.load(model_path)
             scaler = joblib.load(scaler_path)
-            input_scaled = scaler.transform(input_raw)
-            
-            # Chuyển sang Tensor 3D: [Batch=1, Seq=4, Feature=1]
-            X_input = torch.from_numpy(input_scaled).float().unsqueeze(0)
+        except Exception as e:
+            print(f"❌ Lỗi tại {grid_id}: {e}")
+            continue
 
-            # 3. Load Model và Dự báo
-            # Tham số phải khớp với lúc train: input_size=1, hidden=32, layers=2
-            model = AirQualityLSTM(input_size=1, hidden_size=32, num_layers=2)
-            model.load_state_dict(torch.load(model_path))
-            model.eval() # Chế độ dự báo (không dropout/batchnorm)
+        points.append(grid_point)
+        state_dicts.append(state_dict)
+        # MinMaxScaler: x_scaled = x * scale_ + min_
+        scale.append(scaler.scale_[0])
+        offset.append(scaler.min_[0])
+
+    if not points:
+        return [], None, None, None
+
+    if LSTM_QUANTIZED:
+        model = load_quantized_models(points)
+        if model is not None:
+            return points, model, np.array(scale), np.array(offset)
+
+    # Tham số phải khớp với lúc train: input_size=1, hidden=32, layers=2
+    model = StackedAirQualityLSTM.from_state_dicts(state_dicts, input_size=1, hidden_size=32, num_layers=2)
+    model.eval() # Chế độ dự báo (không dropout/batchnorm)
+    return points, model, np.array(scale), np.array(offset)
+
+def load_lite_models(grid_points):
+    """Như load_stacked_models nhưng đọc lstm_model_<id>.npz (trọng số + scaler) cho engine NumPy."""
+    points, state_dicts, scale, offset = [], [], [], []
+    for grid_point in grid_points:
+        grid_id = grid_point['id']
+        model_path = os.path.join(BASE_DIR, f'lstm_model_{grid_id}.npz')
 
-            with torch.no_grad():
-                pred_scaled = model(X_input)
-                # Giải mã về giá trị thực
-                pred_value = scaler.inverse_transform(pred_scaled.numpy())[0][0]
+        if not os.path.exists(model_path):
+            print(f"⏩ Bỏ qua {grid_id}: Chưa có file .npz (Cần chạy train_model.py).")
+            continue
 
-            # Kẹp giá trị (Không âm)
-            forecast_value = max(0.0, float(pred_value))
+        try:
+            state_dict, scaler = load_station_npz(model_path)
+        except Exception as e:
+            print(f"❌ Lỗi tại {grid_id}: {e}")
+            continue
+
+        points.append(grid_point)
+        state_dicts.append(state_dict)
+        scale.append(scaler.scale_[0])
+        offset.append(scaler.min_[0])
+
+    if not points:
+        return [], None, None, None
+    return points, NumpyStackedLSTM(state_dicts), np.array(scale), np.array(offset)
+
+def predict_stations(model, X_input):
+    # X_input: ndarray [Trạm, Batch, Seq, Feature] -> ndarray [Trạm, Batch, Output]
+    if isinstance(model, NumpyStackedLSTM):
+        return model(X_input)
+    import torch
+    with torch.no_grad():
+        return model(torch.from_numpy(X_input)).numpy()
+
+def load_quantized_models(points):
+    """Nạp bản int8 của mọi trạm; thiếu bất kỳ trạm nào thì trả về None (dùng fp32)."""
+    from lstm_model import AirQualityLSTM, QuantizedStationLSTMs
+    from quantize import int8_path, load_quantized
+    models = []
+    for grid_point in points:
+        path = int8_path(os.path.join(BASE_DIR, f"lstm_model_{grid_point['id']}.pth"))
+        if not os.path.exists(path):
+            print(f"⚠️ {grid_point['id']}: Chưa có model int8, dùng model fp32 cho mọi trạm.")
+            return None
+        models.append(load_quantized(AirQualityLSTM(input_size=1, hidden_size=32, num_layers=2), path))
+    print(f"⚡ Dùng model int8 cho {len(models)} trạm.")
+    return QuantizedStationLSTMs(models).eval()
+
+def get_latest_station_windows(engine, grid_points, seq_length=SEQ_LENGTH):
+    """
+    Trả về (ma trận [Trạm, Seq] thứ tự Cũ -> Mới, số bucket có giá trị, mốc bucket mới nhất của từng trạm).
+    Cửa sổ là seq_length bucket cuối của lưới LSTM_GRID_FREQ (cùng lưới lúc train_model.py), nội suy trong DB.
+    """
+    entity_ids = [f"urn:ngsi-ld:AirQualityStation:OWM-{p['id']}" for p in grid_points]
+    times, values, _ = load_grid(engine, entity_ids, LSTM_GRID_FREQ, last_buckets=seq_length)
+
+    windows = np.full((len(grid_points), seq_length), np.nan)
+    if len(times):
+        windows[:, seq_length - len(times):] = values.T
+    counts = np.sum(~np.isnan(windows), axis=1)
+    # load_grid trả về mốc UTC không kèm tz -> gắn lại UTC để validFrom/validTo gửi lên Orion có múi giờ
+    last_bucket = times[-1].astype('datetime64[us]').item().replace(tzinfo=timezone.utc) if len(times) else None
+    return windows, counts, [last_bucket] * len(grid_points)
 
-            print(f"📊 {grid_id} (LSTM): {forecast_value:.2f} µg/m³ (Lúc {forecast_time.strftime('%H:%M')})")
+# ---------------------------------------------------------
+# 2. MAIN
+# ---------------------------------------------------------
+def main():
+    engine, orion_url = get_db_engine()
+    orion_client = OrionClient(orion_url)
+    print(f"\n--- BẮT ĐẦU DỰ BÁO (LSTM - PyTorch) lúc {datetime.now()} ---")
 
-            # 4. Đẩy lên Orion-LD
-            ngsi_ld_payload = format_forecast_to_ngsi_ld(forecast_value, forecast_time, grid_point)
-            sync_forecast_to_orion(orion_url, ngsi_ld_payload)
+    # 1. Load toàn bộ model 1 lần (trọng số xếp chồng theo trạm)
+    points, model, scale, offset = load_stacked_models(HCMC_GRID)
+    if not points:
+        print("--- HOÀN TẤT DỰ BÁO LSTM ---\n")
+        return
 
-        except Exception as e:
-            print(f"❌ Lỗi tại {grid_id}: {e}")
+    try:
+        # 2. Lấy dữ liệu 4 mốc thời gian gần nhất (T-45, T-30, T-15, T) của mọi trạm
+        windows, counts, last_times = get_latest_station_windows(engine, points)
+    except Exception as e:
+        print(f"❌ Lỗi lấy dữ liệu: {e}")
+        return
+
+    ready = counts == SEQ_LENGTH
+    for i in np.flatnonzero(~ready):
+        print(f"⚠️ {points[i]['id']}: Không đủ dữ liệu lịch sử (Cần {SEQ_LENGTH}, có {counts[i]})")
+
+    # 3. Chuẩn hóa vector hóa theo trạm rồi dự báo tất cả trong 1 lần forward
+    # Trạm thiếu dữ liệu vẫn chạy cùng batch (giá trị 0) nhưng bị loại khi publish
+    input_scaled = np.nan_to_num(windows) * scale[:, np.newaxis] + offset[:, np.newaxis]
+    # Tensor 4D: [Trạm, Batch=1, Seq=4, Feature=1]
+    X_input = input_scaled.astype(np.float32)[:, np.newaxis, :, np.newaxis]
+    pred_scaled = predict_stations(model, X_input)[:, 0, 0]
+    # Giải mã về giá trị thực, kẹp giá trị (Không âm)
+    forecast_values = np.maximum(0.0, (pred_scaled - offset) / scale)
+
+    # 4. Gom lại để đẩy lên Orion-LD 1 lần (batch)
+    payloads = []
+    for i in np.flatnonzero(ready):
+        grid_point = points[i]
+        # Thời gian dự báo = bucket kế tiếp (Mốc bucket mới nhất + 15 phút)
+        forecast_time = last_times[i] + parse_interval(LSTM_GRID_FREQ)
+        forecast_value = float(forecast_values[i])
+        print(f"📊 {grid_point['id']} (LSTM): {forecast_value:.2f} µg/m³ (Lúc {forecast_time.strftime('%H:%M')})")
+        payloads.append(format_forecast_to_ngsi_ld(forecast_value, forecast_time, grid_point))
+
+    if payloads:
+        sync_forecast_to_orion(orion_client, payloads)
 
     print("--- HOÀN TẤT DỰ BÁO LSTM ---\n")
 
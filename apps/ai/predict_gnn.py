@@ -15,32 +15,37 @@
 #
 
 import os
-import pandas as pd
+import time
+import threading
 import numpy as np
-import torch
-import joblib
 import requests
-import json
-from sqlalchemy import create_engine, text
+from contextlib import contextmanager
+from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from stations import HCMC_GRID # Danh sách trạm dùng chung (stations.json)
 from datetime import datetime, timedelta
-from gnn_model import ST_GNN
+from orion_sync import OrionClient
+from model_registry import ModelRegistry
+from obs_buffer import StationRingBuffer
+from data_access import GNN_GRID_FREQ, parse_interval
+from numpy_engine import LITE_GNN_FILE, LITE_SCALER_FILE, load_gnn_npz, load_scaler_npz
+import metrics
+import forecast_api
+from forecast_store import ForecastStore
+# torch / torch_geometric / sklearn chỉ được import khi backend cần (chế độ lite chạy thuần NumPy)
 
 # Cấu hình
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-HCMC_GRID = [
-  { 'id': 'ThuDuc', 'lat': 10.8231, 'lon': 106.7711 },
-  { 'id': 'District12', 'lat': 10.8672, 'lon': 106.6415 },
-  { 'id': 'HocMon', 'lat': 10.8763, 'lon': 106.5941 },
-  { 'id': 'District1', 'lat': 10.7769, 'lon': 106.7009 },
-  { 'id': 'BinhTan', 'lat': 10.7656, 'lon': 106.6031 },
-  { 'id': 'District2', 'lat': 10.7877, 'lon': 106.7407 },
-  { 'id': 'District7', 'lat': 10.734, 'lon': 106.7206 },
-  { 'id': 'BinhChanh', 'lat': 10.718, 'lon': 106.6067 },
-  { 'id': 'CanGio', 'lat': 10.518, 'lon': 106.8776 },
-]
 NUM_NODES = len(HCMC_GRID)
 SEQ_LENGTH = 4
+# Độ dài 1 bước dự báo (phút) = 1 bucket của lưới lúc train (GNN_GRID_FREQ)
+STEP_MINUTES = int(os.getenv('GNN_STEP_MINUTES', str(int(parse_interval(GNN_GRID_FREQ).total_seconds() // 60))))
+# Backend chạy model: auto (TorchScript nếu version có artifact, không thì eager) | eager | torchscript | onnx
+# | int8 (eager lượng tử hóa động, quay về fp32 nếu version không có artifact int8)
+# | lite (NumPy thuần, không cần torch - xem numpy_engine.py)
+GNN_BACKEND = os.getenv('GNN_BACKEND', 'auto')
+# Chu kỳ kiểm tra registry để hot reload model mới (giây)
+MODEL_POLL_SECONDS = int(os.getenv('MODEL_POLL_SECONDS', '60'))
 
 def get_db_engine():
     # Load .env từ thư mục gốc (nếu có)
@@ -66,46 +71,32 @@ def get_db_engine():
     else:
         print(f"🌍 Orion URL: {orion_url}")
 
-    return create_engine(db_url), orion_url
+    # pool_pre_ping: engine sống lâu trong worker, kết nối cũ có thể bị Postgres đóng
+    return create_engine(db_url, pool_pre_ping=True, pool_size=2, max_overflow=2), orion_url
+
+def network_input(buffer):
+    """Input (Nodes, Seq, 1) + mốc dữ liệu mới nhất từ bộ đệm. Đủ lịch sử -> view của bộ đệm (không copy)."""
+    data_matrix, counts = buffer.view()
+    if counts.min() < SEQ_LENGTH:
+        # Trạm thiếu lịch sử: fill tạm bằng giá trị cũ nhất đang có (hoặc 30.0 nếu trống) để không crash
+        oldest = data_matrix[np.arange(NUM_NODES), np.minimum(SEQ_LENGTH - counts, SEQ_LENGTH - 1)]
+        oldest = np.where(counts > 0, oldest, 30.0)
+        data_matrix = np.where(np.isnan(data_matrix), oldest[:, np.newaxis], data_matrix)
+
+    # Lấy thời gian của bản ghi mới nhất để làm mốc dự báo
+    latest_time = buffer.latest_time or datetime.now()
+    return data_matrix[..., np.newaxis], latest_time
+
+def new_network_buffer():
+    entity_ids = [f"urn:ngsi-ld:AirQualityStation:OWM-{p['id']}" for p in HCMC_GRID]
+    # Cùng lưới bucket với lúc train (train_gnn.load_data_from_db)
+    return StationRingBuffer(entity_ids, SEQ_LENGTH, GNN_GRID_FREQ)
 
 def get_latest_network_data(engine):
-    data_matrix = [] 
-    latest_time = None
-
-    for grid_point in HCMC_GRID:
-        # Lấy dữ liệu mới nhất
-        query = text(f"""
-            SELECT time, pm2_5 
-            FROM air_quality_observations 
-            WHERE entity_id = 'urn:ngsi-ld:AirQualityStation:OWM-{grid_point['id']}' 
-            ORDER BY time DESC 
-            LIMIT {SEQ_LENGTH}
-        """)
-        with engine.connect() as conn:
-            df = pd.read_sql(query, conn)
-        
-        if len(df) < SEQ_LENGTH:
-            # Fill tạm để không crash (Dùng dòng cuối nhân bản)
-            needed = SEQ_LENGTH - len(df)
-            for _ in range(needed):
-                val = df.iloc[-1]['pm2_5'] if len(df) > 0 else 30.0
-                new_row = pd.DataFrame([{'time': datetime.now(), 'pm2_5': val}])
-                df = pd.concat([df, new_row], ignore_index=True)
-        
-        # Đảo ngược để đúng thứ tự thời gian (Cũ -> Mới) cho LSTM/GNN
-        values = df['pm2_5'].values[::-1]
-        data_matrix.append(values)
-        
-        # Lấy thời gian của bản ghi mới nhất để làm mốc dự báo
-        if len(df) > 0:
-            current_node_time = pd.to_datetime(df['time'].iloc[0])
-            if latest_time is None or current_node_time > latest_time:
-                latest_time = current_node_time
-
-    if latest_time is None:
-        latest_time = datetime.now()
-
-    return np.array(data_matrix)[..., np.newaxis], latest_time
+    # Đọc 1 lần (CLI): nạp bộ đệm tạm rồi lấy input
+    buffer = new_network_buffer()
+    metrics.ROWS_FETCHED.inc(buffer.warm(engine))
+    return network_input(buffer)
 
 def get_next_30min_slot():
     now = datetime.now()
@@ -120,14 +111,15 @@ def get_next_30min_slot():
     target_time = target_time.replace(second=0, microsecond=0)
     return target_time
 
-def sync_to_orion(orion_url, grid_point, value, last_db_time):
-    # 1. Entity DỰ BÁO (Forecast)
+def build_orion_entities(grid_point, value, last_db_time, forecast_time, horizon=1):
+    # 1. Entity DỰ BÁO (Forecast): bước 1 giữ id cũ, các bước sau có hậu tố -H<n>
     forecast_id = f"urn:ngsi-ld:AirQualityForecast:OWM-{grid_point['id']}"
+    if horizon > 1:
+        forecast_id += f"-H{horizon}"
+    valid_to = forecast_time + timedelta(minutes=STEP_MINUTES)
     # 2. Entity QUAN TRẮC (Observed) - Để Route Planner dùng cái này vẽ đường
     observed_id = f"urn:ngsi-ld:AirQualityStation:OWM-{grid_point['id']}"
     
-    forecast_time = get_next_30min_slot()
-    
     # Payload chung
     common_data = {
         "pm25": { "type": "Property", "value": round(float(value), 2), "unitCode": "µg/m³" },
@@ -142,6 +134,8 @@ def sync_to_orion(orion_url, grid_point, value, last_db_time):
         "type": "AirQualityForecast",
         "location": common_data["location"],
         "validFrom": { "type": "Property", "value": { "@type": "DateTime", "@value": forecast_time.isoformat() } },
+        "validTo": { "type": "Property", "value": { "@type": "DateTime", "@value": valid_to.isoformat() } },
+        "forecastHorizon": { "type": "Property", "value": horizon },
         "forecastedPM25": { "type": "Property", "value": common_data["pm25"]["value"], "unitCode": "µg/m³" },
         "observationDateTime": { "type": "Property", "value": { "@type": "DateTime", "@value": last_db_time.isoformat() } }, 
         "@context": common_data["@context"]
@@ -159,65 +153,255 @@ def sync_to_orion(orion_url, grid_point, value, last_db_time):
         "@context": common_data["@context"]
     }
     
-    headers = { 'Content-Type': 'application/ld+json' }
-    
-    # Hàm gửi request
-    def send_request(payload, entity_id):
+    # Entity quan trắc chỉ nhận giá trị của bước gần nhất
+    if horizon > 1:
+        return [payload_forecast]
+    return [payload_forecast, payload_observed]
+
+def sync_to_orion(orion_client, entities):
+    # Gửi toàn bộ entity của 1 lần dự báo qua batch upsert thay vì 2 request nối tiếp / node
+    statuses = orion_client.upsert(entities)
+    failed = {entity_id: err for entity_id, err in statuses.items() if err != 'ok'}
+    metrics.ORION_ENTITIES.inc(len(entities))
+    metrics.ORION_FAILURES.inc(len(failed))
+    for entity_id, err in failed.items():
+        print(f"⚠️ Lỗi Sync {entity_id}: {err}")
+    print(f"✅ [GNN] Đồng bộ {len(statuses) - len(failed)}/{len(entities)} entity lên Orion")
+    return statuses
+
+@contextmanager
+def _stage(timings, name):
+    # Đo thời gian một bước (ms), ghi vào dict timings và histogram /metrics
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings[name] = elapsed * 1000
+        metrics.STAGE_DURATION.observe(elapsed, stage=name)
+
+class GNNBundle:
+    """Model + scaler + graph của cùng 1 version, luôn được thay thế nguyên khối."""
+
+    def __init__(self, version, model, scaler, edge_index, edge_weight, runner=None, backend='eager'):
+        self.version = version
+        self.model = model
+        # Artifact biên dịch sẵn (đã gắn đồ thị bên trong); None = chạy model eager
+        self.runner = runner
+        self.backend = backend
+        # Số bước dự báo suy ra từ trọng số lớp output (model cũ = 1)
+        self.horizons = runner.horizons if runner is not None else model.fc.out_features
+        self.scaler = scaler
+        self.edge_index = edge_index
+        self.edge_weight = edge_weight
+
+    def predict(self, input_data):
+        # input: ndarray (Nodes, Seq, 1) float32 -> out: ndarray (Nodes, Horizons)
+        if self.runner is not None:
+            return self.runner(input_data)
+        import torch
+        with torch.no_grad():
+            return self.model(torch.from_numpy(input_data)).numpy()
+
+def _resolve_backend(artifact_dir, backend):
+    if backend == 'lite' and not os.path.exists(os.path.join(artifact_dir, LITE_GNN_FILE)):
+        print(f"⚠️ Không có artifact {LITE_GNN_FILE} trong {artifact_dir}, dùng eager (cần torch).")
+        return 'eager'
+    if backend != 'auto':
+        return backend
+    from export_model import TORCHSCRIPT_FILE
+    return 'torchscript' if os.path.exists(os.path.join(artifact_dir, TORCHSCRIPT_FILE)) else 'eager'
+
+def load_gnn_bundle(registry, version=None, backend=GNN_BACKEND):
+    version = version or registry.current_version()
+    if version is None:
+        # Registry chưa có version nào -> dùng artifact cũ nằm cạnh script
+        artifact_dir, version = BASE_DIR, 'legacy'
+    else:
+        # Kiểm tra checksum trước khi nạp: không bao giờ dùng cặp model/scaler lệch nhau
+        manifest = registry.load_manifest(version, verify=True)
+        # Node i của model phải là trạm HCMC_GRID[i] (version cũ không ghi station_ids thì bỏ qua)
+        station_ids = manifest.get('metadata', {}).get('station_ids')
+        if station_ids is not None and station_ids != [p['id'] for p in HCMC_GRID]:
+            raise ValueError(f"Version {version} được train với thứ tự trạm khác stations.json, cần train lại")
+        artifact_dir = registry.version_dir(version)
+
+    backend = _resolve_backend(artifact_dir, backend)
+    if backend == 'lite':
+        # Trọng số + Â + tham số scaler đều nằm trong .npz
+        scaler = load_scaler_npz(os.path.join(artifact_dir, LITE_SCALER_FILE))
+        return GNNBundle(version, None, scaler, None, None, load_gnn_npz(os.path.join(artifact_dir, LITE_GNN_FILE)), backend)
+
+    import torch
+    import joblib
+    from export_model import load_runner
+    from quantize import int8_path, load_quantized
+    scaler = joblib.load(os.path.join(artifact_dir, 'gnn_scaler.joblib'))
+    edge_index, edge_weight = torch.load(os.path.join(artifact_dir, 'graph_structure.pt'))
+
+    model_path = os.path.join(artifact_dir, 'gnn_model.pth')
+    if backend == 'int8' and not os.path.exists(int8_path(model_path)):
+        print(f"⚠️ Version {version} không có artifact int8 (chưa qua cổng sai số?), dùng fp32.")
+        backend = 'eager'
+    if backend not in ('eager', 'int8'):
+        # TorchScript/ONNX không cần torch_geometric lúc chạy
+        return GNNBundle(version, None, scaler, edge_index, edge_weight, load_runner(artifact_dir, backend), backend)
+
+    from gnn_model import ST_GNN
+    state_dict = torch.load(model_path)
+    model = ST_GNN(num_nodes=NUM_NODES, input_dim=1, hidden_dim=16, output_dim=state_dict['fc.weight'].shape[0])
+    model.load_state_dict(state_dict)
+    model.eval()
+    if backend == 'int8':
+        model = load_quantized(model, int8_path(model_path))
+    # Chuẩn hóa đồ thị 1 lần cho cả vòng đời version này
+    model.set_graph(edge_index, edge_weight)
+    return GNNBundle(version, model, scaler, edge_index, edge_weight, backend=backend)
+
+class GNNPredictor:
+    """Bộ dự báo sống lâu trong worker: load model/scaler/graph 1 lần, giữ DB pool và HTTP session."""
+
+    def __init__(self, registry=None, engine=None, orion_url=None, backend=GNN_BACKEND):
+        if engine is None:
+            engine, default_orion_url = get_db_engine()
+            orion_url = orion_url or default_orion_url
+        self.engine, self.orion_url = engine, orion_url
+        self.session = requests.Session()
+        self.orion = OrionClient(self.orion_url, session=self.session)
+        self.registry = registry or ModelRegistry('gnn')
+        self.backend = backend
+        self.bundle = None
+        # SEQ_LENGTH bucket gần nhất của từng trạm, nạp ở slot đầu rồi chỉ đọc phần mới
+        self.buffer = new_network_buffer()
+        # Lịch sử mọi lần dự báo (bảng air_quality_forecasts), Orion chỉ giữ bản mới nhất
+        self.history = ForecastStore(self.engine)
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self.load_artifacts()
+
+    def load_artifacts(self, version=None):
+        start = time.perf_counter()
+        bundle = load_gnn_bundle(self.registry, version, self.backend)
+        # Gán 1 lần (atomic): slot đang chạy vẫn giữ bundle cũ cho tới khi xong
+        self.bundle = bundle
+        metrics.MODEL_INFO.set_only(1, model='gnn', version=bundle.version)
+        print(f"📦 Đã nạp model/scaler/graph (version {bundle.version}, backend {bundle.backend}) trong {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def check_for_update(self):
+        """Nạp version mới nếu CURRENT trong registry đã đổi. Trả về True nếu đã đổi model."""
+        # Đang có thread khác nạp rồi thì bỏ qua, không chờ
+        if not self._reload_lock.acquire(blocking=False):
+            return False
         try:
-            # Thử Patch trước
-            patch_url = f"{orion_url}/ngsi-ld/v1/entities/{entity_id}/attrs"
-            resp = requests.post(patch_url, headers=headers, data=json.dumps({k:v for k,v in payload.items() if k not in ['id', 'type']}))
-            
-            if resp.status_code not in [204, 200]:
-                # Nếu Patch lỗi (do chưa có), thì POST tạo mới
-                requests.post(f"{orion_url}/ngsi-ld/v1/entities", headers=headers, data=json.dumps(payload))
+            version = self.registry.current_version()
+            if version is None or version == self.bundle.version:
+                return False
+            print(f"🔄 Phát hiện model mới {version} (đang chạy {self.bundle.version}), nạp nền...")
+            self.load_artifacts(version)
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def start_watcher(self, interval=MODEL_POLL_SECONDS):
+        # Thread nền theo dõi registry: nạp model mới mà không chặn slot dự báo, không cần restart worker
+        if self._watcher is not None:
+            return
+        def watch():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_for_update()
+                except Exception as e:
+                    print(f"⚠️ Lỗi khi nạp model mới (giữ version cũ): {e}")
+        self._watcher = threading.Thread(target=watch, name='gnn-model-watcher', daemon=True)
+        self._watcher.start()
+
+    # --- Các bước của 1 slot (tách riêng để đo/benchmark từng bước) ---
+    def fetch(self):
+        metrics.ROWS_FETCHED.inc(self.buffer.refresh(self.engine))
+        return network_input(self.buffer)
+
+    def preprocess(self, bundle, raw_data):
+        # (Nodes, Seq, 1) -> scaler theo trạm -> float32 (Nodes, Seq, 1)
+        input_2d = raw_data.squeeze(-1).T
+        input_scaled = bundle.scaler.transform(input_2d)
+        return np.ascontiguousarray(input_scaled.T[..., np.newaxis], dtype=np.float32)
+
+    def forward(self, bundle, input_data):
+        return bundle.predict(input_data)
+
+    def inverse_scale(self, bundle, out):
+        # out: (Nodes, Horizons) -> mỗi hàng (1 bước) là 1 vector trạm cho scaler
+        pred_actual = bundle.scaler.inverse_transform(out.T)
+        return np.maximum(pred_actual, 0.0)
+
+    def build_entities(self, pred_actual, last_time, forecast_time=None):
+        forecast_time = forecast_time or get_next_30min_slot()
+        entities = []
+        for h, step_values in enumerate(pred_actual):
+            # Bước h+1 có validFrom/validTo riêng
+            valid_from = forecast_time + timedelta(minutes=STEP_MINUTES * h)
+            for i, val in enumerate(step_values):
+                entities.extend(build_orion_entities(HCMC_GRID[i], val, last_time, valid_from, horizon=h + 1))
+        return entities
+
+    def run_slot(self):
+        # Giữ tham chiếu bundle trong suốt slot (hot reload không làm lệch model/scaler giữa chừng)
+        bundle = self.bundle
+        print(f"\n--- BẮT ĐẦU DỰ BÁO (Next 30m Slot, model {bundle.version}) ---")
+        timings = {}
+        try:
+            with _stage(timings, 'total'):
+                # Lấy dữ liệu
+                with _stage(timings, 'fetch'):
+                    raw_data, last_time = self.fetch()
+
+                # Chuẩn hóa
+                with _stage(timings, 'scale'):
+                    input_tensor = self.preprocess(bundle, raw_data)
+
+                # Predict
+                with _stage(timings, 'forward'):
+                    out = self.forward(bundle, input_tensor)
+
+                # Inverse Scale
+                with _stage(timings, 'inverse'):
+                    pred_actual = self.inverse_scale(bundle, out)
+
+                # Snapshot cho API đọc dự báo (forecast_api), đổi ngay khi có kết quả, không chờ Orion
+                forecast_time = get_next_30min_slot()
+                with _stage(timings, 'publish'):
+                    forecast_api.publish(forecast_api.build_snapshot(
+                        HCMC_GRID, pred_actual, last_time, forecast_time, STEP_MINUTES, bundle.version))
+
+                # Lưu lịch sử (1 COPY / lần chạy), lỗi chỉ cảnh báo, vẫn đồng bộ Orion
+                with _stage(timings, 'persist'):
+                    self.history.write_run(bundle.version, HCMC_GRID, pred_actual, last_time, forecast_time, STEP_MINUTES)
+
+                # Sync
+                with _stage(timings, 'sync'):
+                    print(f"🕒 Dữ liệu đầu vào: {last_time}")
+                    for i, grid_point in enumerate(HCMC_GRID):
+                        print(f"📊 [GNN] {grid_point['id']} -> {[round(float(v), 2) for v in pred_actual[:, i]]}")
+                    sync_to_orion(self.orion, self.build_entities(pred_actual, last_time, forecast_time))
+
         except Exception as e:
-            print(f"⚠️ Lỗi Sync {entity_id}: {e}")
+            print(f"❌ Lỗi dự báo: {e}")
+            return None
 
-    send_request(payload_forecast, forecast_id)
-    send_request(payload_observed, observed_id)
-    
-    print(f"✅ [GNN] Đồng bộ {grid_point['id']} -> {payload_forecast['forecastedPM25']['value']}")
+        metrics.NODES_PREDICTED.inc(pred_actual.shape[1])
+        metrics.LAST_SUCCESS.set(time.time())
+        print("⏱️ Thời gian từng bước: " + ", ".join(f"{k}={v:.1f}ms" for k, v in timings.items()))
+        return timings
 
-# ... (Hàm main giữ nguyên logic load model) ...
 def main():
-    engine, orion_url = get_db_engine()
-    print(f"\n--- BẮT ĐẦU DỰ BÁO (Next 30m Slot) ---")
-
+    # Chạy lẻ 1 lần (CLI). Worker dùng trực tiếp GNNPredictor để không phải load lại.
     try:
-        # Load Model
-        model = ST_GNN(num_nodes=NUM_NODES, input_dim=1, hidden_dim=16, output_dim=1)
-        model.load_state_dict(torch.load(os.path.join(BASE_DIR, 'gnn_model.pth')))
-        model.eval()
-        
-        scaler = joblib.load(os.path.join(BASE_DIR, 'gnn_scaler.joblib'))
-        edge_index, edge_weight = torch.load(os.path.join(BASE_DIR, 'graph_structure.pt'))
-
-        # Lấy dữ liệu
-        raw_data, last_time = get_latest_network_data(engine)
-        
-        # Chuẩn hóa
-        input_2d = raw_data.squeeze().T 
-        input_scaled = scaler.transform(input_2d)
-        input_tensor = torch.tensor(input_scaled.T[..., np.newaxis], dtype=torch.float)
-
-        # Predict
-        with torch.no_grad():
-            out = model(input_tensor, edge_index, edge_weight)
-            
-        # Inverse Scale
-        pred_dummy = np.zeros((1, NUM_NODES))
-        pred_dummy[0] = out.squeeze().numpy()
-        pred_actual = scaler.inverse_transform(pred_dummy)[0]
-
-        # Sync
-        print(f"🕒 Dữ liệu đầu vào: {last_time}")
-        for i, val in enumerate(pred_actual):
-            val = max(0.0, val) 
-            sync_to_orion(orion_url, HCMC_GRID[i], val, last_time)
-
+        predictor = GNNPredictor()
     except Exception as e:
         print(f"❌ Lỗi dự báo: {e}")
+        return
+    predictor.run_slot()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,98 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Lượng tử hóa động int8 (nn.LSTM / nn.Linear) cho inference trên CPU.
+# Artifact int8 (<tên>.int8.pth) được lưu cạnh bản fp32 lúc train, chỉ khi qua cổng sai số:
+# MAE (µg/m³) của int8 trên cửa sổ holdout (phần validation không dùng để train) không được tệ hơn fp32
+# quá QUANT_MAE_TOLERANCE.
+# Không qua cổng -> không lưu int8, predictor tự dùng fp32.
+
+import io
+import os
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+QUANTIZE_MODELS = os.getenv('QUANTIZE_MODELS', 'true').lower() not in ('0', 'false', 'no')
+# MAE int8 được phép lớn hơn fp32 tối đa 2% (cộng sai số tuyệt đối 0.05 µg/m³ cho model rất tốt)
+QUANT_MAE_TOLERANCE = float(os.getenv('QUANT_MAE_TOLERANCE', '0.02'))
+QUANT_MAE_SLACK = float(os.getenv('QUANT_MAE_SLACK', '0.05'))
+# Số mẫu validation mới nhất tối đa dùng làm cửa sổ holdout
+QUANT_HOLDOUT = int(os.getenv('QUANT_HOLDOUT', '48'))
+QUANT_MODULES = {nn.LSTM, nn.Linear}
+
+def int8_path(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}.int8{ext}"
+
+def quantize_model(model):
+    """Bản sao int8 của model (trọng số LSTM/Linear lượng tử hóa, activation vẫn float)."""
+    return quantize_dynamic(copy.deepcopy(model).eval(), QUANT_MODULES, dtype=torch.qint8)
+
+def load_quantized(model, path):
+    # state_dict int8 chỉ nạp được vào model đã được lượng tử hóa cùng cấu trúc
+    quantized = quantize_model(model)
+    # Trọng số int8 được đóng gói dạng ScriptObject -> không nạp được với weights_only
+    # (chỉ nạp artifact do chính pipeline train ghi ra, đã kiểm checksum qua registry)
+    quantized.load_state_dict(torch.load(path, weights_only=False))
+    return quantized.eval()
+
+def model_nbytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def measure_latency_us(fn, x, repeat=200, warmup=10):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(x)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(x)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def gate_quantized(model, quantized, X_holdout, y_holdout, inverse, label='model'):
+    """
+    So sánh fp32 và int8 trên cửa sổ holdout. inverse(pred_scaled) -> giá trị thực (µg/m³), cùng shape y_holdout.
+    Trả về report (dict): MAE, độ trễ / lần gọi, dung lượng trọng số và ok (qua cổng hay không).
+    """
+    with torch.no_grad():
+        pred_fp32 = inverse(model(X_holdout).numpy())
+        pred_int8 = inverse(quantized(X_holdout).numpy())
+    mae_fp32 = float(np.mean(np.abs(pred_fp32 - y_holdout)))
+    mae_int8 = float(np.mean(np.abs(pred_int8 - y_holdout)))
+    limit = mae_fp32 * (1 + QUANT_MAE_TOLERANCE) + QUANT_MAE_SLACK
+
+    report = {
+        'ok': mae_int8 <= limit,
+        'holdout_samples': int(len(y_holdout)),
+        'mae_fp32': round(mae_fp32, 4),
+        'mae_int8': round(mae_int8, 4),
+        'latency_us_fp32': round(measure_latency_us(model, X_holdout), 1),
+        'latency_us_int8': round(measure_latency_us(quantized, X_holdout), 1),
+        'bytes_fp32': model_nbytes(model),
+        'bytes_int8': model_nbytes(quantized),
+    }
+    status = '✅' if report['ok'] else '❌'
+    print(f"{status} Int8 {label}: MAE {mae_fp32:.3f} -> {mae_int8:.3f} µg/m³ (ngưỡng {limit:.3f}), "
+          f"{report['latency_us_fp32']:.0f} -> {report['latency_us_int8']:.0f} µs/lần, "
+          f"{report['bytes_fp32'] / 1024:.1f} -> {report['bytes_int8'] / 1024:.1f} KB")
+    if not report['ok']:
+        print(f"⚠️ Int8 {label} không qua cổng sai số -> giữ fp32.")
+    return report
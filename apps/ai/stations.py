@@ -0,0 +1,69 @@
+#
+# Copyright 2025 Green-AQI Navigator Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Danh sách trạm dùng chung cho train/predict/graph (thứ tự trong file = thứ tự node trong đồ thị)
+
+import os
+import json
+from sqlalchemy import text
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIONS_FILE = os.getenv('STATIONS_FILE') or os.path.join(BASE_DIR, 'stations.json')
+ENTITY_PREFIX = 'urn:ngsi-ld:AirQualityStation:OWM-'
+
+# Tọa độ mới nhất của từng trạm OWM (cột location là geography PostGIS)
+STATIONS_QUERY = text("""
+    SELECT DISTINCT ON (entity_id) entity_id,
+           ST_Y(location::geometry) AS lat,
+           ST_X(location::geometry) AS lon
+    FROM air_quality_observations
+    WHERE location IS NOT NULL AND entity_id LIKE :prefix
+    ORDER BY entity_id, time DESC
+""")
+
+def load_stations(path=STATIONS_FILE):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def load_stations_from_db(engine):
+    """Đọc danh sách trạm + tọa độ từ air_quality_observations (sắp theo id; ghép với file bằng merge_stations)."""
+    with engine.connect() as conn:
+        rows = conn.execute(STATIONS_QUERY, {'prefix': ENTITY_PREFIX + '%'}).fetchall()
+    return [
+        { 'id': entity_id[len(ENTITY_PREFIX):], 'lat': float(lat), 'lon': float(lon) }
+        for entity_id, lat, lon in rows
+    ]
+
+def merge_stations(existing, fresh):
+    """
+    Cập nhật danh sách trạm hiện có bằng dữ liệu mới mà không đổi thứ tự node:
+    trạm đã có giữ nguyên vị trí (cập nhật tọa độ), trạm mới thêm vào cuối. Trạm không còn trong `fresh`
+    vẫn được giữ (bỏ đi sẽ dịch chỉ số các node sau nó). Trả về (danh sách, id trạm mới thêm).
+    Thứ tự node gắn graph_structure.pt, trọng số GNN và cột của scaler với nhau nên không bao giờ được sắp lại.
+    """
+    fresh_by_id = {s['id']: s for s in fresh}
+    merged = [dict(s, **fresh_by_id.get(s['id'], {})) for s in existing]
+    known = {s['id'] for s in existing}
+    added = [s for s in fresh if s['id'] not in known]
+    return merged + added, [s['id'] for s in added]
+
+def save_stations(stations, path=STATIONS_FILE):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(stations, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+HCMC_GRID = load_stations()
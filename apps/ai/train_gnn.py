@@ -15,35 +15,39 @@
 #
 
 import os
-import pandas as pd
+import time
+import shutil
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import joblib
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from stations import HCMC_GRID # Danh sách trạm dùng chung (stations.json)
 from sklearn.preprocessing import MinMaxScaler
-from gnn_model import ST_GNN  
+from gnn_model import ST_GNN
+from obs_cache import ObservationCache
+from data_access import GNN_GRID_FREQ, parse_interval
+from model_registry import ModelRegistry
+from export_model import export_artifacts
+from numpy_engine import LITE_SCALER_FILE, save_scaler_npz
+from quantize import QUANTIZE_MODELS, QUANT_HOLDOUT, quantize_model, gate_quantized
+from finetune import (FINETUNE_MAX_EPOCHS, TrainCheckpoint, choose_mode, replay_start, split_train_val,
+                      finetune_lr, fit, format_time, parse_time)
+from datetime import datetime, timezone
 
 # Cấu hình
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-# Đủ 9 trạm như yêu cầu
-HCMC_GRID = [
-  { 'id': 'ThuDuc', 'lat': 10.8231, 'lon': 106.7711 },
-  { 'id': 'District12', 'lat': 10.8672, 'lon': 106.6415 },
-  { 'id': 'HocMon', 'lat': 10.8763, 'lon': 106.5941 },
-  { 'id': 'District1', 'lat': 10.7769, 'lon': 106.7009 },
-  { 'id': 'BinhTan', 'lat': 10.7656, 'lon': 106.6031 },
-  { 'id': 'District2', 'lat': 10.7877, 'lon': 106.7407 },
-  { 'id': 'District7', 'lat': 10.734, 'lon': 106.7206 },
-  { 'id': 'BinhChanh', 'lat': 10.718, 'lon': 106.6067 },
-  { 'id': 'CanGio', 'lat': 10.518, 'lon': 106.8776 },
-]
-NUM_NODES = len(HCMC_GRID) # = 9
+NUM_NODES = len(HCMC_GRID)
+STATION_IDS = [point['id'] for point in HCMC_GRID]
 SEQ_LENGTH = 4  
-EPOCHS = 100     # Tăng epoch lên để học kỹ hơn với dữ liệu ít
+EPOCHS = 100     # Số epoch tối đa khi train full (dừng sớm theo validation)
 LEARNING_RATE = 0.005 # Giảm learning rate để hội tụ ổn định
+# Số bước dự báo (mỗi bước = 1 bucket GNN_GRID_FREQ) ra cùng lúc trong 1 lần forward
+HORIZONS = int(os.getenv('GNN_HORIZONS', '1'))
+# Số snapshot đồ thị gộp vào 1 lần forward/optimizer.step() (1 = SGD từng mẫu như cũ)
+BATCH_SIZE = int(os.getenv('GNN_BATCH_SIZE', '32'))
 
 def get_db_engine():
     env_path = os.path.join(BASE_DIR, '..', '..', '.env')
@@ -59,71 +63,136 @@ def get_db_engine():
     return create_engine(db_url)
 
 def load_data_from_db(engine):
-    print("📥 Đang tải dữ liệu từ Database...")
-    dfs = []
-    for point in HCMC_GRID:
-        entity_id = f"urn:ngsi-ld:AirQualityStation:OWM-{point['id']}"
-        query = text(f"""
-            SELECT time, pm2_5 
-            FROM air_quality_observations 
-            WHERE entity_id = '{entity_id}'
-            ORDER BY time ASC
-        """)
-        with engine.connect() as conn:
-            df = pd.read_sql(query, conn)
-            
-            # Nếu trạm nào chưa có dữ liệu thì bỏ qua (hoặc xử lý fill sau)
-            if df.empty:
-                print(f"⚠️ Cảnh báo: Trạm {point['id']} chưa có dữ liệu!")
-                return None
-
-            df = df.rename(columns={'pm2_5': point['id']})
-            df = df.set_index('time')
-            # Fix Warning: Dùng '1h' thay vì '1H'
-            df = df.resample('1h').mean().interpolate(method='linear') 
-            dfs.append(df)
-    
-    if not dfs: return None
+    print("📥 Đang tải dữ liệu từ Database (bucket 1h tính trong DB + incremental cache)...")
+    # Chỉ hỏi DB các bucket từ bucket cuối đã cache trở đi, lưới bucket trùng với lúc predict (data_access)
+    cache = ObservationCache(engine, GNN_GRID_FREQ)
+    entity_ids = [f"urn:ngsi-ld:AirQualityStation:OWM-{point['id']}" for point in HCMC_GRID]
+    times, values = cache.load_grid(entity_ids)
+
+    # Nếu trạm nào chưa có dữ liệu thì bỏ qua (hoặc xử lý fill sau)
+    missing = [point['id'] for point, column in zip(HCMC_GRID, values.T) if np.isnan(column).all()]
+    if not len(values) or missing:
+        print(f"⚠️ Cảnh báo: Trạm {', '.join(missing) or '(tất cả)'} chưa có dữ liệu!")
+        return None, None
 
-    # Gộp tất cả lại thành 1 bảng lớn
-    dataset = pd.concat(dfs, axis=1).dropna()
-    print(f"📊 Dữ liệu sạch để train: {dataset.shape} (Thời gian x 9 Trạm)")
-    return dataset.values
+    # Bỏ các mốc trước khi mọi trạm đều có dữ liệu (tương đương dropna)
+    complete = ~np.isnan(values).any(axis=1)
+    dataset = values[complete]
+    print(f"📊 Dữ liệu sạch để train: {dataset.shape} (Thời gian x {NUM_NODES} Trạm)")
+    return times[complete], dataset
+
+def load_production(registry):
+    """(version, metadata, state_dict, scaler) của version CURRENT, None nếu chưa có."""
+    version = registry.current_version()
+    if version is None:
+        return None
+    try:
+        manifest = registry.load_manifest(version, verify=True)
+        version_dir = registry.version_dir(version)
+        state_dict = torch.load(os.path.join(version_dir, 'gnn_model.pth'))
+        scaler = joblib.load(os.path.join(version_dir, 'gnn_scaler.joblib'))
+    except Exception as e:
+        print(f"⚠️ Không đọc được model production {version}, train full: {e}")
+        return None
+    return version, manifest.get('metadata', {}), state_dict, scaler
 
-def create_sequences(data, seq_length):
+def is_compatible(metadata):
+    # Chỉ fine-tune được từ model cùng kiến trúc / cửa sổ, có ghi mốc dữ liệu của lần train trước
+    return (metadata.get('num_nodes') == NUM_NODES and metadata.get('seq_length') == SEQ_LENGTH
+            and metadata.get('hidden_dim') == 16 and metadata.get('horizons') == HORIZONS
+            and metadata.get('station_ids', STATION_IDS) == STATION_IDS and bool(metadata.get('data_end')))
+
+def evaluate(model, criterion, X_tensor, y_tensor):
+    """Loss trên tập (N, Nodes, Seq, 1) / (N, Nodes, Horizons), không tính gradient."""
+    model.eval()
+    num_samples, num_nodes, seq_length = X_tensor.shape[:3]
+    with torch.no_grad():
+        output = model(X_tensor.reshape(num_samples * num_nodes, seq_length, 1))
+        return criterion(output.view(y_tensor.shape), y_tensor).item()
+
+def create_sequences(data, seq_length, horizons=1):
     # data shape: (Time_Steps, Num_Nodes) -> (381, 9)
-    xs, ys = [], []
-    for i in range(len(data) - seq_length):
-        x = data[i:(i + seq_length)]      # Input: 4 giờ liên tiếp
-        y = data[i + seq_length]          # Target: Giờ thứ 5
-        xs.append(x)
-        ys.append(y)
-    return np.array(xs), np.array(ys)
+    # Cửa sổ trượt dạng view (không copy): X[i] = data[i:i+seq_length].T, y[i] = data[i+seq_length:i+seq_length+horizons].T
+    # X shape: (Samples, Num_Nodes, Seq_Len) - đúng layout model cần, y shape: (Samples, Num_Nodes, Horizons)
+    xs = np.lib.stride_tricks.sliding_window_view(data[:len(data) - horizons], seq_length, axis=0)
+    ys = np.lib.stride_tricks.sliding_window_view(data[seq_length:], horizons, axis=0)
+    return xs, ys
+
+def train_epoch(model, optimizer, criterion, X_tensor, y_tensor, batch_size):
+    """
+    1 epoch mini-batch (xáo trộn). X_tensor: (N, Nodes, Seq, 1), y_tensor: (N, Nodes, Horizons). Trả về loss TB.
+    Model phải ở chế độ đồ thị tĩnh (model.set_graph) -> mọi snapshot trong batch dùng chung 1 Â.
+    """
+    model.train()
+    num_samples, num_nodes, seq_length = X_tensor.shape[:3]
+    horizons = y_tensor.shape[-1]
+    total_loss = 0
+    permutation = torch.randperm(num_samples)
+
+    # Mini-batch: gộp nhiều snapshot (B, 9, 4, 1) -> (B*9, 4, 1) vào 1 forward
+    for start in range(0, num_samples, batch_size):
+        idx = permutation[start:start + batch_size]
+        size = len(idx)
+        x_batch = X_tensor[idx].reshape(size * num_nodes, seq_length, 1)
+        y_batch = y_tensor[idx] # (B, 9, Horizons)
+
+        optimizer.zero_grad()
+
+        # Forward pass
+        output = model(x_batch)
+
+        # Tính loss: output shape (B*9, Horizons) -> (B, 9, Horizons) vs y_batch (B, 9, Horizons)
+        loss = criterion(output.view(size, num_nodes, horizons), y_batch)
+
+        loss.backward()
+        optimizer.step()
+
+        total_loss += loss.item() * size
+
+    return total_loss / num_samples
 
 def train():
     engine = get_db_engine()
+    registry = ModelRegistry('gnn')
     
     # 1. Load Data
-    raw_data = load_data_from_db(engine)
-    if raw_data is None or len(raw_data) < SEQ_LENGTH + 2:
+    times, raw_data = load_data_from_db(engine)
+    if raw_data is None:
+        print("❌ Dữ liệu quá ít để train! Hãy đợi Crawler chạy thêm.")
+        return
+
+    # Version đang CURRENT trước khi publish: cổng backtest so sánh / rollback về đúng version này
+    previous_version = registry.current_version()
+    # Nightly: fine-tune từ model production trên dữ liệu mới + cửa sổ replay; full: train lại toàn bộ lịch sử
+    production = load_production(registry)
+    base_version, base_meta = (production[0], production[1]) if production else (None, {})
+    mode = choose_mode(base_meta.get('full_trained_at') or base_meta.get('trained_at'), is_compatible(base_meta))
+    if mode == 'nightly':
+        start = replay_start(times, parse_time(base_meta['data_end']), SEQ_LENGTH)
+        if start is None:
+            print(f"⏩ Không có dữ liệu mới kể từ {base_meta['data_end']}, giữ model {base_version}.")
+            return
+        raw_data = raw_data[start:]
+        print(f"🔁 Fine-tune từ version {base_version}: {len(raw_data)} mốc (dữ liệu mới + replay)")
+
+    if len(raw_data) < SEQ_LENGTH + HORIZONS + 1:
         print("❌ Dữ liệu quá ít để train! Hãy đợi Crawler chạy thêm.")
         return
 
     # 2. Scale Data
-    scaler = MinMaxScaler()
-    data_scaled = scaler.fit_transform(raw_data)
-    
-    joblib.dump(scaler, os.path.join(BASE_DIR, 'gnn_scaler.joblib'))
-    print("💾 Đã lưu Scaler.")
+    if mode == 'nightly':
+        # Giữ scaler của model gốc (trọng số học trên thang đo này)
+        scaler = production[3]
+        data_scaled = scaler.transform(raw_data)
+    else:
+        scaler = MinMaxScaler()
+        data_scaled = scaler.fit_transform(raw_data)
+    # Scaler chỉ được lưu cùng model khi publish (tránh cặp model/scaler lệch nhau)
 
     # 3. Tạo Sequence
-    # X shape ban đầu: (Samples, Seq_Len, Nodes) = (N, 4, 9)
-    X, y = create_sequences(data_scaled, SEQ_LENGTH)
-    
-    # 🛑 FIX QUAN TRỌNG: Đổi trục để khớp với Model
-    # Model GNN yêu cầu: (Nodes, Seq_Len, Features) = (9, 4, 1) cho mỗi lần chạy
-    # Ta chuyển X thành: (Samples, Nodes, Seq_Len) = (N, 9, 4)
-    X = np.transpose(X, (0, 2, 1)) 
+    # Model GNN yêu cầu: (Nodes, Seq_Len, Features) = (9, 4, 1) cho mỗi snapshot
+    # X shape: (Samples, Nodes, Seq_Len) = (N, 9, 4)
+    X, y = create_sequences(data_scaled, SEQ_LENGTH, HORIZONS)
     
     # Thêm trục Features cuối cùng -> (Samples, Nodes, Seq_Len, 1) = (N, 9, 4, 1)
     X = X[..., np.newaxis]         
@@ -133,51 +202,105 @@ def train():
     y_tensor = torch.tensor(y, dtype=torch.float32)
     
     # Load cấu trúc đồ thị
+    graph_path = os.path.join(BASE_DIR, 'graph_structure.pt')
     try:
-        edge_index, edge_weight = torch.load(os.path.join(BASE_DIR, 'graph_structure.pt'))
+        edge_index, edge_weight = torch.load(graph_path)
     except:
         print("⚠️ Không tìm thấy graph_structure.pt, vui lòng chạy script tạo graph trước!")
         return
 
     # 4. Khởi tạo Model
-    model = ST_GNN(num_nodes=NUM_NODES, input_dim=1, hidden_dim=16, output_dim=1)
+    model = ST_GNN(num_nodes=NUM_NODES, input_dim=1, hidden_dim=16, output_dim=HORIZONS)
+    if mode == 'nightly':
+        model.load_state_dict(production[2])
+    # Đồ thị không đổi trong suốt quá trình train -> chuẩn hóa 1 lần thay vì mỗi bước
+    model.set_graph(edge_index, edge_weight)
     criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    learning_rate = finetune_lr(LEARNING_RATE, mode)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+    max_epochs = FINETUNE_MAX_EPOCHS if mode == 'nightly' else EPOCHS
 
-    print(f"🏋️‍♀️ Bắt đầu Train ({EPOCHS} epochs) trên {len(X_tensor)} mẫu dữ liệu...")
-    model.train()
-    
-    # 🛑 VÒNG LẶP TRAIN (Sửa lỗi 4D Input)
-    for epoch in range(EPOCHS):
-        total_loss = 0
-        
-        # Duyệt qua từng mẫu thời gian (Stochastic Gradient Descent)
-        for i in range(len(X_tensor)):
-            # Lấy 1 mẫu ra: X_tensor[i] có shape (9, 4, 1) -> ĐÚNG CHUẨN 3D
-            x_sample = X_tensor[i] 
-            y_sample = y_tensor[i] # (9,)
-            
-            optimizer.zero_grad()
-            
-            # Forward pass
-            output = model(x_sample, edge_index, edge_weight)
-            
-            # Tính loss: output shape (9, 1) vs y_sample (9,)
-            loss = criterion(output.squeeze(), y_sample)
-            
-            loss.backward()
-            optimizer.step()
-            
-            total_loss += loss.item()
-        
-        # In log mỗi 10 epoch
-        if (epoch+1) % 10 == 0:
-            avg_loss = total_loss / len(X_tensor)
-            print(f"   Epoch {epoch+1}/{EPOCHS}, Avg Loss: {avg_loss:.6f}")
-
-    # 5. Lưu Model
-    torch.save(model.state_dict(), os.path.join(BASE_DIR, 'gnn_model.pth'))
-    print("✅ Train hoàn tất! Đã lưu model mới vào gnn_model.pth")
+    # Các mẫu mới nhất làm validation cho early stopping
+    num_samples = len(X_tensor)
+    num_train = split_train_val(num_samples)
+    X_train, y_train = X_tensor[:num_train], y_tensor[:num_train]
+    X_val, y_val = X_tensor[num_train:], y_tensor[num_train:]
+    data_end = format_time(times[-1])
+    checkpoint = TrainCheckpoint('gnn', {
+        'mode': mode, 'base_version': base_version, 'data_end': data_end, 'samples': num_samples,
+        'horizons': HORIZONS, 'batch_size': BATCH_SIZE, 'learning_rate': learning_rate, 'max_epochs': max_epochs,
+    })
+    print(f"🏋️‍♀️ Bắt đầu Train {mode} (tối đa {max_epochs} epochs, batch {BATCH_SIZE}) trên {num_train} mẫu "
+          f"(+{num_samples - num_train} mẫu validation)...")
+
+    start_time = time.perf_counter()
+    stats = fit(
+        model, optimizer,
+        lambda: train_epoch(model, optimizer, criterion, X_train, y_train, BATCH_SIZE),
+        lambda: evaluate(model, criterion, X_val, y_val) if len(X_val) else None,
+        max_epochs, checkpoint, label='ST_GNN'
+    )
+    elapsed = time.perf_counter() - start_time
+    print(f"⚡ Train xong {stats['epochs_run']} epochs trong {elapsed:.1f}s (batch {BATCH_SIZE}), "
+          f"tốc độ train: {stats['epochs_run'] * num_train / elapsed:.0f} mẫu/giây")
+
+    # 5. Lượng tử hóa int8 (tùy chọn), chỉ giữ nếu MAE trên phần validation (không dùng để train)
+    #    không tệ hơn fp32 quá ngưỡng. Không có validation -> không lượng tử hóa.
+    quantized, quant_report = None, None
+    if QUANTIZE_MODELS and len(X_val):
+        model.eval()
+        holdout = min(QUANT_HOLDOUT, len(X_val))
+        X_holdout = X_val[-holdout:].reshape(-1, SEQ_LENGTH, 1)
+        # MinMaxScaler theo trạm: x = (x_scaled - min_) / scale_
+        data_min = scaler.min_[np.newaxis, :, np.newaxis]
+        data_scale = scaler.scale_[np.newaxis, :, np.newaxis]
+        inverse = lambda pred: (pred.reshape(holdout, NUM_NODES, HORIZONS) - data_min) / data_scale
+        y_holdout = inverse(y_val[-holdout:].numpy())
+        quantized = quantize_model(model)
+        quant_report = gate_quantized(model, quantized, X_holdout, y_holdout, inverse, label='ST_GNN')
+    elif QUANTIZE_MODELS:
+        print("⏩ Không có mẫu validation, bỏ qua lượng tử hóa int8.")
+
+    # 6. Publish model + scaler + graph thành 1 version mới trong registry (đổi CURRENT atomic)
+    trained_at = datetime.now(timezone.utc).isoformat()
+    metadata = {
+        'trained_at': trained_at,
+        'mode': mode,
+        'base_version': base_version,
+        'previous_version': previous_version,
+        # Lần train full gần nhất (nightly giữ nguyên của model gốc) -> quyết định khi nào train full lại
+        'full_trained_at': (base_meta.get('full_trained_at') or base_meta.get('trained_at')) if mode == 'nightly' else trained_at,
+        'data_end': data_end,
+        'num_nodes': NUM_NODES,
+        # Thứ tự node lúc train (predictor từ chối nạp nếu stations.json đã đổi thứ tự)
+        'station_ids': STATION_IDS,
+        'seq_length': SEQ_LENGTH,
+        'hidden_dim': 16,
+        'horizons': HORIZONS,
+        # Khoảng cách giữa 2 bước dự báo = 1 bucket GNN_GRID_FREQ (cùng cách tính với predict_gnn / backtest)
+        'step_minutes': int(parse_interval(GNN_GRID_FREQ).total_seconds() // 60),
+        'samples': num_samples,
+        'epochs': max_epochs,
+        'epochs_run': stats['epochs_run'],
+        'best_epoch': stats['best_epoch'],
+        'batch_size': BATCH_SIZE,
+        'learning_rate': learning_rate,
+        'final_loss': stats['final_loss'],
+        'val_loss': stats['val_loss'],
+        'quantization': quant_report,
+    }
+    with registry.publishing(metadata) as version_dir:
+        torch.save(model.state_dict(), os.path.join(version_dir, 'gnn_model.pth'))
+        joblib.dump(scaler, os.path.join(version_dir, 'gnn_scaler.joblib'))
+        # Tham số scaler dạng .npz cho chế độ lite (không cần sklearn/joblib lúc dự báo)
+        save_scaler_npz(os.path.join(version_dir, LITE_SCALER_FILE), scaler)
+        shutil.copy(graph_path, os.path.join(version_dir, 'graph_structure.pt'))
+        # Artifact biên dịch sẵn (TorchScript/ONNX) cho predictor, chỉ giữ cái qua được kiểm tra parity
+        export_artifacts(model, edge_index, edge_weight, version_dir, seq_length=SEQ_LENGTH)
+        if quant_report and quant_report['ok']:
+            torch.save(quantized.state_dict(), os.path.join(version_dir, 'gnn_model.int8.pth'))
+    checkpoint.clear()
+    print("✅ Train hoàn tất! Đã publish model mới vào registry")
 
 if __name__ == "__main__":
     train()
\ No newline at end of file
@@ -16,51 +16,49 @@
 
 
 import os
-import pandas as pd
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 import numpy as np
 import torch
 import torch.nn as nn
 import joblib
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from stations import HCMC_GRID
+from sqlalchemy import create_engine
 from sklearn.preprocessing import MinMaxScaler
+from obs_cache import ObservationCache
+from lstm_model import AirQualityLSTM, StackedAirQualityLSTM
+from data_access import LSTM_GRID_FREQ
+from numpy_engine import NumpyStackedLSTM, save_station_npz, load_station_npz
+from quantize import QUANTIZE_MODELS, QUANT_HOLDOUT, int8_path, quantize_model, gate_quantized
+from finetune import (FINETUNE_MAX_EPOCHS, TrainCheckpoint, choose_mode, replay_start, split_train_val,
+                      finetune_lr, fit, format_time, parse_time)
 
 # Cấu hình
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-HCMC_GRID_IDS = [
-    'ThuDuc', 'District12', 'HocMon', 'District1', 'BinhTan',
-    'District2', 'District7', 'BinhChanh', 'CanGio'
-]
+HCMC_GRID_IDS = [p['id'] for p in HCMC_GRID]
 SEQ_LENGTH = 4 # Dùng 4 mốc quá khứ (1 giờ) để dự báo
 HIDDEN_SIZE = 32
 NUM_LAYERS = 2
+EPOCHS = 100 # Số epoch tối đa khi train full (dừng sớm theo validation)
+LEARNING_RATE = 0.01
+# pool: chia các trạm cho LSTM_TRAIN_WORKERS process, mỗi process LSTM_TRAIN_THREADS thread torch
+#       (1 worker = train lần lượt trong process hiện tại như trước)
+# fused: mọi trạm train chung 1 vòng lặp trong 1 process (StackedAirQualityLSTM, bmm theo trục trạm)
+LSTM_TRAIN_MODE = os.getenv('LSTM_TRAIN_MODE', 'pool').lower()
+LSTM_TRAIN_WORKERS = int(os.getenv('LSTM_TRAIN_WORKERS', str(os.cpu_count() or 1)))
+LSTM_TRAIN_THREADS = int(os.getenv('LSTM_TRAIN_THREADS', '1'))
+# Mốc dữ liệu / thời điểm train của model hiện tại từng trạm (artifact .pth không nằm trong registry)
+TRAIN_STATE_PATH = os.path.join(BASE_DIR, 'lstm_train_state.json')
+# Sai số tuyệt đối tối đa giữa engine NumPy (.npz) và model torch, lệch hơn -> không giữ file .npz
+LSTM_PARITY_ATOL = float(os.getenv('LSTM_PARITY_ATOL', '1e-5'))
 
 # ---------------------------------------------------------
 # 1. ĐỊNH NGHĨA MÔ HÌNH LSTM (PyTorch)
 # ---------------------------------------------------------
-class AirQualityLSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, output_size=1):
-        super(AirQualityLSTM, self).__init__()
-        self.hidden_size = hidden_size
-        self.num_layers = num_layers
-        
-        # Layer LSTM
-        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
-        
-        # Layer Fully Connected (đầu ra)
-        self.fc = nn.Linear(hidden_size, output_size)
-
-    def forward(self, x):
-        # Khởi tạo hidden state và cell state
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        
-        # Forward pass
-        out, _ = self.lstm(x, (h0, c0))
-        
-        # Lấy output ở bước thời gian cuối cùng
-        out = self.fc(out[:, -1, :])
-        return out
+# AirQualityLSTM / StackedAirQualityLSTM định nghĩa 1 lần trong lstm_model.py (predict.py nạp .pth bằng cùng class)
 
 # ---------------------------------------------------------
 # 2. HÀM XỬ LÝ DỮ LIỆU
@@ -72,27 +70,24 @@ def get_db_engine():
              f"{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
     return create_engine(db_url)
 
-def load_raw_data(engine, grid_id):
-    """Tải dữ liệu thô, chưa tạo lag features"""
-    print(f"\n--- Tải dữ liệu cho: {grid_id} ---")
-    aqi_id = f"urn:ngsi-ld:AirQualityStation:OWM-{grid_id}"
-    
-    # Lấy AQI
-    query_aqi = text("SELECT time, pm2_5 FROM air_quality_observations WHERE entity_id = :id ORDER BY time")
-    with engine.connect() as conn:
-        df = pd.read_sql(query_aqi, conn, params={'id': aqi_id})
-    
-    if df.empty: return None
-    
-    df['time'] = pd.to_datetime(df['time'])
-    df.set_index('time', inplace=True)
-    df = df.resample('15min').mean().interpolate(method='linear')
-    
+def load_station_data(engine):
+    """
+    Tải chuỗi PM2.5 bucket 15min của mọi trạm (1 truy vấn), trả về dict grid_id -> (bucket datetime64 [T], mảng (T, 1)),
+    chưa tạo lag features
+    """
+    print("📥 Đang tải dữ liệu (bucket LSTM_GRID_FREQ tính trong DB + incremental cache)...")
+    entity_ids = [f"urn:ngsi-ld:AirQualityStation:OWM-{grid_id}" for grid_id in HCMC_GRID_IDS]
+    times, values = ObservationCache(engine, LSTM_GRID_FREQ).load_grid(entity_ids)
+
     # Lấy thêm Weather/Road (Ở đây ta demo với PM2.5 trước cho đơn giản, sau này thêm feature vào)
     # Để LSTM chạy ổn định, ta tạm thời chỉ dùng chuỗi PM2.5 univariate (đơn biến)
     # Sau này khi quen PyTorch, ta sẽ nối thêm cột Weather vào.
-    
-    return df
+    data = {}
+    for grid_id, column in zip(HCMC_GRID_IDS, values.T):
+        # Bỏ các mốc trước bản ghi đầu tiên của trạm
+        valid = ~np.isnan(column)
+        data[grid_id] = (times[valid], column[valid][:, np.newaxis])
+    return data
 
 def create_sequences(data, seq_length):
     """Chuyển dữ liệu bảng thành chuỗi (Sliding Window)"""
@@ -104,57 +99,288 @@ def create_sequences(data, seq_length):
         ys.append(y)
     return np.array(xs), np.array(ys)
 
+def load_train_state():
+    try:
+        with open(TRAIN_STATE_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_train_state(state):
+    # Ghi file tạm rồi đổi tên -> không bao giờ đọc phải file ghi dở
+    tmp_path = TRAIN_STATE_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, TRAIN_STATE_PATH)
+
+def load_station_production(grid_id):
+    """(state_dict, scaler) của model hiện tại của trạm, None nếu chưa có / không đọc được."""
+    model_path = os.path.join(BASE_DIR, f'lstm_model_{grid_id}.pth')
+    scaler_path = os.path.join(BASE_DIR, f'scaler_{grid_id}.joblib')
+    if not os.path.exists(model_path) or not os.path.exists(scaler_path):
+        return None
+    try:
+        return torch.load(model_path), joblib.load(scaler_path)
+    except Exception as e:
+        print(f"⚠️ {grid_id}: Không đọc được model hiện tại, train full: {e}")
+        return None
+
+def prepare_station(grid_id, times, data, meta):
+    """
+    Chọn chế độ train (nightly/full) + chuẩn hóa + tạo sequence cho 1 trạm.
+    Trả về dict job (mode, scaler, X, y, init_state, data_end...) hoặc None nếu không có gì để train.
+    """
+    production = load_station_production(grid_id) if meta else None
+    mode = choose_mode(meta.get('full_trained_at'), production is not None and bool(meta.get('data_end')))
+    init_state = None
+    if mode == 'nightly':
+        start = replay_start(times, parse_time(meta['data_end']), SEQ_LENGTH)
+        if start is None:
+            print(f"⏩ {grid_id}: Không có dữ liệu mới kể từ {meta['data_end']}, giữ model hiện tại.")
+            return None
+        data = data[start:]
+        # Giữ scaler của model gốc (trọng số học trên thang đo này)
+        init_state, scaler = production
+        data_scaled = scaler.transform(data)
+    else:
+        if len(data) < 20:
+            print(f"❌ {grid_id}: Không đủ dữ liệu.")
+            return None
+        # Chuẩn hóa dữ liệu (Bắt buộc cho LSTM)
+        scaler = MinMaxScaler(feature_range=(0, 1))
+        data_scaled = scaler.fit_transform(data)
+    X, y = create_sequences(data_scaled, SEQ_LENGTH)
+    if len(X) < 5:
+        print(f"❌ {grid_id}: Không đủ dữ liệu.")
+        return None
+    return {
+        'mode': mode, 'scaler': scaler, 'X': X, 'y': y, 'init_state': init_state,
+        'num_train': split_train_val(len(X)),
+        'data_end': format_time(times[-1]),
+        'full_trained_at': meta.get('full_trained_at') if mode == 'nightly' else None,
+    }
+
+def _run_key(job):
+    # Mô tả lần train để chỉ resume checkpoint của đúng lần train này
+    return {'mode': job['mode'], 'data_end': job['data_end'], 'samples': len(job['X']), 'num_train': job['num_train'],
+            'learning_rate': finetune_lr(LEARNING_RATE, job['mode']), 'max_epochs': _max_epochs(job['mode'])}
+
+def _max_epochs(mode):
+    return FINETUNE_MAX_EPOCHS if mode == 'nightly' else EPOCHS
+
+def train_station(grid_id, job):
+    """Train (hoặc fine-tune) AirQualityLSTM của 1 trạm, full-batch, dừng sớm theo validation. Trả về (state_dict, stats)."""
+    X = torch.from_numpy(job['X']).float()
+    y = torch.from_numpy(job['y']).float()
+    num_train = job['num_train']
+    X_train, y_train, X_val, y_val = X[:num_train], y[:num_train], X[num_train:], y[num_train:]
+
+    # Khởi tạo mô hình
+    model = AirQualityLSTM(input_size=1, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS)
+    if job['init_state'] is not None:
+        model.load_state_dict(job['init_state'])
+    criterion = nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=finetune_lr(LEARNING_RATE, job['mode']))
+
+    def run_epoch():
+        model.train()
+        optimizer.zero_grad()
+        outputs = model(X_train)
+        loss = criterion(outputs, y_train)
+        loss.backward()
+        optimizer.step()
+        return loss.item()
+
+    def eval_loss():
+        if not len(X_val):
+            return None
+        model.eval()
+        with torch.no_grad():
+            return criterion(model(X_val), y_val).item()
+
+    # Huấn luyện
+    print(f"🚀 Đang train LSTM ({job['mode']}) cho {grid_id}...")
+    stats = fit(model, optimizer, run_epoch, eval_loss, _max_epochs(job['mode']),
+                TrainCheckpoint(f'lstm_{grid_id}', _run_key(job)), label=grid_id, log_every=20)
+    return model.state_dict(), stats
+
+def _init_worker(threads):
+    # Mỗi worker chỉ dùng `threads` thread (tránh N worker x N thread tranh nhau core)
+    torch.set_num_threads(threads)
+
+def train_pool(prepared, workers=LSTM_TRAIN_WORKERS, threads=LSTM_TRAIN_THREADS):
+    """Train từng trạm độc lập trên process pool. Trả về (state_dict, stats) theo thứ tự `prepared`."""
+    workers = max(1, min(workers, len(prepared)))
+    if workers == 1:
+        return [train_station(grid_id, job) for grid_id, job in prepared]
+
+    print(f"🧵 Train {len(prepared)} trạm trên {workers} process x {threads} thread...")
+    # spawn: không fork process đã khởi tạo thread pool của torch / kết nối DB
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        futures = [pool.submit(train_station, grid_id, job) for grid_id, job in prepared]
+        return [future.result() for future in futures]
+
+def _pad_stations(arrays, max_len):
+    # Ghép mảng của từng trạm thành [S, max_len, ...], đệm 0 ở cuối
+    out = np.zeros((len(arrays), max_len) + arrays[0].shape[1:], dtype=np.float32)
+    for s, array in enumerate(arrays):
+        out[s, :len(array)] = array
+    return torch.from_numpy(out)
+
+def train_fused(prepared, mode):
+    """
+    Train mọi trạm (cùng `mode`) trong 1 vòng lặp: trọng số xếp chồng theo trục trạm (StackedAirQualityLSTM),
+    sequence của từng trạm đệm 0 tới cùng độ dài + mask. Loss = tổng MSE (trung bình trên mẫu thật) của
+    từng trạm; trọng số các trạm tách rời và Adam cập nhật theo từng phần tử nên mỗi trạm nhận đúng
+    gradient/bước cập nhật như khi train riêng. Dừng sớm theo tổng loss validation của các trạm.
+    Trả về (state_dict, stats) (định dạng AirQualityLSTM) theo thứ tự `prepared`.
+    """
+    num_stations = len(prepared)
+    jobs = [job for _, job in prepared]
+    max_len = max(len(job['X']) for job in jobs)
+    X_all = _pad_stations([job['X'] for job in jobs], max_len)
+    y_all = _pad_stations([job['y'] for job in jobs], max_len)
+    # Mẫu train / validation (phần cuối) của từng trạm, phần đệm không thuộc mask nào
+    train_mask = _pad_stations([np.ones((job['num_train'], 1)) for job in jobs], max_len)
+    val_mask = _pad_stations([np.ones((len(job['X']), 1)) for job in jobs], max_len) - train_mask
+    train_counts = train_mask.sum(dim=(1, 2))
+    val_counts = val_mask.sum(dim=(1, 2))
+    has_val = bool((val_counts > 0).all())
+
+    # Khởi tạo giống hệt train_station (trọng số production, hoặc mỗi trạm 1 AirQualityLSTM mới) rồi xếp chồng
+    inits = [job['init_state'] if job['init_state'] is not None
+             else AirQualityLSTM(input_size=1, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS).state_dict()
+             for job in jobs]
+    model = StackedAirQualityLSTM.from_state_dicts(inits, input_size=1, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS)
+    optimizer = torch.optim.Adam(model.parameters(), lr=finetune_lr(LEARNING_RATE, mode))
+
+    def run_epoch():
+        model.train()
+        optimizer.zero_grad()
+        outputs = model(X_all)
+        station_loss = (((outputs - y_all) ** 2) * train_mask).sum(dim=(1, 2)) / train_counts
+        station_loss.sum().backward()
+        optimizer.step()
+        return station_loss.mean().item()
+
+    def eval_loss():
+        if not has_val:
+            return None
+        model.eval()
+        with torch.no_grad():
+            station_loss = (((model(X_all) - y_all) ** 2) * val_mask).sum(dim=(1, 2)) / val_counts
+        return station_loss.mean().item()
+
+    print(f"🚀 Đang train LSTM gộp ({mode}) cho {num_stations} trạm ({max_len} mẫu/trạm, {torch.get_num_threads()} thread)...")
+    run = {'stations': [grid_id for grid_id, _ in prepared], 'jobs': [_run_key(job) for job in jobs]}
+    stats = fit(model, optimizer, run_epoch, eval_loss, _max_epochs(mode),
+                TrainCheckpoint(f'lstm_fused_{mode}', run), label='LSTM gộp', log_every=20)
+    return [(state_dict, stats) for state_dict in model.to_state_dicts()]
+
+def check_lite_parity(model, npz_path, batch_size=64, batches=4, seed=0):
+    """Sai số tuyệt đối lớn nhất giữa NumpyStackedLSTM (đọc lại từ file .npz) và model torch, input ngẫu nhiên 0..1."""
+    state_dict, _ = load_station_npz(npz_path)
+    runner = NumpyStackedLSTM([state_dict])
+    generator = torch.Generator().manual_seed(seed)
+    max_diff = 0.0
+    model.eval()
+    with torch.no_grad():
+        for _ in range(batches):
+            x = torch.rand(batch_size, SEQ_LENGTH, model.lstm.input_size, generator=generator)
+            max_diff = max(max_diff, float(np.abs(runner(x.numpy()[np.newaxis])[0] - model(x).numpy()).max()))
+    return max_diff
+
+def save_station(grid_id, state_dict, scaler, X_val, y_val):
+    """
+    Lưu artifact của 1 trạm đúng định dạng predict.py đọc (.pth + .joblib + .npz, tùy chọn .int8).
+    X_val / y_val: phần validation (không dùng để train) cho cổng sai số int8.
+    """
+    model = AirQualityLSTM(input_size=1, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS)
+    model.load_state_dict(state_dict)
+
+    # Lưu mô hình (PyTorch save state_dict)
+    model_path = os.path.join(BASE_DIR, f'lstm_model_{grid_id}.pth')
+    scaler_path = os.path.join(BASE_DIR, f'scaler_{grid_id}.joblib')
+
+    torch.save(model.state_dict(), model_path)
+    joblib.dump(scaler, scaler_path) # Lưu scaler để lúc dự báo còn giải mã ngược lại
+    # Bản .npz (trọng số + scaler) cho predictor chế độ lite (LSTM_LITE, không cần torch)
+    npz_path = os.path.join(BASE_DIR, f'lstm_model_{grid_id}.npz')
+    save_station_npz(npz_path, model.state_dict(), scaler)
+    diff = check_lite_parity(model, npz_path)
+    if diff > LSTM_PARITY_ATOL:
+        # Lệch torch -> xóa, predictor lite bỏ qua trạm này thay vì dự báo sai
+        os.remove(npz_path)
+        print(f"❌ [{grid_id}] Engine NumPy lệch torch {diff:.2e} > {LSTM_PARITY_ATOL:.0e}, không giữ {os.path.basename(npz_path)}")
+
+    # Bản int8 (tùy chọn) cạnh bản fp32, chỉ khi qua cổng sai số trên phần validation (không dùng để train)
+    report = None
+    if QUANTIZE_MODELS and len(X_val):
+        model.eval()
+        quantized = quantize_model(model)
+        holdout = min(QUANT_HOLDOUT, len(X_val))
+        report = gate_quantized(
+            model, quantized, torch.from_numpy(X_val[-holdout:]).float(), scaler.inverse_transform(y_val[-holdout:]),
+            scaler.inverse_transform, label=grid_id
+        )
+        if report['ok']:
+            torch.save(quantized.state_dict(), int8_path(model_path))
+    elif QUANTIZE_MODELS:
+        print(f"⏩ [{grid_id}] Không có mẫu validation, bỏ qua lượng tử hóa int8.")
+    if (report is None or not report['ok']) and os.path.exists(int8_path(model_path)):
+        # Không để lại bản int8 của lần train trước (lệch với fp32 mới)
+        os.remove(int8_path(model_path))
+
+    print(f"✅ Đã lưu model LSTM: {model_path}")
+
 # ---------------------------------------------------------
 # 3. MAIN TRAINING LOOP
 # ---------------------------------------------------------
 def main():
     engine = get_db_engine()
     
+    station_data = load_station_data(engine)
+    train_state = load_train_state()
+    prepared = []
     for grid_id in HCMC_GRID_IDS:
-        df = load_raw_data(engine, grid_id)
-        if df is None or len(df) < 20:
-            print(f"❌ {grid_id}: Không đủ dữ liệu.")
-            continue
+        times, data = station_data[grid_id]
+        job = prepare_station(grid_id, times, data, train_state.get(grid_id, {}))
+        if job is not None:
+            prepared.append((grid_id, job))
+    if not prepared:
+        return
 
-        # Chuẩn hóa dữ liệu (Bắt buộc cho LSTM)
-        scaler = MinMaxScaler(feature_range=(0, 1))
-        data_scaled = scaler.fit_transform(df[['pm2_5']].values)
-
-        # Tạo Sequence
-        X, y = create_sequences(data_scaled, SEQ_LENGTH)
-        
-        if len(X) < 5: continue
+    if LSTM_TRAIN_MODE == 'fused':
+        # Trạm fine-tune và trạm train full khác learning rate / số epoch -> mỗi chế độ 1 model gộp
+        results = {}
+        for mode in ('nightly', 'full'):
+            group = [(grid_id, job) for grid_id, job in prepared if job['mode'] == mode]
+            if group:
+                results.update(zip([grid_id for grid_id, _ in group], train_fused(group, mode)))
+        results = [results[grid_id] for grid_id, _ in prepared]
+    else:
+        results = train_pool(prepared)
 
-        # Chuyển sang Tensor
-        X_train = torch.from_numpy(X).float()
-        y_train = torch.from_numpy(y).float()
+    for (grid_id, job), (state_dict, stats) in zip(prepared, results):
+        save_station(grid_id, state_dict, job['scaler'], job['X'][job['num_train']:], job['y'][job['num_train']:])
+        trained_at = datetime.now(timezone.utc).isoformat()
+        train_state[grid_id] = {
+            'trained_at': trained_at,
+            'mode': job['mode'],
+            # Lần train full gần nhất (nightly giữ nguyên) -> quyết định khi nào train full lại
+            'full_trained_at': job['full_trained_at'] or trained_at,
+            'data_end': job['data_end'],
+            'samples': len(job['X']),
+            **stats,
+        }
+        save_train_state(train_state)
 
-        # Khởi tạo mô hình
-        model = AirQualityLSTM(input_size=1, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS)
-        criterion = nn.MSELoss()
-        optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
-
-        # Huấn luyện
-        print(f"🚀 Đang train LSTM cho {grid_id}...")
-        model.train()
-        for epoch in range(100): # Chạy 100 vòng
-            optimizer.zero_grad()
-            outputs = model(X_train)
-            loss = criterion(outputs, y_train)
-            loss.backward()
-            optimizer.step()
-            
-            if (epoch+1) % 20 == 0:
-                print(f"   Epoch {epoch+1}/100, Loss: {loss.item():.4f}")
-
-        # Lưu mô hình (PyTorch save state_dict)
-        model_path = os.path.join(BASE_DIR, f'lstm_model_{grid_id}.pth')
-        scaler_path = os.path.join(BASE_DIR, f'scaler_{grid_id}.joblib')
-        
-        torch.save(model.state_dict(), model_path)
-        joblib.dump(scaler, scaler_path) # Lưu scaler để lúc dự báo còn giải mã ngược lại
-        
-        print(f"✅ Đã lưu model LSTM: {model_path}")
+    # Artifact + mốc dữ liệu đã lưu -> bỏ checkpoint của lần train này
+    for grid_id, _ in prepared:
+        TrainCheckpoint(f'lstm_{grid_id}', None).clear()
+    for mode in ('nightly', 'full'):
+        TrainCheckpoint(f'lstm_fused_{mode}', None).clear()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
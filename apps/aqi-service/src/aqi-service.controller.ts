@@ -219,11 +219,20 @@ export class AqiServiceController {
     // 2. Lấy dữ liệu quan trắc (Orion-LD)
     const observations = await this.routePlannerService.getObservationData();
 
-    // 3. Tính toán chi tiết từng điểm
+    // 3. Nội suy PM2.5 cho toàn bộ điểm của mọi tuyến trong 1 lần gọi AI worker
+    const allPoints = routesGeoJson.features.flatMap((route: any) =>
+      route.geometry.coordinates.map((coord: number[]) => ({ lat: coord[1], lng: coord[0] })), // [[lng, lat], ...]
+    );
+    const allPm25 = await this.routePlannerService.interpolateAqAtPoints(allPoints, observations);
+
+    // 4. Tính toán chi tiết từng tuyến
+    let offset = 0;
     routesGeoJson.features.forEach((route: any, index: number) => {
       let totalExposure = 0; // Tích lũy: (PM2.5 * Thời gian đi qua)
-      const coordinates = route.geometry.coordinates; // [[lng, lat], ...]
-      const pointAqis: number[] = []; // Mảng lưu PM2.5 của từng điểm
+      const coordinates = route.geometry.coordinates;
+      // Mảng lưu PM2.5 của từng điểm (cùng thứ tự với coordinates)
+      const pointAqis: number[] = allPm25.slice(offset, offset + coordinates.length);
+      offset += coordinates.length;
 
       // Lấy tổng thời gian (giây) và tổng khoảng cách (mét)
       const totalDuration = route.properties.summary.duration;
@@ -231,14 +240,7 @@ export class AqiServiceController {
       // Ước lượng thời gian đi qua mỗi đoạn nhỏ (giả sử tốc độ đều)
       const timePerPoint = totalDuration / coordinates.length;
 
-      coordinates.forEach((coord: number[]) => {
-        const point = { lat: coord[1], lng: coord[0] }; 
-        
-        // Nội suy PM2.5 tại điểm này
-        const pm25 = this.routePlannerService.interpolateAqAtPoint(point, observations);
-        
-        pointAqis.push(pm25); // Lưu lại để vẽ màu
-        
+      pointAqis.forEach((pm25: number) => {
         // Cộng dồn vào tổng lượng bụi hấp thụ (Liều lượng = Nồng độ * Thời gian)
         totalExposure += (pm25 * timePerPoint);
       });
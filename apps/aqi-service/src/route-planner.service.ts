@@ -30,6 +30,8 @@ export class RoutePlannerService {
   private readonly orsApiKey: string;
   private readonly orsApiUrl = 'https://api.openrouteservice.org/v2/directions/driving-car/geojson';
   private readonly orionLdUrl: string;
+  // API nội suy của AI worker (POST /interpolate), chỉ mở trong mạng green-net
+  private readonly aiForecastApiUrl: string;
 
   constructor(
     private readonly configService: ConfigService,
@@ -42,6 +44,8 @@ export class RoutePlannerService {
     const orionUrl = this.configService.get<string>('ORION_LD_URL');
     if (!orionUrl) throw new Error('ORION_LD_URL is not defined in .env');
     this.orionLdUrl = orionUrl;
+
+    this.aiForecastApiUrl = this.configService.get<string>('AI_FORECAST_API_URL') || 'http://ai-service:8090';
   }
 
   /**
@@ -165,6 +169,29 @@ export class RoutePlannerService {
     return closestPm25;
   }
   
+  /**
+   * Nội suy PM2.5 cho mọi điểm của các tuyến trong 1 request tới AI worker (IDW từ dự báo ST_GNN mới nhất).
+   * AI worker chưa có dự báo / lỗi -> quay về lấy trạm quan trắc gần nhất cho từng điểm.
+   */
+  async interpolateAqAtPoints(points: GeoPoint[], observations: any[]): Promise<number[]> {
+    if (points.length === 0) return [];
+    try {
+      const response = await firstValueFrom(
+        this.httpService.post(`${this.aiForecastApiUrl}/interpolate`, {
+          points: points.map((p) => [p.lng, p.lat]),
+          horizon: 1,
+          method: 'idw',
+        }, { timeout: 3000 }),
+      );
+      const values: (number | null)[] = response.data.pm25;
+      // null = không có trạm nào đủ gần -> dùng trạm quan trắc gần nhất
+      return values.map((v, i) => (v === null ? this.interpolateAqAtPoint(points[i], observations) : v));
+    } catch (error) {
+      this.logger.warn(`AI interpolate API không dùng được, dùng trạm gần nhất: ${error.message}`);
+      return points.map((p) => this.interpolateAqAtPoint(p, observations));
+    }
+  }
+
   async getNearbyGreenSpaces(dto: GetGreenSpacesDto): Promise<any> {
     const radius = dto.radius || 2000; 
     const params = {